@@ -1,15 +1,82 @@
 from fastapi import APIRouter
-from agent.app.models.dtos import Agent, AgentUpdate, Product, ProductUpdate
+from agent.app.models.dtos import Agent, AgentUpdate, Product, ProductUpdate, \
+    Branch, BranchUpdate, BranchDetail, SalesHistory
 from fastapi import Body
 from pydantic import BaseModel
 from typing import Annotated
 from agent.app.db_repository.sql_repoitory import SQLRepository, DatabaseOperationException \
-    , DataNotFoundException
-from agent.configs import DB_STRING
-from fastapi import HTTPException, status
+    , DataNotFoundException, DataConflictException
+from agent.app.db_repository.idempotency_store import IdempotencyStore, \
+    IdempotencyConflictException, IdempotencyInProgressException
+from fastapi import HTTPException, status, Depends, Request, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from typing import Optional, Literal
+from datetime import date
+from uuid import UUID
+import logging
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
-db_repository = SQLRepository(database_url=DB_STRING)  # Example URL, replace with actual
+
+def get_db_repository(request: Request) -> SQLRepository:
+    """Dependency returning the repository created by the app lifespan."""
+    return request.app.state.db_repository
+
+def get_idempotency_store(request: Request) -> IdempotencyStore:
+    """Dependency returning the idempotency store created by the app lifespan."""
+    return request.app.state.idempotency_store
+
+def replay_response(idempotency_store: IdempotencyStore, scope: str,
+                    idempotency_key: Optional[str], fingerprint: str):
+    """Return the stored response of a retried write request, if any, 
+    - otherwise reserve the key for this request."""
+    if not idempotency_key:
+        return None
+    try:
+        stored = idempotency_store.reserve(scope, idempotency_key, fingerprint)
+    except IdempotencyConflictException as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e)
+        )
+    except IdempotencyInProgressException as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    if stored is None:
+        return None
+    status_code, body = stored
+    return JSONResponse(status_code=status_code, content=body,
+                        headers={"Idempotent-Replayed": "true"})
+
+def remember_response(idempotency_store: IdempotencyStore, scope: str,
+                      idempotency_key: Optional[str], fingerprint: str, response: dict):
+    """Store the response of a successful write request under its key."""
+    if idempotency_key:
+        try:
+            idempotency_store.save(scope, idempotency_key, fingerprint,
+                                   status.HTTP_200_OK, jsonable_encoder(response))
+        except DatabaseOperationException as e:
+            # the write itself succeeded, do not turn it into an error
+            logger.warning(f"Could not store idempotent response: {e}")
+    return response
+
+def release_key(idempotency_store: IdempotencyStore, scope: str, idempotency_key: Optional[str]):
+    """Release the key of a write request that did not succeed, so it can 
+    - be retried. A no-op once the response has been stored."""
+    if idempotency_key:
+        try:
+            idempotency_store.release(scope, idempotency_key)
+        except DatabaseOperationException as e:
+            # the reservation expires by itself, keep the original response
+            logger.warning(f"Could not release idempotency key: {e}")
 
 class AgentResponse(BaseModel):
     message: str
@@ -19,6 +86,10 @@ class ProductResponse(BaseModel):
     message: str
     product: Product | ProductUpdate
 
+class BranchResponse(BaseModel):
+    message: str
+    branch: Branch | BranchUpdate
+
 class ErrorResponse(BaseModel):
     detail: str
 
@@ -27,6 +98,8 @@ class ErrorResponse(BaseModel):
     response_model=AgentResponse,
     responses={
         200: {"description": "Agent created successfully", "model": AgentResponse},
+        404: {"description": "Branch not found", "model": ErrorResponse},
+        409: {"description": "Request with this Idempotency-Key in progress", "model": ErrorResponse},
         500: {"description": "Server error", "model": ErrorResponse},
     },
     summary="Create a new agent",
@@ -34,7 +107,10 @@ class ErrorResponse(BaseModel):
         the required agent details.",
     tags=["Agent"]
 )
-async def create_agent(agent: Agent):
+async def create_agent(agent: Agent,
+                       idempotency_key: Optional[str] = Header(default=None),
+                       db_repository: SQLRepository = Depends(get_db_repository),
+                       idempotency_store: IdempotencyStore = Depends(get_idempotency_store)):
     """Controller function to create an agent.
     
     Args:
@@ -44,19 +120,28 @@ async def create_agent(agent: Agent):
     Returns:
         JSON response: Success or error message.
     """
+    fingerprint = idempotency_store.fingerprint(agent)
+    replayed = replay_response(idempotency_store, "POST /agent/", idempotency_key, fingerprint)
+    if replayed is not None:
+        return replayed
     try:
         # Call the repository function to save the agent
         success = db_repository.save_agen_info(agent)
         if success:
-            return {
+            return remember_response(idempotency_store, "POST /agent/", idempotency_key, fingerprint, {
                 "message": "Agent created successfully",
                 "agent": agent
-            }
+            })
         else:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Failed to create agent due to an unknown error."
             )
+    except DataNotFoundException as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
     except DatabaseOperationException as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -72,6 +157,8 @@ async def create_agent(agent: Agent):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An unexpected error occurred: {str(e)}"
         )
+    finally:
+        release_key(idempotency_store, "POST /agent/", idempotency_key)
 
 @router.put(
     "/agent/{agent_id}",
@@ -86,7 +173,7 @@ async def create_agent(agent: Agent):
         providing the user ID and updated information.",
         tags=["Agent"]
 )
-async def update_user(agent_id: str, agent: AgentUpdate):
+async def update_user(agent_id: UUID, agent: AgentUpdate, db_repository: SQLRepository = Depends(get_db_repository)):
     """Controller function to update a agent's information.
     
     Args:
@@ -142,7 +229,7 @@ async def update_user(agent_id: str, agent: AgentUpdate):
     description="This endpoint allows you to delete an agent by providing the agent ID.",
     tags=["Agent"]
 )
-async def delete_agent(agent_id: str):
+async def delete_agent(agent_id: UUID, db_repository: SQLRepository = Depends(get_db_repository)):
     """Controller function to delete an agent.
     
     Args:
@@ -186,11 +273,57 @@ async def delete_agent(agent_id: str):
         
         
 
+@router.get(
+    "/agent/{agent_id}/sales",
+    response_model=SalesHistory,
+    responses={
+        200: {"description": "Sales history of the agent", "model": SalesHistory},
+        400: {"description": "Invalid date range", "model": ErrorResponse},
+        404: {"description": "Agent not found", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Get an agent's sales history",
+    description="This endpoint returns an agent's sales totals by day, week or month \
+        over a date range, served from the daily sales rollup.",
+    tags=["Agent"]
+)
+async def get_agent_sales_history(agent_id: UUID, start_date: date, end_date: date,
+                                  granularity: Literal["day", "week", "month"] = "day",
+                                  product_id: Optional[UUID] = None,
+                                  db_repository: SQLRepository = Depends(get_db_repository)):
+    if start_date > end_date:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="start_date must not be after end_date."
+        )
+    try:
+        return db_repository.get_agent_sales_history(
+            agent_id, start_date, end_date, granularity, product_id
+        )
+    except DataNotFoundException as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+        
+        
+
 @router.post(
     "/product/",
     response_model=ProductResponse,
     responses={
         200: {"description": "Product created successfully", "model": ProductResponse},
+        409: {"description": "Request with this Idempotency-Key in progress", "model": ErrorResponse},
         500: {"description": "Server error", "model": ErrorResponse},
     },
     summary="Create a new product",
@@ -198,14 +331,21 @@ async def delete_agent(agent_id: str):
         the required product details.",
     tags=["Product"]
 )
-async def create_product(product: Product):
+async def create_product(product: Product,
+                         idempotency_key: Optional[str] = Header(default=None),
+                         db_repository: SQLRepository = Depends(get_db_repository),
+                         idempotency_store: IdempotencyStore = Depends(get_idempotency_store)):
+    fingerprint = idempotency_store.fingerprint(product)
+    replayed = replay_response(idempotency_store, "POST /product/", idempotency_key, fingerprint)
+    if replayed is not None:
+        return replayed
     try:
         success = db_repository.save_product_info(product)
         if success:
-            return {
+            return remember_response(idempotency_store, "POST /product/", idempotency_key, fingerprint, {
                 "message": "Product created successfully",
                 "product": product
-            }
+            })
         else:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -226,6 +366,8 @@ async def create_product(product: Product):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An unexpected error occurred: {str(e)}"
         )
+    finally:
+        release_key(idempotency_store, "POST /product/", idempotency_key)
 
 @router.put(
     "/product/{product_id}",
@@ -240,7 +382,7 @@ async def create_product(product: Product):
         providing the product ID and updated information.",
     tags=["Product"]
 )
-async def update_product(product_id: str, product: ProductUpdate):
+async def update_product(product_id: UUID, product: ProductUpdate, db_repository: SQLRepository = Depends(get_db_repository)):
     try:
         success = db_repository.update_product_info(product_id, product)
         if success:
@@ -285,7 +427,7 @@ async def update_product(product_id: str, product: ProductUpdate):
     description="This endpoint allows you to delete a product by providing the product ID.",
     tags=["Product"]
 )
-async def delete_product(product_id: str):
+async def delete_product(product_id: UUID, db_repository: SQLRepository = Depends(get_db_repository)):
     try:
         success = db_repository.delete_product(product_id)
         if success:
@@ -316,4 +458,217 @@ async def delete_product(product_id: str):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An unexpected error occurred: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+
+@router.post(
+    "/branch/",
+    response_model=BranchResponse,
+    responses={
+        200: {"description": "Branch created successfully", "model": BranchResponse},
+        409: {"description": "Request with this Idempotency-Key in progress", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Create a new branch",
+    description="This endpoint allows you to create a new branch by providing \
+        the required branch details.",
+    tags=["Branch"]
+)
+async def create_branch(branch: Branch,
+                        idempotency_key: Optional[str] = Header(default=None),
+                        db_repository: SQLRepository = Depends(get_db_repository),
+                        idempotency_store: IdempotencyStore = Depends(get_idempotency_store)):
+    fingerprint = idempotency_store.fingerprint(branch)
+    replayed = replay_response(idempotency_store, "POST /branch/", idempotency_key, fingerprint)
+    if replayed is not None:
+        return replayed
+    try:
+        success = db_repository.save_branch_info(branch)
+        if success:
+            return remember_response(idempotency_store, "POST /branch/", idempotency_key, fingerprint, {
+                "message": "Branch created successfully",
+                "branch": branch
+            })
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to create branch due to an unknown error."
+            )
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Validation error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+    finally:
+        release_key(idempotency_store, "POST /branch/", idempotency_key)
+
+@router.get(
+    "/branch/{branch_id}",
+    response_model=Branch,
+    responses={
+        200: {"description": "Branch found", "model": Branch},
+        404: {"description": "Branch not found", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Get a branch",
+    description="This endpoint returns a branch by its branch ID.",
+    tags=["Branch"]
+)
+async def get_branch(branch_id: UUID, db_repository: SQLRepository = Depends(get_db_repository)):
+    try:
+        return db_repository.get_branch_info(branch_id)
+    except DataNotFoundException as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.get(
+    "/branch/{branch_id}/detail",
+    response_model=BranchDetail,
+    responses={
+        200: {"description": "Branch detail", "model": BranchDetail},
+        404: {"description": "Branch not found", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Get branch detail",
+    description="This endpoint returns the agent count, product coverage and \
+        running sales totals of a branch from a cached rollup.",
+    tags=["Branch"]
+)
+async def get_branch_detail(branch_id: UUID, db_repository: SQLRepository = Depends(get_db_repository)):
+    try:
+        return db_repository.get_branch_detail(branch_id)
+    except DataNotFoundException as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.put(
+    "/branch/{branch_id}",
+    response_model=BranchResponse,
+    responses={
+        200: {"description": "Branch updated successfully", "model": BranchResponse},
+        404: {"description": "Branch not found", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Update an existing branch",
+    description="This endpoint allows you to update an existing branch's details by \
+        providing the branch ID and updated information.",
+    tags=["Branch"]
+)
+async def update_branch(branch_id: UUID, branch: BranchUpdate, db_repository: SQLRepository = Depends(get_db_repository)):
+    try:
+        success = db_repository.update_branch_info(branch_id, branch)
+        if success:
+            return {
+                "message": "Branch updated successfully",
+                "branch": branch
+            }
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Branch with ID {branch_id} not found."
+            )
+    except DataNotFoundException as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Validation error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.delete(
+    "/branch/{branch_id}",
+    responses={
+        200: {"description": "Branch deleted successfully", "model": BranchResponse},
+        404: {"description": "Branch not found", "model": ErrorResponse},
+        409: {"description": "Branch still has agents", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Delete a branch",
+    description="This endpoint allows you to delete a branch that has no agents \
+        by providing the branch ID.",
+    tags=["Branch"]
+)
+async def delete_branch(branch_id: UUID, db_repository: SQLRepository = Depends(get_db_repository)):
+    try:
+        success = db_repository.delete_branch(branch_id)
+        if success:
+            return {
+                "message": "Branch deleted successfully"
+            }
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Branch with ID {branch_id} not found."
+            )
+    except DataNotFoundException as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except DataConflictException as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Validation error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from common.cache import TTLCache
+from agent.app.db_repository.sql_repoitory import DatabaseOperationException
+from agent.app.models.db_models import IdempotencyKey as DBIdempotencyKey
+from agent.configs import IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_CACHE_SIZE, \
+    IDEMPOTENCY_IN_PROGRESS_SECONDS
+
+
+class IdempotencyConflictException(Exception):
+    """Raised when an Idempotency-Key is reused with a different request body."""
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class IdempotencyInProgressException(Exception):
+    """Raised when a request with the same Idempotency-Key is still being processed."""
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class IdempotencyStore:
+    """Stores the first response of a write request under its Idempotency-Key.
+
+    A key is reserved before the write runs, so a retry that arrives while
+    the first request is still in flight is refused instead of repeating the
+    write. Once the write succeeds its response replaces the reservation; if
+    it fails the reservation is released and the key can be used again.
+
+    Responses live in a bounded, TTL-evicted in-process cache. When an engine
+    is given, reservations and responses are also written to the
+    ``idempotency_key`` table, so a retry that lands on another worker or pod
+    is still answered from the stored response. Without an engine a key is
+    only reserved within this process. Replays never go through the
+    SQLRepository.
+    """
+    # status_code of a reserved key whose response is not stored yet
+    IN_PROGRESS_STATUS = 0
+
+    def __init__(self, engine=None, ttl_seconds: int = IDEMPOTENCY_TTL_SECONDS,
+                 max_size: int = IDEMPOTENCY_CACHE_SIZE,
+                 in_progress_seconds: int = IDEMPOTENCY_IN_PROGRESS_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.in_progress_seconds = in_progress_seconds
+        self.cache = TTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.Session = sessionmaker(bind=engine) if engine is not None else None
+        # key hash -> fingerprint of the keys this process has reserved
+        self._in_progress = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(payload) -> str:
+        """Hash of the request payload, used to detect reused keys."""
+        body = payload.model_dump_json() if hasattr(payload, "model_dump_json") \
+            else json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+    def reserve(self, scope: str, key: str, fingerprint: str):
+        """Reserve a key for a new request, or return the stored response of
+        - the request that used it first.
+
+        Returns:
+            tuple: The stored (status_code, body), or None when the key is
+            now reserved by the caller, who must then save or release it.
+
+        Raises:
+            IdempotencyConflictException: If the key was first used with a
+            different payload.
+            IdempotencyInProgressException: If the first request made with the
+            key is still being processed.
+            DatabaseOperationException: If the database lookup fails.
+        """
+        key_hash = self.__key_hash(scope, key)
+        record = self.cache.get(key_hash)
+        if record is not None:
+            return self.__replay(record, fingerprint)
+        with self._lock:
+            reserved_fingerprint = self._in_progress.get(key_hash)
+            if reserved_fingerprint is None:
+                self._in_progress[key_hash] = fingerprint
+        if reserved_fingerprint is not None:
+            return self.__replay((reserved_fingerprint, self.IN_PROGRESS_STATUS, None), fingerprint)
+        if self.Session is None:
+            return None
+        try:
+            record = self.__reserve_row(key_hash, fingerprint)
+        except Exception:
+            self.__forget(key_hash)
+            raise
+        if record is None:
+            return None
+        self.__forget(key_hash)
+        if record[1] != self.IN_PROGRESS_STATUS:
+            self.cache.set(key_hash, record)
+        return self.__replay(record, fingerprint)
+
+    def save(self, scope: str, key: str, fingerprint: str, status_code: int, body):
+        """Store the response of the request that reserved a key.
+
+        Raises:
+            DatabaseOperationException: If the database write fails.
+        """
+        key_hash = self.__key_hash(scope, key)
+        self.cache.set(key_hash, (fingerprint, status_code, body))
+        self.__forget(key_hash)
+        if self.Session is None:
+            return
+        session = self.Session()
+        try:
+            session.query(DBIdempotencyKey) \
+                .filter(DBIdempotencyKey.idempotency_key == key_hash) \
+                .update({
+                    "request_fingerprint": fingerprint,
+                    "status_code": status_code,
+                    "response_body": json.dumps(body, default=str),
+                    "expires_at": datetime.now() + timedelta(seconds=self.ttl_seconds),
+                }, synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while saving idempotency key: {e}")
+        finally:
+            session.close()
+
+    def release(self, scope: str, key: str):
+        """Drop the reservation of a key whose request failed, so the client
+        - can retry it. Keys this process did not reserve are left alone.
+
+        Raises:
+            DatabaseOperationException: If the database delete fails.
+        """
+        key_hash = self.__key_hash(scope, key)
+        if not self.__forget(key_hash) or self.Session is None:
+            return
+        session = self.Session()
+        try:
+            session.query(DBIdempotencyKey) \
+                .filter(DBIdempotencyKey.idempotency_key == key_hash) \
+                .filter(DBIdempotencyKey.status_code == self.IN_PROGRESS_STATUS) \
+                .delete(synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while releasing idempotency key: {e}")
+        finally:
+            session.close()
+
+    def purge_expired(self) -> int:
+        """Delete expired keys from the backing table."""
+        if self.Session is None:
+            return 0
+        session = self.Session()
+        try:
+            deleted = session.query(DBIdempotencyKey) \
+                .filter(DBIdempotencyKey.expires_at < datetime.now()) \
+                .delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while purging idempotency keys: {e}")
+        finally:
+            session.close()
+
+    def __reserve_row(self, key_hash: str, fingerprint: str):
+        """Insert the reservation row of a key.
+
+        Returns:
+            tuple: None when the key is reserved, else the (fingerprint,
+            status_code, body) of the row that holds it.
+        """
+        session = self.Session()
+        try:
+            now = datetime.now()
+            reservation = {
+                "request_fingerprint": fingerprint,
+                "status_code": self.IN_PROGRESS_STATUS,
+                "response_body": "null",
+                "expires_at": now + timedelta(seconds=self.in_progress_seconds),
+            }
+            try:
+                session.add(DBIdempotencyKey(idempotency_key=key_hash, **reservation))
+                session.commit()
+                return None
+            except IntegrityError:
+                session.rollback()
+            # the key exists; an expired row, e.g. the reservation of a worker
+            # that died mid-request, is taken over, anything else is returned
+            taken_over = session.query(DBIdempotencyKey) \
+                .filter(DBIdempotencyKey.idempotency_key == key_hash) \
+                .filter(DBIdempotencyKey.expires_at < now) \
+                .update(reservation, synchronize_session=False)
+            session.commit()
+            if taken_over:
+                return None
+            row = session.query(DBIdempotencyKey) \
+                .filter(DBIdempotencyKey.idempotency_key == key_hash) \
+                .first()
+            if row is None:
+                # purged in between, report it as in progress and let the client retry
+                return fingerprint, self.IN_PROGRESS_STATUS, None
+            return row.request_fingerprint, row.status_code, json.loads(row.response_body)
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while reserving idempotency key: {e}")
+        finally:
+            session.close()
+
+    def __replay(self, record, fingerprint: str):
+        stored_fingerprint, status_code, body = record
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyConflictException(
+                "Idempotency-Key has already been used with a different request payload."
+            )
+        if status_code == self.IN_PROGRESS_STATUS:
+            raise IdempotencyInProgressException(
+                "A request with this Idempotency-Key is still being processed, retry later."
+            )
+        return status_code, body
+
+    def __forget(self, key_hash: str) -> bool:
+        with self._lock:
+            return self._in_progress.pop(key_hash, None) is not None
+
+    def __key_hash(self, scope: str, key: str) -> str:
+        return hashlib.sha256(f"{scope}\n{key}".encode("utf-8")).hexdigest()
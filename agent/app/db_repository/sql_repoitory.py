@@ -1,8 +1,17 @@
-from sqlalchemy import create_engine
+from collections import OrderedDict
+from datetime import date, timedelta
+from uuid import UUID
+from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker, declarative_base
-from agent.app.models.dtos import Agent, AgentUpdate, Product, ProductUpdate
+from agent.app.models.dtos import Agent, AgentUpdate, Product, ProductUpdate, \
+    Branch, BranchUpdate, BranchDetail, SalesHistory, SalesHistoryPoint
 from agent.app.models.db_models import Agent as DBAgent
 from agent.app.models.db_models import Product as DBProduct
+from agent.app.models.db_models import Branch as DBBranch, \
+    ProductPermission as DBProductPermission, SalesDailyRollup as DBSalesDailyRollup
+from common.cache import TTLCache
+from agent.configs import BRANCH_ROLLUP_TTL_SECONDS, BRANCH_ROLLUP_CACHE_SIZE, \
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_ECHO
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 
@@ -18,14 +27,27 @@ class DataNotFoundException(Exception):
     def __init__(self, message):
         super().__init__(message)
 
+class DataConflictException(Exception):
+    """Custom exception for writes that conflict with existing data."""
+    def __init__(self, message):
+        super().__init__(message)
+
 class SQLRepository:
     def __init__(self, database_url):
         """
         Initialize the SQLRepository with a database URL.
         This will create the database engine and session factory.
         """
-        self.engine = create_engine(database_url, echo=True)
+        self.engine = create_engine(
+            database_url, echo=DB_ECHO,
+            pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True
+        )
         self.Session = sessionmaker(bind=self.engine)
+        # branch detail rollups keyed by branch id, invalidated on agent moves
+        self.branch_rollups = TTLCache(
+            max_size=BRANCH_ROLLUP_CACHE_SIZE,
+            ttl_seconds=BRANCH_ROLLUP_TTL_SECONDS
+        )
 
     def create_tables(self):
         Base.metadata.create_all(self.engine)
@@ -35,6 +57,10 @@ class SQLRepository:
 
     def get_session(self):
         return self.Session()
+
+    def dispose(self):
+        """Close every pooled connection, used when a worker shuts down."""
+        self.engine.dispose()
     
     def save_agen_info(self, agent_info: Agent):
         """Save agent info to the database when agent 
@@ -51,6 +77,7 @@ class SQLRepository:
         output = False
         session = self.get_session()
         try:
+            self.__check_branch_exists(session, agent_info.branch_id)
             db_agent_instance = DBAgent(
                 agent_id=agent_info.agent_id,
                 agent_code=agent_info.agent_code,
@@ -58,11 +85,15 @@ class SQLRepository:
                 last_name=agent_info.last_name,
                 email=agent_info.email,
                 phone=agent_info.phone,
-                branch_id=agent_info.branch_id
+                branch_id=str(agent_info.branch_id)
             )
             session.add(db_agent_instance)
             session.commit()
+            self.branch_rollups.invalidate(str(agent_info.branch_id))
             output = True
+        except DataNotFoundException as e:
+            session.rollback()
+            raise e
         except IntegrityError as e:
             session.rollback()
             raise DatabaseOperationException(f"Integrity error while saving agent info: {e}")
@@ -93,13 +124,17 @@ class SQLRepository:
         try:
             db_agent_instance = session.query(DBAgent).filter(DBAgent.agent_id == agent_id).first()
             if db_agent_instance:
+                self.__check_branch_exists(session, agent.branch_id)
+                previous_branch_id = db_agent_instance.branch_id
                 db_agent_instance.agent_code = agent.agent_code
                 db_agent_instance.first_name = agent.first_name
                 db_agent_instance.last_name = agent.last_name
                 db_agent_instance.email = agent.email
                 db_agent_instance.phone = agent.phone
-                db_agent_instance.branch_id = agent.branch_id
+                db_agent_instance.branch_id = str(agent.branch_id)
                 session.commit()
+                # the agent may have moved, both rollups are stale now
+                self.branch_rollups.invalidate(previous_branch_id, str(agent.branch_id))
                 output = True
             else:
                 raise DataNotFoundException("Agent not found")
@@ -136,8 +171,10 @@ class SQLRepository:
         try:
             db_agent_instance = session.query(DBAgent).filter(DBAgent.agent_id == agent_id).first()
             if db_agent_instance:
+                branch_id = db_agent_instance.branch_id
                 session.delete(db_agent_instance)
                 session.commit()
+                self.branch_rollups.invalidate(branch_id)
                 output = True
             else:
                 raise DataNotFoundException("Agent not found")
@@ -268,7 +305,322 @@ class SQLRepository:
         finally:
             session.close()
         return output
+
+    def save_branch_info(self, branch_info: Branch):
+        """Save branch info to the database when branch 
+        - data is passed as Branch DTO.
+        
+        Args:
+            branch_info (Branch): Branch information provided 
+            from the service layer (business logic).
+        
+        Raises:
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        output = False
+        session = self.get_session()
+        try:
+            db_branch_instance = DBBranch(
+                branch_id=str(branch_info.branch_id),
+                branch_name=branch_info.branch_name,
+                location=branch_info.location
+            )
+            session.add(db_branch_instance)
+            session.commit()
+            output = True
+        except IntegrityError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Integrity error while saving branch info: {e}")
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while saving branch info: {e}")
+        except Exception as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Unexpected error while saving branch info: {e}")
+        finally:
+            session.close()
+        return output
+
+    def get_branch_info(self, branch_id: str):
+        """Get branch info from the database.
+        
+        Args:
+            branch_id (str): Branch ID to look up.
+        
+        Returns:
+            Branch: The branch as a Branch DTO.
+        
+        Raises:
+            DataNotFoundException: If the branch does not exist.
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        session = self.get_session()
+        try:
+            db_branch_instance = session.query(DBBranch).filter(DBBranch.branch_id == branch_id).first()
+            if not db_branch_instance:
+                raise DataNotFoundException("Branch not found")
+            return Branch(
+                branch_id=db_branch_instance.branch_id,
+                branch_name=db_branch_instance.branch_name,
+                location=db_branch_instance.location
+            )
+        except DataNotFoundException as e:
+            raise e
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while fetching branch info: {e}")
+        finally:
+            session.close()
+
+    def update_branch_info(self, branch_id: str, branch: BranchUpdate):
+        """Update branch info in the database when branch 
+        - data is passed as BranchUpdate DTO.
+        
+        Args:
+            branch_id (str): Branch ID to update.
+            branch (BranchUpdate): Branch information provided 
+            from the service layer (business logic).
+        
+        Raises:
+            DataNotFoundException: If the branch does not exist.
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        output = False
+        session = self.get_session()
+        try:
+            db_branch_instance = session.query(DBBranch).filter(DBBranch.branch_id == branch_id).first()
+            if db_branch_instance:
+                db_branch_instance.branch_name = branch.branch_name
+                db_branch_instance.location = branch.location
+                session.commit()
+                self.branch_rollups.invalidate(self.__branch_key(branch_id))
+                output = True
+            else:
+                raise DataNotFoundException("Branch not found")
+        except DataNotFoundException as e:
+            session.rollback()
+            raise e
+        except IntegrityError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Integrity error while updating branch info: {e}")
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while updating branch info: {e}")
+        except Exception as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Unexpected error while updating branch info: {e}")
+        finally:
+            session.close()
+        return output
+
+    def delete_branch(self, branch_id: str):
+        """Delete branch info from the database. Branches that still 
+        - have agents assigned cannot be deleted.
+        
+        Args:
+            branch_id (str): Branch ID to delete.
+        
+        Raises:
+            DataNotFoundException: If the branch does not exist.
+            DataConflictException: If agents are still assigned to the branch.
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        output = False
+        session = self.get_session()
+        try:
+            db_branch_instance = session.query(DBBranch).filter(DBBranch.branch_id == branch_id) \
+                .with_for_update().first()
+            if db_branch_instance:
+                # deleting through the ORM would set branch_id of every agent
+                # to NULL instead of refusing, so check for agents first
+                agent_count = session.query(func.count(DBAgent.agent_id)) \
+                    .filter(DBAgent.branch_id == branch_id).scalar()
+                if agent_count:
+                    raise DataConflictException(
+                        f"Branch still has {agent_count} agent(s) assigned"
+                    )
+                session.delete(db_branch_instance)
+                session.commit()
+                self.branch_rollups.invalidate(self.__branch_key(branch_id))
+                output = True
+            else:
+                raise DataNotFoundException("Branch not found")
+        except (DataNotFoundException, DataConflictException) as e:
+            session.rollback()
+            raise e
+        except IntegrityError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Integrity error while deleting branch info: {e}")
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while deleting branch info: {e}")
+        except Exception as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Unexpected error while deleting branch info: {e}")
+        finally:
+            session.close()
+        return output
+
+    def get_branch_detail(self, branch_id: str):
+        """Get the branch detail rollup (agent count, product coverage 
+        - and running sales totals). Sales totals are summed from the daily 
+        - rollup table instead of the raw sales, so the last sale is known 
+        - to the day. The rollup is served from the in-process cache and only 
+        - recomputed when it is missing, expired or invalidated by an agent 
+        - joining, leaving or moving between branches. The cache is per 
+        - worker process: other workers keep serving their copy until it 
+        - expires (BRANCH_ROLLUP_TTL_SECONDS).
+        
+        Args:
+            branch_id (str): Branch ID to summarise.
+        
+        Returns:
+            BranchDetail: The branch rollup.
+        
+        Raises:
+            DataNotFoundException: If the branch does not exist.
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        cache_key = self.__branch_key(branch_id)
+        detail = self.branch_rollups.get(cache_key)
+        if detail is not None:
+            return detail
+
+        session = self.get_session()
+        try:
+            db_branch_instance = session.query(DBBranch).filter(DBBranch.branch_id == branch_id).first()
+            if not db_branch_instance:
+                raise DataNotFoundException("Branch not found")
+
+            agent_count = session.query(func.count(DBAgent.agent_id)) \
+                .filter(DBAgent.branch_id == branch_id).scalar()
+            product_count = session.query(func.count(func.distinct(DBProductPermission.product_id))) \
+                .join(DBAgent, DBProductPermission.agent_id == DBAgent.agent_id) \
+                .filter(DBAgent.branch_id == branch_id).scalar()
+            transaction_count, total_sales, last_sale_date = session.query(
+                    func.coalesce(func.sum(DBSalesDailyRollup.transaction_count), 0),
+                    func.coalesce(func.sum(DBSalesDailyRollup.total_sales), 0),
+                    func.max(DBSalesDailyRollup.sale_day)
+                ) \
+                .join(DBAgent, DBSalesDailyRollup.agent_id == DBAgent.agent_id) \
+                .filter(DBAgent.branch_id == branch_id).one()
+
+            detail = BranchDetail(
+                branch_id=db_branch_instance.branch_id,
+                branch_name=db_branch_instance.branch_name,
+                location=db_branch_instance.location,
+                agent_count=agent_count,
+                product_count=product_count,
+                transaction_count=transaction_count,
+                total_sales=total_sales,
+                last_sale_date=last_sale_date
+            )
+        except DataNotFoundException as e:
+            raise e
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while building branch detail: {e}")
+        finally:
+            session.close()
+
+        self.branch_rollups.set(cache_key, detail)
+        return detail
+
+    def get_agent_sales_history(self, agent_id: str, start_date: date, end_date: date,
+                                granularity: str = "day", product_id: str = None):
+        """Get an agent's sales per day, week or month over a date range. 
+        - The totals come from the daily rollup table, so a year of history 
+        - reads at most a few hundred rollup rows instead of the raw sales.
         
+        Args:
+            agent_id (str): Agent ID.
+            start_date (date): First day of the range (inclusive).
+            end_date (date): Last day of the range (inclusive).
+            granularity (str): day, week (starting Monday) or month.
+            product_id (str): Only count sales of this product when given.
         
+        Returns:
+            SalesHistory: One point per period that has sales.
         
+        Raises:
+            DataNotFoundException: If the agent does not exist.
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        session = self.get_session()
+        try:
+            agent_exists = session.query(DBAgent.agent_id).filter(DBAgent.agent_id == agent_id).first()
+            if not agent_exists:
+                raise DataNotFoundException("Agent not found")
+
+            query = session.query(
+                DBSalesDailyRollup.sale_day,
+                func.sum(DBSalesDailyRollup.total_sales),
+                func.sum(DBSalesDailyRollup.transaction_count)
+            ) \
+                .filter(DBSalesDailyRollup.agent_id == agent_id) \
+                .filter(DBSalesDailyRollup.sale_day.between(start_date, end_date))
+            if product_id is not None:
+                query = query.filter(DBSalesDailyRollup.product_id == product_id)
+            daily_rows = query.group_by(DBSalesDailyRollup.sale_day) \
+                .order_by(DBSalesDailyRollup.sale_day).all()
+        except DataNotFoundException as e:
+            raise e
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while fetching sales history: {e}")
+        finally:
+            session.close()
+
+        periods = OrderedDict()
+        for sale_day, total_sales, transaction_count in daily_rows:
+            period_start = self.__period_start(sale_day, granularity)
+            totals = periods.setdefault(period_start, [0, 0])
+            totals[0] += total_sales
+            totals[1] += int(transaction_count)
+
+        return SalesHistory(
+            agent_id=agent_id,
+            granularity=granularity,
+            start_date=start_date,
+            end_date=end_date,
+            product_id=product_id,
+            points=[
+                SalesHistoryPoint(
+                    period_start=period_start,
+                    total_sales=total_sales,
+                    transaction_count=transaction_count
+                )
+                for period_start, (total_sales, transaction_count) in periods.items()
+            ]
+        )
+
+    def __branch_key(self, branch_id):
+        """Canonical form of a branch id, the key of its cached rollup.
+
+        Raises:
+            DataNotFoundException: If the id is not a UUID.
+        """
+        try:
+            return str(UUID(str(branch_id)))
+        except ValueError:
+            raise DataNotFoundException("Branch not found")
+
+    def __period_start(self, sale_day: date, granularity: str):
+        if granularity == "week":
+            return sale_day - timedelta(days=sale_day.weekday())
+        if granularity == "month":
+            return sale_day.replace(day=1)
+        return sale_day
 
+    def __check_branch_exists(self, session, branch_id):
+        """Raise DataNotFoundException when an agent refers to a missing branch, 
+        - instead of letting the insert fail on the foreign key."""
+        if branch_id is None:
+            return
+        exists = session.query(DBBranch.branch_id) \
+            .filter(DBBranch.branch_id == str(branch_id)).first()
+        if not exists:
+            raise DataNotFoundException(f"Branch {branch_id} not found")
@@ -1,7 +1,53 @@
 import sys
 sys.path.append("/home/kosala/git-repos/moon_agent_tracker_test/")
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from intergration.app.controllers.controller import router
+from agent.app.controllers.controller import router
+from agent.app.db_repository.sql_repoitory import SQLRepository, DatabaseOperationException
+from agent.app.db_repository.idempotency_store import IdempotencyStore
+from common.timing import RequestTimingMiddleware, install_sql_timing
+from agent.configs import DB_STRING, IDEMPOTENCY_DB_BACKED, IDEMPOTENCY_PURGE_INTERVAL_SECONDS, \
+    SLOW_QUERY_THRESHOLD_MS
 
-app = FastAPI()
-app.include_router(router)
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+
+async def purge_idempotency_keys(idempotency_store: IdempotencyStore,
+                                 interval_seconds: float = IDEMPOTENCY_PURGE_INTERVAL_SECONDS):
+    """Delete expired idempotency keys every interval while the app serves."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            deleted = await asyncio.to_thread(idempotency_store.purge_expired)
+            if deleted:
+                logger.info(f"Purged {deleted} expired idempotency keys")
+        except DatabaseOperationException as e:
+            logger.warning(e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the database resources when the app starts serving, not at
+    import time, so workers never inherit an engine across fork."""
+    app.state.db_repository = SQLRepository(database_url=DB_STRING)
+    install_sql_timing(app.state.db_repository.engine, SLOW_QUERY_THRESHOLD_MS)
+    app.state.idempotency_store = IdempotencyStore(
+        engine=app.state.db_repository.engine if IDEMPOTENCY_DB_BACKED else None
+    )
+    purge_task = asyncio.create_task(purge_idempotency_keys(app.state.idempotency_store)) \
+        if IDEMPOTENCY_DB_BACKED else None
+    yield
+    # uvicorn has already drained in-flight requests at this point
+    if purge_task is not None:
+        purge_task.cancel()
+    app.state.db_repository.dispose()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestTimingMiddleware)
+app.include_router(router)
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"status": "ok"}
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Text, DECIMAL, Enum, TIMESTAMP, func, CHAR
+from sqlalchemy import Column, String, Integer, ForeignKey, Text, DECIMAL, Enum, TIMESTAMP, func, CHAR, Index, Date, UniqueConstraint
 from sqlalchemy.orm import relationship, declarative_base
+from agent.app.models.types import BinaryUUID
 import uuid
 import logging
 
@@ -9,7 +10,7 @@ Base = declarative_base()
 class Branch(Base):
     __tablename__ = "branch"
 
-    branch_id = Column(CHAR(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    branch_id = Column(BinaryUUID, primary_key=True, default=lambda: str(uuid.uuid4()))
     branch_name = Column(String(255), nullable=False, unique=True)
     location = Column(String(255), nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
@@ -20,13 +21,13 @@ class Branch(Base):
 class Agent(Base):
     __tablename__ = "agent"
 
-    agent_id = Column(CHAR(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    agent_id = Column(BinaryUUID, primary_key=True, default=lambda: str(uuid.uuid4()))
     agent_code = Column(String(50), unique=True, nullable=False)
     first_name = Column(String(100), nullable=False)
     last_name = Column(String(100), nullable=False)
     email = Column(String(255), unique=True, nullable=False)
     phone = Column(String(20), nullable=False)
-    branch_id = Column(CHAR(36), ForeignKey("branch.branch_id"), nullable=True)
+    branch_id = Column(BinaryUUID, ForeignKey("branch.branch_id"), nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
     updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
 
@@ -37,7 +38,7 @@ class Agent(Base):
 class Product(Base):
     __tablename__ = "product"
 
-    product_id = Column(CHAR(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    product_id = Column(BinaryUUID, primary_key=True, default=lambda: str(uuid.uuid4()))
     name = Column(String(255), nullable=False)
     description = Column(Text, nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
@@ -47,9 +48,9 @@ class Product(Base):
 class ProductPermission(Base):
     __tablename__ = "product_permission"
 
-    id = Column(CHAR(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    agent_id = Column(CHAR(36), ForeignKey("agent.agent_id"), nullable=False)
-    product_id = Column(CHAR(36), ForeignKey("product.product_id"), nullable=False)
+    id = Column(BinaryUUID, primary_key=True, default=lambda: str(uuid.uuid4()))
+    agent_id = Column(BinaryUUID, ForeignKey("agent.agent_id"), nullable=False)
+    product_id = Column(BinaryUUID, ForeignKey("product.product_id"), nullable=False)
     created_at = Column(TIMESTAMP, server_default=func.now())
 
     agent = relationship("Agent", back_populates="products")
@@ -59,29 +60,74 @@ class ProductPermission(Base):
 class SalesTransaction(Base):
     __tablename__ = "sales_transaction"
 
+    # the schema of the partitioned table (agent/app/models/partition_sales.py):
+    # MySQL needs sale_date in every unique key and allows no foreign keys on
+    # partitioned tables, so agent_id and product_id are not declared as such
     transaction_id = Column(Integer, primary_key=True, autoincrement=True)
-    agent_id = Column(CHAR(36), ForeignKey("agent.agent_id"), nullable=False)
-    product_id = Column(CHAR(36), ForeignKey("product.product_id"), nullable=False)
+    agent_id = Column(BinaryUUID, nullable=False)
+    product_id = Column(BinaryUUID, nullable=False)
     sale_amount = Column(DECIMAL(10, 2), nullable=False)
-    sale_date = Column(TIMESTAMP, server_default=func.now())
-    core_reference_id = Column(String(100), unique=True, nullable=False)
+    sale_date = Column(TIMESTAMP, primary_key=True, nullable=False, server_default=func.now())
+    core_reference_id = Column(String(100), nullable=False)
 
-    agent = relationship("Agent")
-    product = relationship("Product")
+    agent = relationship("Agent", primaryjoin="foreign(SalesTransaction.agent_id) == Agent.agent_id")
+    product = relationship("Product", primaryjoin="foreign(SalesTransaction.product_id) == Product.product_id")
+
+    # covering indexes for the aggregation and lookup queries; create_all
+    # builds the table unpartitioned, partition_sales.py migrate partitions it
+    __table_args__ = (
+        UniqueConstraint("core_reference_id", "sale_date", name="uq_sales_transaction_core_reference"),
+        Index("ix_sales_transaction_agent_date", "agent_id", "sale_date", "sale_amount"),
+        Index("ix_sales_transaction_product", "product_id", "sale_amount"),
+        Index("ix_sales_transaction_sale_date", "sale_date"),
+    )
 
 
 class Notification(Base):
     __tablename__ = "notification"
 
-    notification_id = Column(CHAR(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    agent_id = Column(CHAR(36), ForeignKey("agent.agent_id"), nullable=True)
+    notification_id = Column(BinaryUUID, primary_key=True, default=lambda: str(uuid.uuid4()))
+    agent_id = Column(BinaryUUID, ForeignKey("agent.agent_id"), nullable=True)
     recipient_email = Column(String(255), nullable=False)
     message = Column(Text, nullable=False)
     status = Column(Enum("PENDING", "SENT", "FAILED", name="notification_status"), default="PENDING")
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    next_attempt_at = Column(TIMESTAMP, nullable=True)
+    last_error = Column(Text, nullable=True)
+    sent_at = Column(TIMESTAMP, nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
 
     agent = relationship("Agent", foreign_keys=[agent_id])
+
+    # the dispatcher claims PENDING rows that are due, oldest first; existing
+    # tables get the retry columns from agent/app/models/migrate_notification_outbox.py
+    __table_args__ = (
+        Index("ix_notification_status_next_attempt", "status", "next_attempt_at", "created_at"),
+    )
     
+## daily per-agent/per-product sales totals, kept current by the ingestion
+class SalesDailyRollup(Base):
+    __tablename__ = "sales_daily_rollup"
+
+    agent_id = Column(BinaryUUID, ForeignKey("agent.agent_id"), primary_key=True)
+    sale_day = Column(Date, primary_key=True)
+    product_id = Column(BinaryUUID, ForeignKey("product.product_id"), primary_key=True)
+    total_sales = Column(DECIMAL(14, 2), nullable=False, default=0)
+    transaction_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+## all-time per-agent/per-product totals of the sales moved to the archive
+## (intergration/app/services/archive_service.py), so all-time aggregates
+## keep counting them
+class SalesArchivedTotal(Base):
+    __tablename__ = "sales_archived_total"
+
+    agent_id = Column(BinaryUUID, primary_key=True)
+    product_id = Column(BinaryUUID, primary_key=True)
+    total_sales = Column(DECIMAL(16, 2), nullable=False, default=0)
+    transaction_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
 ## table to maintain the hash of the files
 class FileHash(Base):
     __tablename__ = "file_hash"
@@ -92,6 +138,43 @@ class FileHash(Base):
     updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
 
 
+## claims of files by ingestion workers; a worker owns a file until its lease
+## expires, renews it while processing and marks it DONE together with the rows
+class FileLease(Base):
+    __tablename__ = "file_lease"
+
+    file_hash = Column(String(255), primary_key=True)
+    file_key = Column(String(1024), nullable=False)
+    owner = Column(String(255), nullable=False)
+    status = Column(Enum("PROCESSING", "DONE", "FAILED", name="file_lease_status"),
+                    nullable=False, default="PROCESSING")
+    attempts = Column(Integer, nullable=False, default=1, server_default="1")
+    # modification time and size, or ETag, of the attempted file; a replaced
+    # file starts over with fresh attempts. Existing tables get the column
+    # from agent/app/models/migrate_file_lease.py
+    file_version = Column(String(64), nullable=True)
+    lease_expires_at = Column(TIMESTAMP, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_file_lease_status_expires", "status", "lease_expires_at"),
+    )
+
+
+## responses of write requests keyed by their Idempotency-Key header
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_key"
+
+    idempotency_key = Column(CHAR(64), primary_key=True)  # sha256 of endpoint + key
+    request_fingerprint = Column(CHAR(64), nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(Text, nullable=False)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    expires_at = Column(TIMESTAMP, nullable=False, index=True)
+
+
 def init_db(engine):
     try:
         Base.metadata.create_all(engine)
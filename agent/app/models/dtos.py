@@ -1,9 +1,11 @@
 from pydantic import BaseModel, EmailStr
-from datetime import datetime
+from typing import Optional, List, Literal
+from datetime import date
+from decimal import Decimal
 from uuid import UUID
 
 class Agent(BaseModel):
-    agent_id: str
+    agent_id: UUID
     agent_code: str
     first_name: str
     last_name: str
@@ -22,7 +24,7 @@ class AgentUpdate(BaseModel):
 
     
 class Product(BaseModel):
-    product_id: str
+    product_id: UUID
     name: str
     description: str
     
@@ -30,3 +32,38 @@ class ProductUpdate(BaseModel):
     name: str
     description: str
 
+
+
+class Branch(BaseModel):
+    branch_id: UUID
+    branch_name: str
+    location: Optional[str] = None
+
+class BranchUpdate(BaseModel):
+    branch_name: str
+    location: Optional[str] = None
+
+class BranchDetail(BaseModel):
+    branch_id: UUID
+    branch_name: str
+    location: Optional[str] = None
+    agent_count: int
+    product_count: int
+    transaction_count: int
+    total_sales: Decimal
+    # day of the last sale, from the daily rollup
+    last_sale_date: Optional[date] = None
+
+
+class SalesHistoryPoint(BaseModel):
+    period_start: date
+    total_sales: Decimal
+    transaction_count: int
+
+class SalesHistory(BaseModel):
+    agent_id: UUID
+    granularity: Literal["day", "week", "month"]
+    start_date: date
+    end_date: date
+    product_id: Optional[UUID] = None
+    points: List[SalesHistoryPoint]
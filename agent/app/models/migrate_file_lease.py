@@ -0,0 +1,54 @@
+## set the BASE DIRECTORY path of the installation directory
+import sys
+
+sys.path.append("/home/kosala/git-repos/moon_agent_tracker_test/")
+
+import logging
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from agent.configs import DB_STRING
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "file_lease"
+
+# columns the ingestion workers need, see FileLease
+FILE_LEASE_COLUMNS = {
+    "file_version": "VARCHAR(64) NULL AFTER attempts",
+}
+
+
+def migrate_file_lease(engine):
+    """Add the file version column, which lets a replaced file that failed
+    - too often be retried, to an existing file_lease table.
+
+    create_all only creates missing tables, it never alters one that already
+    exists. The migration only adds what is missing, so it can be run again
+    safely. A nullable column is an instant change in MySQL 8, so the table
+    stays writable while it runs.
+    """
+    try:
+        with engine.begin() as connection:
+            existing_columns = {row[0] for row in connection.execute(text("""
+                SELECT COLUMN_NAME FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+            """), {"table": TABLE_NAME}).fetchall()}
+            if not existing_columns:
+                raise ValueError(f"{TABLE_NAME} does not exist, create the tables first")
+            additions = [
+                f"ADD COLUMN {column} {definition}"
+                for column, definition in FILE_LEASE_COLUMNS.items() if column not in existing_columns
+            ]
+            if additions:
+                connection.execute(text(f"ALTER TABLE {TABLE_NAME} {', '.join(additions)}"))
+                logger.info(f"Added {len(additions)} column(s) to {TABLE_NAME}")
+    except SQLAlchemyError as e:
+        logger.error("Error while migrating the file_lease table")
+        logger.error(e)
+        raise e
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(DB_STRING)
+    migrate_file_lease(engine)
@@ -0,0 +1,69 @@
+## set the BASE DIRECTORY path of the installation directory
+import sys
+
+sys.path.append("/home/kosala/git-repos/moon_agent_tracker_test/")
+
+import logging
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from agent.configs import DB_STRING
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "notification"
+
+# columns the notification dispatcher needs, see Notification
+OUTBOX_COLUMNS = {
+    "attempts": "INT NOT NULL DEFAULT 0",
+    "next_attempt_at": "TIMESTAMP NULL",
+    "last_error": "TEXT NULL",
+    "sent_at": "TIMESTAMP NULL",
+}
+OUTBOX_INDEXES = {
+    "ix_notification_status_next_attempt": "status, next_attempt_at, created_at",
+}
+
+
+def migrate_notification_outbox(engine):
+    """Add the retry bookkeeping columns and the claim index of the
+    - notification dispatcher to an existing notification table.
+
+    create_all only creates missing tables, it never alters one that already
+    exists. The migration only adds what is missing, so it can be run again
+    safely. Trailing nullable or defaulted columns are an instant change in
+    MySQL 8, so the table stays writable while it runs.
+    """
+    try:
+        with engine.begin() as connection:
+            existing_columns = {row[0] for row in connection.execute(text("""
+                SELECT COLUMN_NAME FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+            """), {"table": TABLE_NAME}).fetchall()}
+            if not existing_columns:
+                raise ValueError(f"{TABLE_NAME} does not exist, create the tables first")
+            additions = [
+                f"ADD COLUMN {column} {definition}"
+                for column, definition in OUTBOX_COLUMNS.items() if column not in existing_columns
+            ]
+            if additions:
+                connection.execute(text(f"ALTER TABLE {TABLE_NAME} {', '.join(additions)}"))
+                logger.info(f"Added {len(additions)} column(s) to {TABLE_NAME}")
+
+            existing_indexes = {row[0] for row in connection.execute(text("""
+                SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+            """), {"table": TABLE_NAME}).fetchall()}
+            for index_name, columns in OUTBOX_INDEXES.items():
+                if index_name not in existing_indexes:
+                    connection.execute(text(f"ALTER TABLE {TABLE_NAME} ADD INDEX {index_name} ({columns})"))
+                    logger.info(f"Added index {index_name} to {TABLE_NAME}")
+    except SQLAlchemyError as e:
+        logger.error("Error while migrating the notification table")
+        logger.error(e)
+        raise e
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(DB_STRING)
+    migrate_notification_outbox(engine)
@@ -0,0 +1,187 @@
+## set the BASE DIRECTORY path of the installation directory
+import sys
+
+sys.path.append("/home/kosala/git-repos/moon_agent_tracker_test/")
+
+import argparse
+import logging
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from agent.configs import DB_STRING
+
+logger = logging.getLogger(__name__)
+
+# CHAR(36) uuid columns converted to BINARY(16), see BinaryUUID
+UUID_COLUMNS = {
+    "branch": ["branch_id"],
+    "agent": ["agent_id", "branch_id"],
+    "product": ["product_id"],
+    "product_permission": ["id", "agent_id", "product_id"],
+    "sales_transaction": ["agent_id", "product_id"],
+    "notification": ["notification_id", "agent_id"],
+    "sales_daily_rollup": ["agent_id", "product_id"],
+}
+
+
+def shadow_column(column: str) -> str:
+    return f"{column}_bin"
+
+
+def trigger_name(table: str, event: str) -> str:
+    return f"{table}_uuid_bin_{event}"
+
+
+def prepare(engine):
+    """Phase 1, online: add a nullable BINARY(16) shadow column next to every
+    uuid column and install triggers that keep it in sync with new writes.
+
+    Adding a trailing nullable column is an instant change in MySQL 8, so the
+    tables stay readable and writable throughout.
+    """
+    try:
+        with engine.begin() as connection:
+            for table, columns in UUID_COLUMNS.items():
+                existing = {row[0] for row in connection.execute(text("""
+                    SELECT COLUMN_NAME FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+                """), {"table": table}).fetchall()}
+                additions = [
+                    f"ADD COLUMN {shadow_column(column)} BINARY(16) NULL"
+                    for column in columns if shadow_column(column) not in existing
+                ]
+                if additions:
+                    connection.execute(text(f"ALTER TABLE {table} {', '.join(additions)}, ALGORITHM=INSTANT"))
+
+                assignments = "; ".join(
+                    f"SET NEW.{shadow_column(column)} = UUID_TO_BIN(NEW.{column})" for column in columns
+                )
+                for event in ("INSERT", "UPDATE"):
+                    name = trigger_name(table, event.lower())
+                    connection.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+                    connection.execute(text(
+                        f"CREATE TRIGGER {name} BEFORE {event} ON {table} "
+                        f"FOR EACH ROW BEGIN {assignments}; END"
+                    ))
+                logger.info(f"Prepared shadow uuid columns on {table}")
+    except SQLAlchemyError as e:
+        logger.error("Error while preparing the uuid migration")
+        logger.error(e)
+        raise e
+
+
+def backfill(engine, batch_size: int = 5000):
+    """Phase 2, online: fill the shadow columns of existing rows in small
+    batches, each in its own short transaction, so row locks are held briefly.
+    """
+    try:
+        for table, columns in UUID_COLUMNS.items():
+            pending = " OR ".join(
+                f"({shadow_column(column)} IS NULL AND {column} IS NOT NULL)" for column in columns
+            )
+            assignments = ", ".join(
+                f"{shadow_column(column)} = UUID_TO_BIN({column})" for column in columns
+            )
+            total = 0
+            while True:
+                with engine.begin() as connection:
+                    updated = connection.execute(text(
+                        f"UPDATE {table} SET {assignments} WHERE {pending} LIMIT {int(batch_size)}"
+                    )).rowcount
+                total += updated
+                if updated < batch_size:
+                    break
+            logger.info(f"Backfilled {total} rows of {table}")
+    except SQLAlchemyError as e:
+        logger.error("Error while backfilling uuid shadow columns")
+        logger.error(e)
+        raise e
+
+
+def cutover(engine):
+    """Phase 3: swap the shadow columns in for the CHAR(36) ones.
+
+    Foreign keys and the indexes that cover a uuid column are dropped, the
+    columns are swapped and everything is recreated under the same names.
+    The index and primary key rebuilds run as in-place table rebuilds. Deploy
+    the BinaryUUID models right after this step, since the old code writes
+    text ids.
+    """
+    try:
+        with engine.connect() as connection:
+            foreign_keys = connection.execute(text("""
+                SELECT k.TABLE_NAME, k.CONSTRAINT_NAME, k.COLUMN_NAME,
+                    k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME
+                FROM information_schema.KEY_COLUMN_USAGE k
+                WHERE k.TABLE_SCHEMA = DATABASE() AND k.REFERENCED_TABLE_NAME IS NOT NULL
+            """)).fetchall()
+            foreign_keys = [fk for fk in foreign_keys if fk[0] in UUID_COLUMNS]
+            for table, constraint, _, _, _ in foreign_keys:
+                connection.execute(text(f"ALTER TABLE {table} DROP FOREIGN KEY `{constraint}`"))
+
+            for table, columns in UUID_COLUMNS.items():
+                indexes = {}
+                for index_name, non_unique, column in connection.execute(text("""
+                    SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+                    ORDER BY INDEX_NAME, SEQ_IN_INDEX
+                """), {"table": table}).fetchall():
+                    indexes.setdefault(index_name, [non_unique, []])[1].append(column)
+                affected = {
+                    name: definition for name, definition in indexes.items()
+                    if set(definition[1]) & set(columns)
+                }
+
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger_name(table, 'insert')}"))
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger_name(table, 'update')}"))
+
+                nullable = {row[0]: row[1] == "YES" for row in connection.execute(text("""
+                    SELECT COLUMN_NAME, IS_NULLABLE FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+                """), {"table": table}).fetchall()}
+
+                alterations = []
+                for name in affected:
+                    alterations.append("DROP PRIMARY KEY" if name == "PRIMARY" else f"DROP INDEX `{name}`")
+                for column in columns:
+                    null_clause = "NULL" if nullable[column] else "NOT NULL"
+                    alterations.append(f"DROP COLUMN {column}")
+                    alterations.append(
+                        f"CHANGE COLUMN {shadow_column(column)} {column} BINARY(16) {null_clause}"
+                    )
+                for name, (non_unique, index_columns) in affected.items():
+                    column_list = ", ".join(index_columns)
+                    if name == "PRIMARY":
+                        alterations.append(f"ADD PRIMARY KEY ({column_list})")
+                    elif non_unique:
+                        alterations.append(f"ADD INDEX `{name}` ({column_list})")
+                    else:
+                        alterations.append(f"ADD UNIQUE INDEX `{name}` ({column_list})")
+                connection.execute(text(f"ALTER TABLE {table} {', '.join(alterations)}"))
+                logger.info(f"Swapped uuid columns of {table}")
+
+            for table, constraint, column, referenced_table, referenced_column in foreign_keys:
+                connection.execute(text(
+                    f"ALTER TABLE {table} ADD CONSTRAINT `{constraint}` FOREIGN KEY ({column}) "
+                    f"REFERENCES {referenced_table} ({referenced_column})"
+                ))
+            connection.commit()
+    except SQLAlchemyError as e:
+        logger.error("Error while swapping uuid columns")
+        logger.error(e)
+        raise e
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convert CHAR(36) uuid keys to BINARY(16).")
+    parser.add_argument("phase", choices=["prepare", "backfill", "cutover"])
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    engine = create_engine(DB_STRING)
+    if args.phase == "prepare":
+        prepare(engine)
+    elif args.phase == "backfill":
+        backfill(engine, args.batch_size)
+    else:
+        cutover(engine)
@@ -0,0 +1,204 @@
+## set the BASE DIRECTORY path of the installation directory
+import sys
+
+sys.path.append("/home/kosala/git-repos/moon_agent_tracker_test/")
+
+import argparse
+import logging
+from datetime import date
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from agent.configs import DB_STRING
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "sales_transaction"
+FUTURE_PARTITION = "p_future"
+
+# indexes every partitioned sales_transaction needs, see SalesTransaction
+COVERING_INDEXES = {
+    "ix_sales_transaction_agent_date": "agent_id, sale_date, sale_amount",
+    "ix_sales_transaction_product": "product_id, sale_amount",
+    "ix_sales_transaction_sale_date": "sale_date",
+}
+
+
+def add_months(month_start: date, months: int) -> date:
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month_start: date) -> str:
+    return f"p{month_start.year:04d}{month_start.month:02d}"
+
+
+def partition_definition(month_start: date) -> str:
+    upper_bound = add_months(month_start, 1)
+    return f"PARTITION {partition_name(month_start)} VALUES LESS THAN " \
+        f"(UNIX_TIMESTAMP('{upper_bound.isoformat()} 00:00:00'))"
+
+
+def get_partitions(connection) -> list:
+    rows = connection.execute(text("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+            AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """), {"table": TABLE_NAME}).fetchall()
+    return [row[0] for row in rows]
+
+
+def migrate_sales_transaction_partitioning(engine, months_ahead: int = 3, null_sale_date: date = None):
+    """Range-partition sales_transaction by month of sale_date.
+
+    MySQL requires the partitioning column in every unique key and does not
+    support foreign keys on partitioned tables, so the migration:
+
+    0. checks for sales without a sale_date, which NOT NULL would reject
+       half way through; they are set to ``null_sale_date`` if given,
+       otherwise the migration stops before changing anything,
+    1. drops the foreign keys to agent and product,
+    2. makes sale_date NOT NULL and part of the primary key
+       (transaction_id, sale_date) and of the core_reference_id unique key,
+    3. adds the covering indexes used by the aggregation queries,
+    4. partitions the table with one partition per month from the oldest
+       sale up to ``months_ahead`` months from now, plus a catch-all.
+
+    A retried file still collides on (core_reference_id, sale_date) because
+    both values come from the same source row.
+
+    Steps 2 to 4 copy the whole table, and MySQL blocks writes to it for the
+    whole copy: stop ingestion, or run it in a maintenance window.
+    """
+    try:
+        with engine.begin() as connection:
+            if get_partitions(connection):
+                logger.info(f"{TABLE_NAME} is already partitioned")
+                return
+
+            missing_dates = connection.execute(
+                text(f"SELECT COUNT(*) FROM {TABLE_NAME} WHERE sale_date IS NULL")
+            ).scalar()
+            if missing_dates and null_sale_date is None:
+                raise ValueError(
+                    f"{missing_dates} sale(s) in {TABLE_NAME} have no sale_date, which the partitioned "
+                    f"table requires; pass --null-sale-date YYYY-MM-DD to set them to that date"
+                )
+            if missing_dates:
+                connection.execute(
+                    text(f"UPDATE {TABLE_NAME} SET sale_date = :sale_date WHERE sale_date IS NULL"),
+                    {"sale_date": null_sale_date}
+                )
+                logger.warning(f"Set the sale_date of {missing_dates} sale(s) without one to {null_sale_date}")
+
+            foreign_keys = connection.execute(text("""
+                SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+                WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = :table
+            """), {"table": TABLE_NAME}).fetchall()
+            for (constraint_name,) in foreign_keys:
+                connection.execute(text(f"ALTER TABLE {TABLE_NAME} DROP FOREIGN KEY `{constraint_name}`"))
+
+            unique_indexes = connection.execute(text("""
+                SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+                    AND COLUMN_NAME = 'core_reference_id' AND NON_UNIQUE = 0
+            """), {"table": TABLE_NAME}).fetchall()
+            existing_indexes = {row[0] for row in connection.execute(text("""
+                SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+            """), {"table": TABLE_NAME}).fetchall()}
+
+            alterations = [
+                "MODIFY sale_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+                "DROP PRIMARY KEY",
+                "ADD PRIMARY KEY (transaction_id, sale_date)",
+            ]
+            alterations += [f"DROP INDEX `{index_name}`" for (index_name,) in unique_indexes]
+            alterations.append("ADD UNIQUE KEY uq_sales_transaction_core_reference (core_reference_id, sale_date)")
+            alterations += [
+                f"ADD INDEX {index_name} ({columns})"
+                for index_name, columns in COVERING_INDEXES.items()
+                if index_name not in existing_indexes
+            ]
+            connection.execute(text(f"ALTER TABLE {TABLE_NAME} " + ", ".join(alterations)))
+
+            oldest_sale = connection.execute(text(f"SELECT MIN(sale_date) FROM {TABLE_NAME}")).scalar()
+            this_month = date.today().replace(day=1)
+            first_month = oldest_sale.date().replace(day=1) if oldest_sale else this_month
+            last_month = add_months(this_month, months_ahead)
+
+            definitions = []
+            month = first_month
+            while month <= last_month:
+                definitions.append(partition_definition(month))
+                month = add_months(month, 1)
+            definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+            connection.execute(text(
+                f"ALTER TABLE {TABLE_NAME} PARTITION BY RANGE (UNIX_TIMESTAMP(sale_date)) "
+                f"({', '.join(definitions)})"
+            ))
+            logger.info(f"{TABLE_NAME} partitioned into {len(definitions)} partitions")
+    except SQLAlchemyError as e:
+        logger.error("Error while partitioning sales_transaction")
+        logger.error(e)
+        raise e
+
+
+def ensure_future_partitions(engine, months_ahead: int = 3) -> list:
+    """Create the monthly partitions up to ``months_ahead`` months from now.
+
+    New partitions are split off the catch-all partition, which only holds
+    rows dated after the last monthly partition, so the reorganisation stays
+    cheap. Run it from a scheduled job well before the month starts.
+
+    Returns:
+        list: Names of the partitions that were added.
+    """
+    try:
+        with engine.begin() as connection:
+            partitions = get_partitions(connection)
+            if not partitions:
+                raise ValueError(f"{TABLE_NAME} is not partitioned, run the migration first")
+
+            monthly = [name for name in partitions if name != FUTURE_PARTITION]
+            last_name = max(monthly)
+            next_month = add_months(date(int(last_name[1:5]), int(last_name[5:7]), 1), 1)
+            last_month = add_months(date.today().replace(day=1), months_ahead)
+
+            definitions = []
+            added = []
+            while next_month <= last_month:
+                definitions.append(partition_definition(next_month))
+                added.append(partition_name(next_month))
+                next_month = add_months(next_month, 1)
+            if not definitions:
+                logger.info("No partitions to add")
+                return added
+
+            definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+            connection.execute(text(
+                f"ALTER TABLE {TABLE_NAME} REORGANIZE PARTITION {FUTURE_PARTITION} "
+                f"INTO ({', '.join(definitions)})"
+            ))
+            logger.info(f"Added partitions {', '.join(added)}")
+            return added
+    except SQLAlchemyError as e:
+        logger.error("Error while adding sales_transaction partitions")
+        logger.error(e)
+        raise e
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Partition maintenance for sales_transaction.")
+    parser.add_argument("command", choices=["migrate", "add-partitions"])
+    parser.add_argument("--months-ahead", type=int, default=3)
+    parser.add_argument("--null-sale-date", type=date.fromisoformat,
+                        help="migrate: sale date to give sales that have none (they block the migration)")
+    args = parser.parse_args()
+
+    engine = create_engine(DB_STRING)
+    if args.command == "migrate":
+        migrate_sales_transaction_partitioning(engine, args.months_ahead, args.null_sale_date)
+    else:
+        ensure_future_partitions(engine, args.months_ahead)
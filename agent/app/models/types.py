@@ -0,0 +1,32 @@
+import uuid
+from sqlalchemy.types import TypeDecorator, BINARY
+
+
+class BinaryUUID(TypeDecorator):
+    """UUID stored as BINARY(16) instead of its 36 character text form.
+
+    Accepts UUID objects, their string form or the raw 16 bytes as bind
+    values, and always returns the canonical lower-case string, so DTOs and
+    callers keep working with plain ``str`` ids.
+    """
+    impl = BINARY(16)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return to_uuid_bytes(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return str(uuid.UUID(bytes=bytes(value)))
+
+
+def to_uuid_bytes(value):
+    """Convert a UUID, its string form or its 16 raw bytes to raw bytes."""
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray)) and len(value) == 16:
+        return bytes(value)
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(str(value))
+    return value.bytes
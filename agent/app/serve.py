@@ -0,0 +1,48 @@
+"""Multi-worker serving entry point for the agent API.
+
+    python -m agent.app.serve --workers 4
+
+Each worker process imports the app and runs its lifespan on its own, so
+every worker gets its own engine pool after the fork. On
+SIGTERM uvicorn stops accepting connections, waits up to the graceful
+shutdown timeout for in-flight requests and then runs the lifespan shutdown,
+which disposes the pool.
+
+The same app also runs under gunicorn:
+
+    WEB_CONCURRENCY=4 gunicorn agent.app.main:app -k uvicorn.workers.UvicornWorker --graceful-timeout 30
+
+(gunicorn takes its worker count from WEB_CONCURRENCY, which the workers
+also read, so pass it that way rather than with -w.)
+"""
+import sys
+sys.path.append("/home/kosala/git-repos/moon_agent_tracker_test/")
+import argparse
+import os
+import uvicorn
+from agent.configs import SERVER_HOST, SERVER_PORT, WEB_CONCURRENCY, \
+    GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS
+
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT, workers: int = WEB_CONCURRENCY,
+          graceful_shutdown_timeout: int = GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS):
+    # workers read their settings from the environment, e.g. to share
+    # idempotency keys through the database when there is more than one
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "agent.app.main:app",
+        host=host,
+        port=port,
+        workers=workers,
+        timeout_graceful_shutdown=graceful_shutdown_timeout,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the agent API.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY)
+    parser.add_argument("--graceful-shutdown-timeout", type=int, default=GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.graceful_shutdown_timeout)
@@ -0,0 +1,228 @@
+import sys
+sys.path.append('/home/kosala/git-repos/moon_agent_tracker_test/')
+import argparse
+import logging
+import multiprocessing
+import signal
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
+from agent.app.db_repository.sql_repoitory import SQLRepository, DatabaseOperationException
+from agent.app.models.db_models import Notification as DBNotification
+from agent.app.services.transports import NotificationTransport, TransportException, get_transport
+from agent.configs import DB_STRING, NOTIFICATION_TRANSPORT, NOTIFICATION_BATCH_SIZE, \
+    NOTIFICATION_MAX_ATTEMPTS, NOTIFICATION_BACKOFF_BASE_SECONDS, \
+    NOTIFICATION_BACKOFF_MAX_SECONDS, NOTIFICATION_POLL_INTERVAL_SECONDS, NOTIFICATION_CLAIM_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+# the fields of a claimed notification the dispatcher needs after the
+# claiming transaction has ended
+ClaimedNotification = namedtuple("ClaimedNotification", "notification_id recipient_email message attempts")
+
+
+class NotificationDispatcher:
+    """Transactional outbox worker for the notification table.
+
+    Each batch is claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` so any
+    number of dispatcher processes can drain the table side by side without
+    sending a message twice. The claim is a lease: claimed rows get their
+    next_attempt_at moved past the claim time and the claim commits, so no
+    row lock or transaction is held while messages are sent; rows of a
+    dispatcher that died become due again once the lease passes. Messages
+    of one batch are coalesced per recipient, and failed deliveries are
+    retried with exponential backoff until ``max_attempts`` is reached.
+    """
+    def __init__(self, db_adapter: SQLRepository = None, transport: NotificationTransport = None,
+                 batch_size: int = NOTIFICATION_BATCH_SIZE,
+                 max_attempts: int = NOTIFICATION_MAX_ATTEMPTS,
+                 backoff_base_seconds: float = NOTIFICATION_BACKOFF_BASE_SECONDS,
+                 backoff_max_seconds: float = NOTIFICATION_BACKOFF_MAX_SECONDS,
+                 claim_seconds: int = NOTIFICATION_CLAIM_SECONDS):
+        self.db_adapter = db_adapter
+        self.transport = transport
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.claim_seconds = claim_seconds
+
+    def dispatch_batch(self) -> int:
+        """Claim, send and settle one batch of due PENDING notifications.
+
+        Returns:
+            int: Number of notifications claimed in this batch.
+
+        Raises:
+            DatabaseOperationException: If there is an error during
+            the database operation.
+        """
+        # TIMESTAMP columns keep whole seconds; the claim time identifies
+        # the claim when it is settled, so it must compare equal
+        now = datetime.now().replace(microsecond=0)
+        claimed_until = now + timedelta(seconds=self.claim_seconds)
+        notifications = self.__claim(now, claimed_until)
+        if not notifications:
+            return 0
+
+        sent_ids = []
+        failed = []
+        try:
+            with self.transport:
+                for recipient, group in self.__group_by_recipient(notifications).items():
+                    try:
+                        subject, body = self.__coalesce(group)
+                        self.transport.send(recipient, subject, body)
+                        sent_ids.extend(n.notification_id for n in group)
+                    except TransportException as e:
+                        logger.warning(f"Delivery to {recipient} failed: {e}")
+                        failed.extend((n, str(e)) for n in group)
+        except TransportException as e:
+            # the transport could not be opened at all, release the claim
+            # so the rows are picked up again on the next poll
+            logger.error(f"Notification transport unavailable: {e}")
+            self.__settle([], [], claimed_until, now, release=[n.notification_id for n in notifications])
+            return 0
+
+        self.__settle(sent_ids, failed, claimed_until, datetime.now())
+        logger.info(f"Dispatched {len(sent_ids)} notifications, {len(failed)} failed")
+        return len(notifications)
+
+    def __claim(self, now, claimed_until) -> list:
+        """Lease a batch of due PENDING notifications to this dispatcher."""
+        session = self.db_adapter.get_session()
+        try:
+            notifications = session.query(DBNotification) \
+                .filter(DBNotification.status == "PENDING") \
+                .filter(or_(DBNotification.next_attempt_at.is_(None),
+                            DBNotification.next_attempt_at <= now)) \
+                .order_by(DBNotification.created_at) \
+                .limit(self.batch_size) \
+                .with_for_update(skip_locked=True) \
+                .all()
+            claimed = [
+                ClaimedNotification(n.notification_id, n.recipient_email, n.message, n.attempts or 0)
+                for n in notifications
+            ]
+            for notification in notifications:
+                notification.next_attempt_at = claimed_until
+            session.commit()
+            return claimed
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while claiming notifications: {e}")
+        finally:
+            session.close()
+
+    def __settle(self, sent_ids, failed, claimed_until, now, release=()):
+        """Record the outcome of a claimed batch. Rows whose claim expired
+        - and was taken by another dispatcher in the meantime are left to it."""
+        session = self.db_adapter.get_session()
+        try:
+            def claimed(notification_ids):
+                return session.query(DBNotification) \
+                    .filter(DBNotification.notification_id.in_(notification_ids)) \
+                    .filter(DBNotification.status == "PENDING") \
+                    .filter(DBNotification.next_attempt_at == claimed_until)
+
+            if sent_ids:
+                claimed(sent_ids).update(
+                    {"status": "SENT", "sent_at": now, "next_attempt_at": None, "last_error": None},
+                    synchronize_session=False
+                )
+            if release:
+                claimed(list(release)).update({"next_attempt_at": None}, synchronize_session=False)
+            for notification, error in failed:
+                claimed([notification.notification_id]).update(
+                    self.__retry_values(notification, error, now), synchronize_session=False
+                )
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DatabaseOperationException(f"Database error while settling notifications: {e}")
+        finally:
+            session.close()
+
+    def run(self, stop_event: threading.Event = None,
+            poll_interval: float = NOTIFICATION_POLL_INTERVAL_SECONDS):
+        """Dispatch batches until stopped. Full batches are followed
+        - immediately by the next claim so bursts drain at transport speed,
+        - the poll interval only applies once the outbox is empty."""
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                claimed = self.dispatch_batch()
+            except DatabaseOperationException as e:
+                logger.error(e)
+                claimed = 0
+            if claimed < self.batch_size:
+                stop_event.wait(poll_interval)
+
+    def backoff_delay(self, attempts: int) -> float:
+        """Seconds to wait before the next delivery attempt."""
+        return min(self.backoff_base_seconds * (2 ** (attempts - 1)), self.backoff_max_seconds)
+
+    def __retry_values(self, notification, error, now) -> dict:
+        """Column values of a notification whose delivery failed."""
+        attempts = notification.attempts + 1
+        if attempts >= self.max_attempts:
+            return {"attempts": attempts, "last_error": error, "status": "FAILED", "next_attempt_at": None}
+        return {
+            "attempts": attempts,
+            "last_error": error,
+            "next_attempt_at": now + timedelta(seconds=self.backoff_delay(attempts)),
+        }
+
+    def __group_by_recipient(self, notifications):
+        groups = OrderedDict()
+        for notification in notifications:
+            groups.setdefault(notification.recipient_email, []).append(notification)
+        return groups
+
+    def __coalesce(self, group):
+        """Merge all messages for one recipient into a single email."""
+        if len(group) == 1:
+            return "Moon Agent notification", group[0].message
+        subject = f"Moon Agent: {len(group)} new notifications"
+        body = "\n\n---\n\n".join(n.message for n in group)
+        return subject, body
+
+
+def run_worker(transport_name: str = NOTIFICATION_TRANSPORT):
+    """Entry point of one dispatcher process. Resources are created here,
+    - after fork, so every worker owns its engine and transport."""
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    dispatcher = NotificationDispatcher(
+        db_adapter=SQLRepository(database_url=DB_STRING),
+        transport=get_transport(transport_name)
+    )
+    dispatcher.run(stop_event)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Send PENDING notifications.")
+    parser.add_argument("--workers", type=int, default=1, help="number of dispatcher processes")
+    parser.add_argument("--transport", default=NOTIFICATION_TRANSPORT, choices=["smtp", "file"])
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_worker(args.transport)
+    else:
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(args.transport,))
+            for _ in range(args.workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
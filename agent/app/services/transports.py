@@ -0,0 +1,130 @@
+import os
+import re
+import smtplib
+import uuid
+from abc import ABC, abstractmethod
+from email.message import EmailMessage
+from agent.configs import SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, \
+    SMTP_SENDER, SMTP_USE_TLS, NOTIFICATION_OUTBOX_DIR
+
+
+class TransportException(Exception):
+    """Custom exception for notification delivery errors."""
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class NotificationTransport(ABC):
+    """Base class of the pluggable notification transports.
+
+    A transport is opened once per claimed batch so that connection setup
+    (SMTP handshake, TLS, login) is paid per batch and not per message.
+    """
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def send(self, recipient: str, subject: str, body: str):
+        """Deliver one message, raising TransportException on failure."""
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class SMTPTransport(NotificationTransport):
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT,
+                 username: str = SMTP_USERNAME, password: str = SMTP_PASSWORD,
+                 sender: str = SMTP_SENDER, use_tls: bool = SMTP_USE_TLS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.use_tls = use_tls
+        self.smtp = None
+
+    def open(self):
+        try:
+            self.smtp = smtplib.SMTP(self.host, self.port, timeout=30)
+            if self.use_tls:
+                self.smtp.starttls()
+            if self.username:
+                self.smtp.login(self.username, self.password)
+        except (smtplib.SMTPException, OSError) as e:
+            self.smtp = None
+            raise TransportException(f"Error connecting to SMTP server {self.host}:{self.port}: {e}")
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def send(self, recipient: str, subject: str, body: str):
+        if self.smtp is None:
+            self.open()
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = recipient
+        message["Subject"] = subject
+        message.set_content(body)
+        try:
+            self.smtp.send_message(message)
+        except (smtplib.SMTPException, OSError) as e:
+            # reconnect on the next send in case the connection was dropped
+            self.close()
+            raise TransportException(f"Error sending notification to {recipient}: {e}")
+
+
+class FileTransport(NotificationTransport):
+    """Local stand-in for SMTP that writes each message as a file.
+
+    Useful for tests and local runs: every delivered message ends up as
+    ``<outbox_dir>/<recipient>/<uuid>.txt``. Recipients come from the
+    notification table, so only letters, digits and ``@._+-`` are kept of
+    them in the directory name.
+    """
+    UNSAFE_CHARACTERS = re.compile(r"[^A-Za-z0-9@._+-]")
+
+    def __init__(self, outbox_dir: str = NOTIFICATION_OUTBOX_DIR):
+        self.outbox_dir = outbox_dir
+
+    def open(self):
+        os.makedirs(self.outbox_dir, exist_ok=True)
+
+    def recipient_dir(self, recipient: str) -> str:
+        """Directory of a recipient's messages, always inside the outbox."""
+        name = self.UNSAFE_CHARACTERS.sub("_", recipient).strip(".") or "_"
+        outbox_dir = os.path.realpath(self.outbox_dir)
+        recipient_dir = os.path.realpath(os.path.join(outbox_dir, name))
+        if os.path.dirname(recipient_dir) != outbox_dir:
+            raise TransportException(f"Invalid recipient {recipient!r}")
+        return recipient_dir
+
+    def send(self, recipient: str, subject: str, body: str):
+        recipient_dir = self.recipient_dir(recipient)
+        try:
+            os.makedirs(recipient_dir, exist_ok=True)
+            message_path = os.path.join(recipient_dir, f"{uuid.uuid4()}.txt")
+            with open(message_path, "w", encoding="utf-8") as message_file:
+                message_file.write(f"Subject: {subject}\n\n{body}\n")
+        except OSError as e:
+            raise TransportException(f"Error writing notification for {recipient}: {e}")
+
+
+def get_transport(name: str) -> NotificationTransport:
+    """Build a transport from its configured name."""
+    if name == "smtp":
+        return SMTPTransport()
+    if name == "file":
+        return FileTransport()
+    raise ValueError(f"Unknown notification transport: {name}")
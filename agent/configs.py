@@ -9,4 +9,61 @@ DB_STRING_CHECK = os.getenv('DB_STRING')
 if not DB_STRING_CHECK:
     os.environ["DB_STRING"] = f'mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_ENDPOINT}/{DB_NAME}'
 
-DB_STRING = os.getenv('DB_STRING')    
\ No newline at end of file
+DB_STRING = os.getenv('DB_STRING')
+
+# In-process cache of branch detail rollups. Each worker has its own cache and
+# only invalidates its own entries, so other workers may serve a rollup that is
+# up to the TTL old after an agent moves
+BRANCH_ROLLUP_TTL_SECONDS = int(os.getenv('BRANCH_ROLLUP_TTL_SECONDS', '60'))
+BRANCH_ROLLUP_CACHE_SIZE = int(os.getenv('BRANCH_ROLLUP_CACHE_SIZE', '1024'))
+
+# Notification dispatcher
+NOTIFICATION_TRANSPORT = os.getenv('NOTIFICATION_TRANSPORT', 'smtp')  # smtp | file
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', '500'))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '5'))
+NOTIFICATION_BACKOFF_BASE_SECONDS = float(os.getenv('NOTIFICATION_BACKOFF_BASE_SECONDS', '30'))
+NOTIFICATION_BACKOFF_MAX_SECONDS = float(os.getenv('NOTIFICATION_BACKOFF_MAX_SECONDS', '3600'))
+NOTIFICATION_POLL_INTERVAL_SECONDS = float(os.getenv('NOTIFICATION_POLL_INTERVAL_SECONDS', '5'))
+# a claimed batch is sent outside the claiming transaction; rows of a
+# dispatcher that died are claimed again once this has passed, so keep it
+# above the time one batch takes to send
+NOTIFICATION_CLAIM_SECONDS = int(os.getenv('NOTIFICATION_CLAIM_SECONDS', '300'))
+NOTIFICATION_OUTBOX_DIR = os.getenv('NOTIFICATION_OUTBOX_DIR', '/tmp/moon_agent_outbox/')
+SMTP_HOST = os.getenv('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '25'))
+SMTP_USERNAME = os.getenv('SMTP_USERNAME')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
+SMTP_SENDER = os.getenv('SMTP_SENDER', 'no-reply@moon-agent.local')
+SMTP_USE_TLS = os.getenv('SMTP_USE_TLS', 'false').lower() == 'true'
+
+# Serving: one engine pool per worker process, so every worker holds up to
+# DB_POOL_SIZE + DB_MAX_OVERFLOW connections. The worker count is a small
+# fixed default rather than the CPU count, which inside a container is the
+# node's and not the pod's
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '8000'))
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '2'))
+GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS = int(os.getenv('GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS', '30'))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '5'))
+
+# Request / SQL timing
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
+# log every statement with its parameters; off by default because it
+# bypasses the parameter redaction of the slow-query log
+DB_ECHO = os.getenv('DB_ECHO', 'false').lower() == 'true'
+
+# Idempotency-Key support for write endpoints. Keys are only shared between
+# workers through the idempotency_key table, so it is on by default when more
+# than one worker was started, as told by the WEB_CONCURRENCY that serve.py
+# and gunicorn pass to their workers (a plain uvicorn run is one process);
+# set it to true as well when several pods serve. The table must exist
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_DB_BACKED = os.getenv(
+    'IDEMPOTENCY_DB_BACKED', 'true' if int(os.getenv('WEB_CONCURRENCY', '1')) > 1 else 'false'
+).lower() == 'true'
+# a reserved key is taken over after this long if its request never finished,
+# keep it above the longest write request
+IDEMPOTENCY_IN_PROGRESS_SECONDS = int(os.getenv('IDEMPOTENCY_IN_PROGRESS_SECONDS', '60'))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = float(os.getenv('IDEMPOTENCY_PURGE_INTERVAL_SECONDS', '3600'))
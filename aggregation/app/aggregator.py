@@ -1,39 +1,306 @@
 import sys
 sys.path.append('/home/kosala/git-repos/moon_agent_tracker_test/')
-from aggregation.app.sps.db import RdsSession, get_redshift_conn
-from aggregation.app.sps.rds_provider import get_best_performing_teams, get_top_products, get_branch_performance
-from aggregation.app.sps.redshift_provider import load_to_redshift
+import argparse
+import time
+from datetime import date, timedelta
+from aggregation.app.sps.db import rds_engine
+from aggregation.app.job_runner import JobRunner
+from aggregation.app.instrumentation import RunReport, phase, publish, timed
+from aggregation.app.sps.rds_provider import get_best_performing_teams, get_top_products, \
+    get_branch_performance, get_sales_base, get_max_transaction_id, get_daily_sales, \
+    get_missing_transaction_ids
+from aggregation.app.sps.aggregates import derive_best_performing_teams, derive_top_products, \
+    derive_branch_performance, merge_sales_base
+from aggregation.app.sps.windows import DIMENSIONS, derive_period_sales, derive_rolling_sales, \
+    period_table, rolling_table
+from aggregation.app.sps.redshift_provider import SALES_BASE_STATE_TABLE
+from aggregation.app.sps.shards import PARTIALS, ShardException, partial_table, validate_shard, \
+    derive_partials, reduce_partials, wait_for_shards
+from aggregation.app.sps.sinks import get_sink_factory
+from aggregation.configs import AGGREGATION_MODE, AGGREGATION_INCREMENTAL, AGGREGATION_SKETCHES, \
+    AGGREGATION_CHUNK_SIZE, AGGREGATION_WINDOWS, AGGREGATION_WINDOW_HISTORY_DAYS, \
+    AGGREGATION_ROLLING_OUTPUT_DAYS, AGGREGATION_SINK, AGGREGATION_SHARD_INDEX, AGGREGATION_SHARD_COUNT, \
+    AGGREGATION_REDUCE, AGGREGATION_PENDING_RANGE_TTL_SECONDS
 import logging
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def run_aggregator():
-    rds_connection = RdsSession()
-    redshift_conn = get_redshift_conn() 
-    try:
-        logger.info("Aggregating best performing teams...")
-        best_teams = get_best_performing_teams(rds_connection)
-        load_to_redshift(best_teams, "best_teams", redshift_conn)
-
-        logger.info("Aggregating top products...")
-        top_products = get_top_products(rds_connection)
-        load_to_redshift(top_products, "top_products", redshift_conn)
-
-        logger.info("Aggregating branch performance...")
-        branch_performance = get_branch_performance(rds_connection)
-        load_to_redshift(branch_performance, "branch_performance", redshift_conn)
-
-        logger.info("Aggregation and loading complete.")
-        
-    except Exception as e:
-        logger.error("An error occurred during aggregation and loading.")
-        logger.error(e)
-        raise e
-    finally:
-        rds_connection.close()
-        redshift_conn.close()
+def run_incremental(rds_connection, sink, full_rebuild=False, with_sketches=False):
+    """Fold new sales into the stored agent x product base and rebuild the
+    three aggregates from it.
+
+    The base is kept in the sink together with the last transaction id it
+    covers. A run reads only the sales after that watermark (up to the
+    current maximum, so rows inserted during the run wait for the next one),
+    merges them into the base and replaces base, aggregates and watermark in
+    one transaction. All three aggregates derive from the base, so it carries
+    their shared watermark. With full_rebuild the base is recomputed from all
+    history, for backfills and corrections.
+
+    Ids are assigned when a row is inserted, not when it commits, so a file
+    still being ingested can hold ids below ones that are already visible.
+    The ranges missing below the watermark are stored with it and read again
+    by the following runs until their rows show up, or until they are older
+    than AGGREGATION_PENDING_RANGE_TTL_SECONDS and taken to be rolled back.
+    Every run reads in one REPEATABLE READ snapshot, so a row is either in
+    the delta or in a pending range, never both.
+    """
+    sink.ensure_state_tables()
+    now = time.time()
+    high_water_mark = get_max_transaction_id(rds_connection)
+    low_water_mark = sink.read_watermark(SALES_BASE_STATE_TABLE)
+    ranges = []
+    for first_id, last_id, first_seen in sink.read_pending_ranges(SALES_BASE_STATE_TABLE):
+        if now - first_seen > AGGREGATION_PENDING_RANGE_TTL_SECONDS:
+            logger.warning(f"Sales {first_id}-{last_id} never showed up, taking them as rolled back")
+            continue
+        ranges.append((first_id, last_id, first_seen))
+    if high_water_mark > low_water_mark:
+        ranges.append((low_water_mark + 1, high_water_mark, now))
+    high_water_mark = max(high_water_mark, low_water_mark)
+    if not ranges and not full_rebuild:
+        logger.info("No new sales since the last run.")
+        return
+
+    pending = [
+        [missing_first, missing_last, first_seen]
+        for first_id, last_id, first_seen in ranges
+        for missing_first, missing_last in get_missing_transaction_ids(rds_connection, first_id, last_id)
+    ]
+    watermarks = {SALES_BASE_STATE_TABLE: high_water_mark}
+    pending_ranges = {SALES_BASE_STATE_TABLE: pending}
+    if full_rebuild:
+        logger.info(f"Rebuilding sales base up to transaction {high_water_mark}...")
+        base = get_sales_base(rds_connection, up_to_transaction_id=high_water_mark)
+    else:
+        logger.info(f"Aggregating sales {', '.join(f'{first}-{last}' for first, last, _ in ranges)}...")
+        delta = get_sales_base(
+            rds_connection,
+            transaction_ranges=[(first_id, last_id) for first_id, last_id, _ in ranges]
+        )
+        if delta.empty:
+            logger.info("No new committed sales since the last run.")
+            sink.replace_tables({}, watermarks=watermarks, pending_ranges=pending_ranges)
+            return
+        stored_base = sink.read_table(SALES_BASE_STATE_TABLE)
+        with timed("pandas_seconds"):
+            base = merge_sales_base(stored_base, delta)
+
+    with timed("pandas_seconds"):
+        frames = {
+            SALES_BASE_STATE_TABLE: base,
+            "best_teams": derive_best_performing_teams(base, with_sketches=with_sketches),
+            "top_products": derive_top_products(base, with_sketches=with_sketches),
+            "branch_performance": derive_branch_performance(base, with_sketches=with_sketches),
+        }
+    sink.replace_tables(frames, watermarks=watermarks, pending_ranges=pending_ranges)
+
+def run_shard(rds_connection, sink, shard_index, shard_count, with_sketches=False):
+    """Aggregate the agents of one shard into partials, see shards.py."""
+    logger.info(f"Aggregating shard {shard_index} of {shard_count}...")
+    base = get_sales_base(rds_connection, shard_index=shard_index, shard_count=shard_count)
+    with timed("pandas_seconds"):
+        partials = derive_partials(base, with_sketches=with_sketches)
+    sink.load_partials(partials, shard_index, shard_count)
+    return len(base)
+
+def run_reduce(sink, shard_count, with_sketches=False):
+    """Merge the partials of all shards and replace the aggregates with them."""
+    partials = {
+        partial_table(name): sink.read_partials(partial_table(name), shard_count) for name in PARTIALS
+    }
+    with timed("pandas_seconds"):
+        aggregates = reduce_partials(partials, with_sketches=with_sketches)
+    sink.replace_tables(aggregates)
+    return {name: len(df) for name, df in aggregates.items()}
+
+def extract_and_load(extract, table_name, chunk_size=0):
+    """Job that runs one aggregation query and loads its result, streamed in
+    - chunks when chunk_size is set."""
+    def job(context):
+        if chunk_size:
+            return context.sink.load_chunks(extract(context.rds, chunksize=chunk_size), table_name)
+        df = extract(context.rds)
+        context.sink.load(df, table_name)
+        return len(df)
+    return job
+
+def derive_and_load(derive, table_name, with_sketches=False):
+    """Job that derives one aggregate from the shared base and loads it."""
+    def job(context):
+        with timed("pandas_seconds"):
+            df = derive(context.results["sales_base"], with_sketches=with_sketches)
+        context.sink.load(df, table_name)
+        return len(df)
+    return job
+
+def register_window_jobs(runner, history_days=AGGREGATION_WINDOW_HISTORY_DAYS,
+                         output_days=AGGREGATION_ROLLING_OUTPUT_DAYS):
+    """Jobs for the windowed aggregates: one extract of the daily rollup,
+    - then one derive and one batched load per output table."""
+    today = date.today()
+    # start on a month boundary so the oldest month is complete
+    since = (today - timedelta(days=history_days)).replace(day=1)
+
+    def load_window(derive, table_name):
+        def job(context):
+            with timed("pandas_seconds"):
+                df = derive(context.results["daily_sales"])
+            context.sink.load(df, table_name)
+            return len(df)
+        return job
+
+    runner.register("daily_sales", lambda context: get_daily_sales(context.rds, since=since))
+    for dimension in DIMENSIONS:
+        runner.register(
+            period_table(dimension),
+            load_window(lambda daily, dimension=dimension: derive_period_sales(daily, dimension, since),
+                        period_table(dimension)),
+            depends_on=["daily_sales"]
+        )
+        runner.register(
+            rolling_table(dimension),
+            load_window(lambda daily, dimension=dimension: derive_rolling_sales(
+                daily, dimension, as_of=today, output_days=output_days), rolling_table(dimension)),
+            depends_on=["daily_sales"]
+        )
+
+def register_jobs(runner, mode, incremental, full_rebuild, with_sketches, chunk_size=0,
+                  shard_index=0, shard_count=1, reduce=False):
+    if reduce:
+        runner.register("reduce", lambda context: run_reduce(context.sink, shard_count, with_sketches))
+    elif shard_count > 1:
+        runner.register(
+            f"shard_{shard_index}",
+            lambda context: run_shard(context.rds, context.sink, shard_index, shard_count, with_sketches)
+        )
+    elif incremental:
+        # base, aggregates and watermark are replaced in one transaction
+        runner.register(
+            "incremental",
+            lambda context: run_incremental(context.rds, context.sink, full_rebuild, with_sketches)
+        )
+    elif mode == "shared":
+        runner.register("sales_base", lambda context: get_sales_base(context.rds))
+        runner.register("best_teams", derive_and_load(derive_best_performing_teams, "best_teams", with_sketches),
+                        depends_on=["sales_base"])
+        runner.register("top_products", derive_and_load(derive_top_products, "top_products", with_sketches),
+                        depends_on=["sales_base"])
+        runner.register("branch_performance",
+                        derive_and_load(derive_branch_performance, "branch_performance", with_sketches),
+                        depends_on=["sales_base"])
+    else:
+        runner.register("best_teams", extract_and_load(get_best_performing_teams, "best_teams", chunk_size))
+        runner.register("top_products", extract_and_load(get_top_products, "top_products", chunk_size))
+        runner.register("branch_performance",
+                        extract_and_load(get_branch_performance, "branch_performance", chunk_size))
+
+def run_aggregator(mode=AGGREGATION_MODE, incremental=AGGREGATION_INCREMENTAL, full_rebuild=False,
+                   with_sketches=AGGREGATION_SKETCHES, chunk_size=AGGREGATION_CHUNK_SIZE,
+                   windows=AGGREGATION_WINDOWS, sink=AGGREGATION_SINK, shard_index=AGGREGATION_SHARD_INDEX,
+                   shard_count=AGGREGATION_SHARD_COUNT, reduce=AGGREGATION_REDUCE):
+    """Run the nightly aggregation.
+
+    Every aggregate is a job of a JobRunner, so independent extract/load
+    steps run concurrently on their own pooled connections and the run takes
+    about as long as its slowest job. Failed or timed out jobs are retried.
+
+    Args:
+        mode (str): "separate" runs one query per aggregate, "shared" scans
+        sales_transaction once into an agent x product base and derives all
+        three aggregates from it.
+        incremental (bool): Only aggregate sales past the stored watermark and
+        merge them into the existing totals (implies the shared base).
+        full_rebuild (bool): With incremental, recompute the stored base from
+        all history instead of merging a delta.
+        with_sketches (bool): Add HyperLogLog sketches of the distinct agents
+        and products to the aggregates, so partial results can be merged.
+        Needs the agent x product base, so it is ignored in "separate" mode.
+        chunk_size (int): In "separate" mode, stream every extract through a
+        server-side cursor and load it chunk by chunk, keeping peak memory
+        at one chunk. 0 reads whole results.
+        windows (bool): Also build the day/week/month and rolling 7/30-day
+        aggregates per agent, branch and product from the daily rollup.
+        sink (str): "redshift", or "duckdb" to write to a local database.
+        shard_index (int), shard_count (int): With more than one shard, only
+        aggregate the agents in this shard's id range and write them as
+        partials (see shards.py); windows are left to the reduce run.
+        reduce (bool): Wait for the partials of all shard_count shards of
+        today's run, then merge them into the aggregates.
+
+    Every job is a phase of the run report, which is published when the run
+    ends, failed or not (see instrumentation.publish).
+    """
+    sharded = shard_count > 1 and not reduce
+    if sharded or reduce:
+        validate_shard(shard_index, shard_count)
+        if incremental:
+            raise ShardException("Sharded runs do not support incremental aggregation")
+    report = RunReport(mode=mode, incremental=incremental, full_rebuild=full_rebuild,
+                       with_sketches=with_sketches, chunk_size=chunk_size, windows=windows, sink=sink,
+                       shard_index=shard_index if sharded else None, shard_count=shard_count, reduce=reduce)
+    error = None
+    with report.activate():
+        # one run date for the whole run, partials are matched on it
+        sink_factory = get_sink_factory(sink, run_date=date.today())
+        try:
+            with phase("prepare"):
+                target = sink_factory.open()
+                try:
+                    target.prepare(with_sketches=with_sketches and (incremental or mode == "shared" or reduce),
+                                   windows=windows and not sharded, shards=sharded or reduce)
+                finally:
+                    target.close()
+            if reduce:
+                with phase("wait_for_shards"):
+                    target = sink_factory.open()
+                    try:
+                        wait_for_shards(target, shard_count)
+                    finally:
+                        target.close()
+
+            runner = JobRunner(rds_engine, sink_factory)
+            register_jobs(runner, mode, incremental, full_rebuild, with_sketches, chunk_size,
+                          shard_index, shard_count, reduce)
+            if windows and not sharded:
+                register_window_jobs(runner)
+            runner.run()
+            logger.info("Aggregation and loading complete.")
+
+        except Exception as e:
+            error = e
+            logger.error("An error occurred during aggregation and loading.")
+            logger.error(e)
+            raise e
+        finally:
+            sink_factory.close()
+            rds_engine.dispose()
+            report.finish(error)
+            publish(report)
 
 if __name__ == "__main__":
-    run_aggregator()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Aggregate sales into Redshift or a local DuckDB database.")
+    parser.add_argument("--mode", choices=["separate", "shared"], default=AGGREGATION_MODE)
+    parser.add_argument("--incremental", action="store_true", default=AGGREGATION_INCREMENTAL,
+                        help="only aggregate sales past the stored watermark")
+    parser.add_argument("--full-rebuild", action="store_true",
+                        help="with --incremental, recompute the stored base from all history")
+    parser.add_argument("--sketches", action="store_true", default=AGGREGATION_SKETCHES,
+                        help="add mergeable distinct agent/product sketches to the aggregates")
+    parser.add_argument("--chunk-size", type=int, default=AGGREGATION_CHUNK_SIZE,
+                        help="stream extracts in chunks of this many rows (0 = off)")
+    parser.add_argument("--windows", action="store_true", default=AGGREGATION_WINDOWS,
+                        help="also build the day/week/month and rolling 7/30-day aggregates")
+    parser.add_argument("--sink", choices=["redshift", "duckdb"], default=AGGREGATION_SINK)
+    parser.add_argument("--shard-index", type=int, default=AGGREGATION_SHARD_INDEX)
+    parser.add_argument("--shard-count", type=int, default=AGGREGATION_SHARD_COUNT,
+                        help="aggregate only the agents of one of this many shards and write partials")
+    parser.add_argument("--reduce", action="store_true", default=AGGREGATION_REDUCE,
+                        help="merge the partials of all shards into the aggregates")
+    args = parser.parse_args()
+    run_aggregator(mode=args.mode, incremental=args.incremental, full_rebuild=args.full_rebuild,
+                   with_sketches=args.sketches, chunk_size=args.chunk_size, windows=args.windows,
+                   sink=args.sink, shard_index=args.shard_index, shard_count=args.shard_count,
+                   reduce=args.reduce)
@@ -0,0 +1,160 @@
+"""HTTP API serving the aggregate queries of rds_provider.py on demand.
+
+    python -m aggregation.app.api
+
+Results are cached in memory per query, parameters and data watermark
+(MAX(transaction_id)), so repeated queries are answered without touching
+the aggregates until new sales arrive. Archiving old sales does not move
+the watermark, but it does not change the results either: the queries
+count archived sales through their totals in sales_archived_total. Every response carries an ETag of
+its body; dashboards polling with If-None-Match get an empty 304 while
+nothing changed.
+"""
+import sys
+sys.path.append('/home/kosala/git-repos/moon_agent_tracker_test/')
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+import uvicorn
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response, status
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+from common.cache import TTLCache
+from aggregation.app.sps.db import get_rds_engine
+from aggregation.app.sps.rds_provider import get_best_performing_teams, get_top_products, \
+    get_branch_performance, get_max_transaction_id
+from aggregation.configs import API_HOST, API_PORT, API_CACHE_SIZE, API_CACHE_TTL_SECONDS, \
+    API_WATERMARK_REFRESH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+QUERIES = {
+    "best_teams": get_best_performing_teams,
+    "top_products": get_top_products,
+    "branch_performance": get_branch_performance,
+}
+
+
+class AggregateQueryService:
+    """Runs aggregate queries, cached per parameters and data watermark.
+
+    The watermark is a primary key lookup, re-read at most once per
+    refresh interval. Concurrent misses on the same key wait for one
+    query instead of all running it.
+    """
+    def __init__(self, engine, cache_size: int = API_CACHE_SIZE, ttl_seconds: float = API_CACHE_TTL_SECONDS,
+                 watermark_refresh_seconds: float = API_WATERMARK_REFRESH_SECONDS):
+        self.engine = engine
+        self.Session = sessionmaker(bind=engine)
+        self.results = TTLCache(max_size=cache_size, ttl_seconds=ttl_seconds)
+        self.watermark_refresh_seconds = watermark_refresh_seconds
+        self._watermark = (0.0, None)
+        self._watermark_lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(64)]
+
+    def watermark(self) -> int:
+        with self._watermark_lock:
+            checked_at, value = self._watermark
+            if value is not None and time.monotonic() - checked_at < self.watermark_refresh_seconds:
+                return value
+            session = self.Session()
+            try:
+                value = get_max_transaction_id(session)
+            finally:
+                session.close()
+            self._watermark = (time.monotonic(), value)
+            return value
+
+    def query(self, name: str, params: dict) -> dict:
+        """Result of a query as {"watermark", "etag", "body"}."""
+        watermark = self.watermark()
+        key = (name, json.dumps(params, sort_keys=True), watermark)
+        cached = self.results.get(key)
+        if cached is not None:
+            return cached
+        with self._key_locks[hash(key) % len(self._key_locks)]:
+            cached = self.results.get(key)
+            if cached is not None:
+                return cached
+            session = self.Session()
+            try:
+                df = QUERIES[name](session, **params)
+            finally:
+                session.close()
+            body = json.dumps({
+                "query": name,
+                "params": params,
+                "watermark": watermark,
+                "rows": json.loads(df.to_json(orient="records", date_format="iso")),
+            }).encode("utf-8")
+            result = {
+                "watermark": watermark,
+                "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+                "body": body,
+            }
+            self.results.set(key, result)
+            return result
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in [candidate.removeprefix("W/") for candidate in candidates]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.query_service = AggregateQueryService(get_rds_engine())
+    yield
+    app.state.query_service.engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+
+
+def serve_query(request: Request, name: str, params: dict, if_none_match: Optional[str]):
+    try:
+        result = request.app.state.query_service.query(name, params)
+    except SQLAlchemyError as e:
+        logger.error(f"Error while running aggregate query {name}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    headers = {
+        "ETag": result["etag"],
+        # clients may keep the response but must revalidate before using it
+        "Cache-Control": "no-cache",
+        "X-Data-Watermark": str(result["watermark"]),
+    }
+    if etag_matches(if_none_match, result["etag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=result["body"], media_type="application/json", headers=headers)
+
+
+# plain def: the queries block, so FastAPI runs them in its thread pool
+@app.get("/aggregates/best_teams")
+def best_teams(request: Request, if_none_match: Optional[str] = Header(None)):
+    return serve_query(request, "best_teams", {}, if_none_match)
+
+@app.get("/aggregates/top_products")
+def top_products(request: Request, sales_threshold: float = Query(10000, ge=0),
+                 if_none_match: Optional[str] = Header(None)):
+    return serve_query(request, "top_products", {"sales_threshold": sales_threshold}, if_none_match)
+
+@app.get("/aggregates/branch_performance")
+def branch_performance(request: Request, if_none_match: Optional[str] = Header(None)):
+    return serve_query(request, "branch_performance", {}, if_none_match)
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"status": "ok"}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run("aggregation.app.api:app", host=API_HOST, port=API_PORT)
@@ -0,0 +1,162 @@
+import contextvars
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from aggregation.configs import AGGREGATION_REPORT_PATH, METRICS_PUSH_URL
+
+logger = logging.getLogger(__name__)
+
+# Structured run report of the aggregator. run_aggregator activates a
+# RunReport, every job runs in its own phase, and the providers, loaders
+# and sinks add their counters to the phase they run in through record()
+# and timed(). Outside an active report both are no-ops.
+#
+# Counters per phase:
+#   wall_seconds      time spent inside the phase
+#   db_seconds        executing queries, fetching rows and writing to the sink
+#   pandas_seconds    building, deriving and serialising dataframes
+#   rows_extracted, bytes_extracted (in-memory size of the extracted frames)
+#   rows_loaded
+
+_current_report = contextvars.ContextVar("aggregation_run_report", default=None)
+_current_phase = contextvars.ContextVar("aggregation_run_phase", default=None)
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunReport:
+    def __init__(self, **attributes):
+        self.run_id = str(uuid.uuid4())
+        self.attributes = attributes
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.status = "running"
+        self.error = None
+        self.wall_seconds = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """Make this the report record() and phase() write to."""
+        token = _current_report.set(self)
+        try:
+            yield self
+        finally:
+            _current_report.reset(token)
+
+    def add(self, phase, **counters):
+        with self._lock:
+            totals = self.phases.setdefault(phase or "run", {})
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+
+    def set(self, phase, **values):
+        with self._lock:
+            self.phases.setdefault(phase or "run", {}).update(values)
+
+    def finish(self, error=None):
+        self.wall_seconds = time.perf_counter() - self.start
+        self.status = "failed" if error else "succeeded"
+        self.error = str(error) if error else None
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            phases = {name: dict(counters) for name, counters in self.phases.items()}
+        # phases overlap, so their wall times and peaks do not add up
+        totals = {}
+        for counters in phases.values():
+            for name, value in counters.items():
+                if name not in ("wall_seconds", "peak_rss_bytes"):
+                    totals[name] = totals.get(name, 0) + value
+        slowest = max(phases, key=lambda name: phases[name].get("wall_seconds", 0), default=None)
+        return {
+            "run_id": self.run_id,
+            "started_at": self.started_at.isoformat(),
+            "status": self.status,
+            "error": self.error,
+            "wall_seconds": self.wall_seconds,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "slowest_phase": slowest,
+            **self.attributes,
+            "totals": totals,
+            "phases": phases,
+        }
+
+    def write(self, path):
+        with open(path, "w") as report_file:
+            json.dump(self.to_dict(), report_file, indent=2, default=str)
+
+    def push(self, url, timeout_seconds=10):
+        """POST the report as JSON to a metrics endpoint; failures are only logged."""
+        request = urllib.request.Request(
+            url, data=json.dumps(self.to_dict(), default=str).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout_seconds) as response:
+                response.read()
+        except Exception as e:
+            logger.warning(f"Could not push run report to {url}: {e}")
+
+
+@contextmanager
+def phase(name):
+    """Run a block as a named phase of the active report."""
+    report = _current_report.get()
+    if report is None:
+        yield
+        return
+    token = _current_phase.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add(name, wall_seconds=time.perf_counter() - start)
+        report.set(name, peak_rss_bytes=peak_rss_bytes())
+        _current_phase.reset(token)
+
+
+def record(**counters):
+    """Add counters to the current phase of the active report."""
+    report = _current_report.get()
+    if report is not None:
+        report.add(_current_phase.get(), **counters)
+
+
+@contextmanager
+def timed(counter):
+    """Add the time spent in a block to a counter, e.g. timed("db_seconds")."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(**{counter: time.perf_counter() - start})
+
+
+def record_extracted(df):
+    record(rows_extracted=len(df), bytes_extracted=int(df.memory_usage(deep=True).sum()))
+
+
+def publish(report, path=AGGREGATION_REPORT_PATH, push_url=METRICS_PUSH_URL):
+    """Log the run report as one JSON line, write it to path and push it."""
+    logger.info("Run report: " + json.dumps(report.to_dict(), default=str))
+    if path:
+        try:
+            report.write(path)
+        except OSError as e:
+            logger.warning(f"Could not write run report to {path}: {e}")
+    if push_url:
+        report.push(push_url)
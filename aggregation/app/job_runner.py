@@ -0,0 +1,251 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from aggregation.app.instrumentation import phase, record
+from aggregation.configs import AGGREGATION_WORKERS, AGGREGATION_JOB_TIMEOUT_SECONDS, \
+    AGGREGATION_JOB_RETRIES, AGGREGATION_RETRY_BACKOFF_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class JobRunnerException(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, name, func, depends_on=(), timeout_seconds=AGGREGATION_JOB_TIMEOUT_SECONDS,
+                 retries=AGGREGATION_JOB_RETRIES):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.timeout_seconds = timeout_seconds
+        self.retries = retries
+
+
+class JobContext:
+    """Connections and dependency results handed to one job attempt.
+
+    Every attempt gets its own RDS connection (wrapped in a session, as the
+    rds_provider functions expect) and its own sink from the sink factory.
+    Both carry a statement timeout equal to the job timeout where the
+    backend supports one, and cancel() aborts whatever statement is running
+    on them.
+    """
+    def __init__(self, rds_engine, sink_factory, results, timeout_seconds):
+        self.results = results
+        self.rds_engine = rds_engine
+        self.sink_factory = sink_factory
+        self.rds_connection = None
+        self.rds_connection_id = None
+        self.rds = None
+        self.sink = None
+        self.timeout_seconds = timeout_seconds
+
+    def open(self):
+        timeout_ms = int(self.timeout_seconds * 1000)
+        self.rds_connection = self.rds_engine.connect()
+        self.rds_connection_id = self.rds_connection.execute(text("SELECT CONNECTION_ID()")).scalar()
+        self.rds_connection.execute(text(f"SET SESSION max_execution_time = {timeout_ms}"))
+        self.rds = Session(bind=self.rds_connection)
+        self.sink = self.sink_factory.open(self.timeout_seconds)
+
+    def cancel(self):
+        """Abort the statements currently running for this attempt."""
+        if self.sink is not None:
+            self.sink.cancel()
+        if self.rds_connection_id is not None:
+            try:
+                with self.rds_engine.connect() as connection:
+                    connection.execute(text(f"KILL QUERY {int(self.rds_connection_id)}"))
+            except Exception as e:
+                logger.warning(f"Could not cancel RDS query: {e}")
+
+    def close(self):
+        if self.rds is not None:
+            self.rds.close()
+        if self.rds_connection is not None:
+            try:
+                self.rds_connection.rollback()
+                self.rds_connection.execute(text("SET SESSION max_execution_time = 0"))
+            except Exception as e:
+                logger.warning(f"Could not reset RDS connection: {e}")
+                self.rds_connection.invalidate()
+            finally:
+                self.rds_connection.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+class JobAttempt:
+    def __init__(self, job, number, deadline):
+        self.job = job
+        self.number = number
+        self.deadline = deadline
+        self.started_at = time.monotonic()
+        self.timed_out = False
+        self.context = None
+
+    def cancel(self):
+        if self.context is not None:
+            self.context.cancel()
+
+
+class JobRunner:
+    """Runs registered aggregation jobs concurrently, respecting dependencies.
+
+    A job starts as soon as all the jobs it depends on have succeeded and
+    receives their return values in context.results. A failed attempt, or
+    one that runs past its timeout and is cancelled, is retried after an
+    exponential backoff; once its retries are used up the job fails and the
+    jobs depending on it are skipped. Independent jobs still run to the
+    end, then run() raises JobRunnerException naming the failed jobs.
+
+    Example:
+        runner = JobRunner(rds_engine, sink_factory)
+        runner.register("sales_base", lambda context: get_sales_base(context.rds))
+        runner.register("best_teams", load_best_teams, depends_on=["sales_base"])
+        results = runner.run()
+    """
+    def __init__(self, rds_engine, sink_factory, max_workers=AGGREGATION_WORKERS,
+                 backoff_seconds=AGGREGATION_RETRY_BACKOFF_SECONDS):
+        self.rds_engine = rds_engine
+        self.sink_factory = sink_factory
+        self.max_workers = max_workers
+        self.backoff_seconds = backoff_seconds
+        self.jobs = {}
+        self.durations = {}
+
+    def register(self, name, func, depends_on=(), timeout_seconds=AGGREGATION_JOB_TIMEOUT_SECONDS,
+                 retries=AGGREGATION_JOB_RETRIES):
+        """Register a job.
+
+        Args:
+            func: Called with a JobContext, its return value is the job result.
+            depends_on: Names of the jobs that must succeed before this one starts.
+            timeout_seconds (float): Limit of a single attempt.
+            retries (int): Attempts after the first one.
+        """
+        if name in self.jobs:
+            raise JobRunnerException(f"Job {name} is already registered")
+        self.jobs[name] = Job(name, func, depends_on, timeout_seconds, retries)
+
+    def run(self) -> dict:
+        """Run all registered jobs and return their results by name."""
+        self.__validate()
+        results = {}
+        failed = {}
+        waiting = set(self.jobs)
+        ready_at = {}
+        attempts = {name: 0 for name in self.jobs}
+        running = {}
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while waiting or running:
+                now = time.monotonic()
+                for name in sorted(waiting):
+                    job = self.jobs[name]
+                    failed_dependencies = [dep for dep in job.depends_on if dep in failed]
+                    if failed_dependencies:
+                        waiting.discard(name)
+                        failed[name] = JobRunnerException(f"Skipped, {', '.join(failed_dependencies)} failed")
+                        logger.error(f"Skipping job {name}: {', '.join(failed_dependencies)} failed")
+                        continue
+                    if all(dep in results for dep in job.depends_on) and ready_at.get(name, 0) <= now:
+                        waiting.discard(name)
+                        attempts[name] += 1
+                        attempt = JobAttempt(job, attempts[name], now + job.timeout_seconds)
+                        dependency_results = {dep: results[dep] for dep in job.depends_on}
+                        # run in a copy of the caller's context, so the job reports into its run report
+                        future = executor.submit(
+                            contextvars.copy_context().run, self.__run_attempt, attempt, dependency_results
+                        )
+                        running[future] = attempt
+                        logger.info(f"Started job {name} (attempt {attempt.number})")
+
+                if not running and not waiting:
+                    break
+
+                wake_times = [attempt.deadline for attempt in running.values() if not attempt.timed_out]
+                wake_times += [
+                    ready_at.get(name, 0) for name in waiting
+                    if all(dep in results for dep in self.jobs[name].depends_on)
+                ]
+                timeout = max(0.0, min(wake_times) - now) if wake_times else None
+                if running:
+                    done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout or 0)
+                    done = set()
+
+                now = time.monotonic()
+                for future in done:
+                    attempt = running.pop(future)
+                    name = attempt.job.name
+                    error = future.exception()
+                    if error is None:
+                        results[name] = future.result()
+                        self.durations[name] = now - attempt.started_at
+                        logger.info(f"Finished job {name} in {self.durations[name]:.1f}s")
+                        continue
+                    if attempt.timed_out:
+                        error = JobRunnerException(
+                            f"Timed out after {attempt.job.timeout_seconds}s: {error}"
+                        )
+                    if attempt.number <= attempt.job.retries:
+                        delay = self.backoff_seconds * 2 ** (attempt.number - 1)
+                        logger.warning(f"Job {name} attempt {attempt.number} failed, retrying in {delay}s: {error}")
+                        ready_at[name] = now + delay
+                        waiting.add(name)
+                    else:
+                        logger.error(f"Job {name} failed after {attempt.number} attempts: {error}")
+                        failed[name] = error
+
+                for attempt in running.values():
+                    if not attempt.timed_out and now >= attempt.deadline:
+                        logger.warning(f"Job {attempt.job.name} exceeded {attempt.job.timeout_seconds}s, cancelling")
+                        attempt.timed_out = True
+                        attempt.cancel()
+
+        logger.info(f"Ran {len(self.jobs)} jobs in {time.monotonic() - started:.1f}s")
+        if failed:
+            raise JobRunnerException(
+                "Failed jobs: " + "; ".join(f"{name} ({error})" for name, error in sorted(failed.items()))
+            )
+        return results
+
+    def __run_attempt(self, attempt, dependency_results):
+        attempt.context = JobContext(
+            self.rds_engine, self.sink_factory, dependency_results, attempt.job.timeout_seconds
+        )
+        with phase(attempt.job.name):
+            record(attempts=1)
+            try:
+                attempt.context.open()
+                return attempt.job.func(attempt.context)
+            finally:
+                attempt.context.close()
+
+    def __validate(self):
+        for job in self.jobs.values():
+            unknown = [dep for dep in job.depends_on if dep not in self.jobs]
+            if unknown:
+                raise JobRunnerException(f"Job {job.name} depends on unknown jobs: {', '.join(unknown)}")
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise JobRunnerException(f"Dependency cycle through job {name}")
+            visiting.add(name)
+            for dep in self.jobs[name].depends_on:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.jobs:
+            visit(name)
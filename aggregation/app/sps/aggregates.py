@@ -0,0 +1,139 @@
+import math
+import pandas as pd
+from decimal import Decimal
+from aggregation.app.sps.sketches import sketch_groups, merge_sketch_column, DEFAULT_PRECISION
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The functions below derive the aggregates of rds_provider.py from the
+# agent x product base returned by get_sales_base. Totals are summed as
+# integer cents and divided once at the end, which gives exactly the floats
+# pd.read_sql returns for the DECIMAL sums of the original queries. Ties are
+# ordered with a stable sort.
+
+BASE_KEY = ['agent_id', 'product_id']
+BASE_COLUMNS = ['agent_id', 'product_id', 'branch_id', 'branch_name', 'product_name',
+                'total_cents', 'transaction_count']
+
+def merge_sales_base(state, delta):
+    """Add a delta base to a stored base, both at agent x product grain.
+
+    Totals and counts are summed. Branch and product names are taken from
+    the delta where present, so agents with new sales pick up their current
+    branch, or lose it when they were moved out of every branch; a full
+    rebuild corrects agents that moved without new sales.
+    """
+    combined = pd.concat([state[BASE_COLUMNS], delta[BASE_COLUMNS]], ignore_index=True)
+    totals = combined.groupby(BASE_KEY, sort=False, dropna=False)[['total_cents', 'transaction_count']].sum()
+    # the latest row of every key, missing values included ('last' would skip them)
+    latest = combined.drop_duplicates(BASE_KEY, keep='last') \
+        .set_index(BASE_KEY)[['branch_id', 'branch_name', 'product_name']]
+    merged = totals.join(latest).reset_index()
+    return merged[BASE_COLUMNS]
+
+def cents_to_amount(cents):
+    return cents / 100
+
+def add_distinct_sketches(result, rows, group_cols, sketch_columns, precision=DEFAULT_PRECISION):
+    """Attach HyperLogLog sketch columns to an aggregate.
+
+    Args:
+        sketch_columns (dict): Output column name -> column of rows whose
+        distinct values it counts, e.g. {"agents_sketch": "agent_id"}.
+    """
+    for sketch_column, value_column in sketch_columns.items():
+        sketches = sketch_groups(rows, group_cols, value_column, precision)
+        sketches = sketches.rename(sketch_column).reset_index()
+        result = result.merge(sketches, on=group_cols, how='left')
+    return result
+
+def merge_partials(partials, group_cols, with_sketches=False):
+    """Combine the partial aggregates of several shards into one.
+
+    Cents totals and agent counts are summed, which is exact because shards
+    split the agents (see shards.py); sketch columns are merged.
+    """
+    sums = [column for column in ('total_cents', 'num_agents') if column in partials.columns]
+    result = partials.groupby(group_cols, sort=False)[sums].sum().reset_index()
+    if with_sketches:
+        for sketch_column in [column for column in partials.columns if column.endswith('_sketch')]:
+            result = result.merge(merge_sketch_column(partials, group_cols, sketch_column),
+                                  on=group_cols, how='left')
+    return result
+
+def partial_best_performing_teams(base, with_sketches=False):
+    """Cents total and distinct agents per branch, before sorting."""
+    teams = base[base['branch_id'].notna()]
+    result = teams.groupby(['branch_id', 'branch_name'], sort=False).agg(
+        total_cents=('total_cents', 'sum'),
+        num_agents=('agent_id', 'nunique')
+    ).reset_index()
+    if with_sketches:
+        result = add_distinct_sketches(result, teams, ['branch_id', 'branch_name'],
+                                       {'agents_sketch': 'agent_id', 'products_sketch': 'product_id'})
+    return result
+
+def finish_best_performing_teams(partial, with_sketches=False):
+    result = partial.assign(total_sales=cents_to_amount(partial['total_cents']))
+    result = result.sort_values('total_sales', ascending=False, kind='mergesort')
+    columns = ['branch_id', 'branch_name', 'total_sales', 'num_agents']
+    if with_sketches:
+        columns += ['agents_sketch', 'products_sketch']
+    return result[columns].reset_index(drop=True)
+
+def derive_best_performing_teams(base, with_sketches=False):
+    """Same output as rds_provider.get_best_performing_teams, plus mergeable
+    - agents_sketch and products_sketch columns when with_sketches is set."""
+    return finish_best_performing_teams(partial_best_performing_teams(base, with_sketches), with_sketches)
+
+def partial_top_products(base, with_sketches=False):
+    """Cents total per product, before the threshold is applied."""
+    products = base[base['product_name'].notna()]
+    result = products.groupby('product_name', sort=False).agg(
+        total_cents=('total_cents', 'sum')
+    ).reset_index()
+    if with_sketches:
+        result = add_distinct_sketches(result, products, ['product_name'], {'agents_sketch': 'agent_id'})
+    return result
+
+def finish_top_products(partial, sales_threshold=10000, with_sketches=False):
+    # SUM >= threshold  <=>  cents >= ceil(threshold * 100) for integer cents
+    threshold_cents = math.ceil(Decimal(str(sales_threshold)) * 100)
+    result = partial[partial['total_cents'] >= threshold_cents]
+    result = result.assign(total_sales=cents_to_amount(result['total_cents']))
+    result = result.sort_values('total_sales', ascending=False, kind='mergesort')
+    columns = ['product_name', 'total_sales']
+    if with_sketches:
+        columns += ['agents_sketch']
+    return result[columns].reset_index(drop=True)
+
+def derive_top_products(base, sales_threshold=10000, with_sketches=False):
+    """Same output as rds_provider.get_top_products, plus a mergeable
+    - agents_sketch column when with_sketches is set."""
+    return finish_top_products(partial_top_products(base, with_sketches), sales_threshold, with_sketches)
+
+def partial_branch_performance(base, with_sketches=False):
+    """Distinct agents and cents total per branch name, before sorting."""
+    branches = base[base['branch_id'].notna()]
+    result = branches.groupby('branch_name', sort=False).agg(
+        num_agents=('agent_id', 'nunique'),
+        total_cents=('total_cents', 'sum')
+    ).reset_index()
+    if with_sketches:
+        result = add_distinct_sketches(result, branches, ['branch_name'],
+                                       {'agents_sketch': 'agent_id', 'products_sketch': 'product_id'})
+    return result
+
+def finish_branch_performance(partial, with_sketches=False):
+    result = partial.assign(total_branch_sales=cents_to_amount(partial['total_cents']))
+    result = result.sort_values('total_branch_sales', ascending=False, kind='mergesort')
+    columns = ['branch_name', 'num_agents', 'total_branch_sales']
+    if with_sketches:
+        columns += ['agents_sketch', 'products_sketch']
+    return result[columns].reset_index(drop=True)
+
+def derive_branch_performance(base, with_sketches=False):
+    """Same output as rds_provider.get_branch_performance, plus mergeable
+    - agents_sketch and products_sketch columns when with_sketches is set."""
+    return finish_branch_performance(partial_branch_performance(base, with_sketches), with_sketches)
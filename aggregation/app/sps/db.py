@@ -1,14 +1,21 @@
 import os
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-import psycopg2
 from aggregation.configs import DB_STRING as RDS_DB_URL, \
-    REDSHIFT_DB_ENDPOINT, REDSHIFT_DB_USERNAME, REDSHIFT_DB_PASSWORD, REDSHIFT_DB_NAME
+    REDSHIFT_DB_ENDPOINT, REDSHIFT_DB_USERNAME, REDSHIFT_DB_PASSWORD, REDSHIFT_DB_NAME, \
+    AGGREGATION_WORKERS
 
 def get_rds_engine():
-    return create_engine(RDS_DB_URL)
+    # one pooled connection per concurrent aggregation job, plus one spare
+    # for cancelling queries of timed out jobs
+    return create_engine(
+        RDS_DB_URL,
+        pool_size=AGGREGATION_WORKERS + 1,
+        pool_pre_ping=True
+    )
 
 def get_redshift_conn():
+    import psycopg2
     return psycopg2.connect(
     host=REDSHIFT_DB_ENDPOINT,
     port=5439,
@@ -17,4 +24,16 @@ def get_redshift_conn():
     password=REDSHIFT_DB_PASSWORD
 )
 
-RdsSession = sessionmaker(bind=get_rds_engine())
\ No newline at end of file
+def get_redshift_pool(max_connections=AGGREGATION_WORKERS):
+    from psycopg2.pool import ThreadedConnectionPool
+    return ThreadedConnectionPool(
+        1, max_connections,
+        host=REDSHIFT_DB_ENDPOINT,
+        port=5439,
+        dbname=REDSHIFT_DB_NAME,
+        user=REDSHIFT_DB_USERNAME,
+        password=REDSHIFT_DB_PASSWORD
+    )
+
+rds_engine = get_rds_engine()
+RdsSession = sessionmaker(bind=rds_engine)
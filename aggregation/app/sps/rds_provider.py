@@ -1,57 +1,295 @@
 import pandas as pd
 from sqlalchemy.sql import text
+from aggregation.app.instrumentation import record_extracted, timed
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_best_performing_teams(session):
-    query = """
+def read_query(session, query, params=None, chunksize=None):
+    """Run an extract query.
+
+    Without a chunksize the whole result is read at once. With one, the rows
+    are streamed through an unbuffered server-side cursor and returned as an
+    iterator of DataFrames of at most chunksize rows, so memory is bounded by
+    the chunk size instead of the result size. Fetching counts as DB time and
+    building the frames as pandas time in the run report.
+    """
+    if not chunksize:
+        with timed("db_seconds"):
+            result = session.connection().execute(text(query), params or {})
+            columns = list(result.keys())
+            rows = result.fetchall()
+        with timed("pandas_seconds"):
+            # coerce_float turns DECIMAL values into floats, as pd.read_sql does
+            df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        record_extracted(df)
+        return df
+    return stream_query(session, query, params, chunksize)
+
+def stream_query(session, query, params, chunksize):
+    """Yield the result of a query chunk by chunk from a server-side cursor."""
+    statement = text(query).execution_options(stream_results=True, max_row_buffer=chunksize)
+    with timed("db_seconds"):
+        result = session.connection().execute(statement, params or {})
+    rows_read = 0
+    try:
+        columns = list(result.keys())
+        partitions = result.partitions(chunksize)
+        while True:
+            with timed("db_seconds"):
+                rows = next(partitions, None)
+            if rows is None:
+                break
+            rows_read += len(rows)
+            with timed("pandas_seconds"):
+                df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+            record_extracted(df)
+            yield df
+    finally:
+        result.close()
+        logger.info(f"Streamed {rows_read} rows")
+
+# per-agent/per-product totals of the sales moved out of sales_transaction
+# by the archive job (intergration/app/services/archive_service.py); the
+# all-time aggregates add them to the live sales, so archiving a batch does
+# not change them
+ARCHIVED_TOTALS_TABLE = "sales_archived_total"
+
+def sales_totals(group_column):
+    """Derived table of all-time sales totals per group column, live and
+    - archived; grouping each side first keeps the union small."""
+    return f"""(
+            SELECT {group_column}, SUM(sale_amount) AS total_sales
+            FROM sales_transaction
+            GROUP BY {group_column}
+            UNION ALL
+            SELECT {group_column}, SUM(total_sales) AS total_sales
+            FROM {ARCHIVED_TOTALS_TABLE}
+            GROUP BY {group_column}
+        )"""
+
+def get_best_performing_teams(session, chunksize=None):
+    query = f"""
         SELECT 
-            a.branch_id,
+            BIN_TO_UUID(a.branch_id) AS branch_id,
             b.branch_name,
-            SUM(s.sale_amount) AS total_sales,
+            SUM(s.total_sales) AS total_sales,
             COUNT(DISTINCT s.agent_id) AS num_agents
-        FROM sales_transaction s
+        FROM {sales_totals("agent_id")} s
         JOIN agent a ON s.agent_id = a.agent_id
         JOIN branch b ON a.branch_id = b.branch_id
         GROUP BY a.branch_id, b.branch_name
         ORDER BY total_sales DESC;
     """
     logger.info("Fetching best performing teams")
-    result = pd.read_sql(query, session.bind)
+    if chunksize:
+        return read_query(session, query, chunksize=chunksize)
+    result = read_query(session, query)
     logger.info(f"Fetched {len(result)} best performing teams")
     return result
 
-def get_top_products(session, sales_threshold=10000):
+def get_top_products(session, sales_threshold=10000, chunksize=None):
     logger.info("Fetching top products with sales threshold: {}".format(sales_threshold))
-    query = """
+    query = f"""
         SELECT 
             p.name AS product_name,
-            SUM(s.sale_amount) AS total_sales
-        FROM sales_transaction s
+            SUM(s.total_sales) AS total_sales
+        FROM {sales_totals("product_id")} s
         JOIN product p ON s.product_id = p.product_id
         GROUP BY p.name
-        HAVING SUM(s.sale_amount) >= :threshold
+        HAVING SUM(s.total_sales) >= :threshold
         ORDER BY total_sales DESC;
     """
-    result = pd.read_sql(text(query), session.bind, params={"threshold": sales_threshold})
+    if chunksize:
+        return read_query(session, query, {"threshold": sales_threshold}, chunksize)
+    result = read_query(session, query, {"threshold": sales_threshold})
     logger.info(f"Fetched {len(result)} top products")
     return result
 
-def get_branch_performance(session):
+def get_branch_performance(session, chunksize=None):
     logger.info("Fetching branch performance")
-    query = """
+    query = f"""
         SELECT 
             b.branch_name,
             COUNT(DISTINCT a.agent_id) AS num_agents,
-            SUM(s.sale_amount) AS total_branch_sales
-        FROM sales_transaction s
+            SUM(s.total_sales) AS total_branch_sales
+        FROM {sales_totals("agent_id")} s
         JOIN agent a ON s.agent_id = a.agent_id
         JOIN branch b ON a.branch_id = b.branch_id
         GROUP BY b.branch_name
         ORDER BY total_branch_sales DESC;
     """
-    result = pd.read_sql(query, session.bind)
+    if chunksize:
+        return read_query(session, query, chunksize=chunksize)
+    result = read_query(session, query)
     logger.info(f"Fetched {len(result)} branch performance records")
-    return result
\ No newline at end of file
+    return result
+
+def get_max_transaction_id(session):
+    """Cheap data watermark: the highest transaction id (primary key lookup)."""
+    result = session.execute(text("SELECT MAX(transaction_id) FROM sales_transaction")).scalar()
+    return int(result) if result is not None else 0
+
+def get_missing_transaction_ids(session, first_id, last_id):
+    """Ranges of ids between first_id and last_id (inclusive) with no
+    visible sales row.
+
+    Auto-increment ids are handed out when a row is inserted, not when it
+    commits, so the rows of an ingestion transaction that is still open are
+    missing here while later ids are already visible; rolled back inserts
+    leave ranges that stay missing for good.
+
+    Returns:
+        list: (first, last) id ranges.
+    """
+    query = """
+        SELECT prev_id + 1 AS first_id, transaction_id - 1 AS last_id
+        FROM (
+            SELECT
+                transaction_id,
+                COALESCE(LAG(transaction_id) OVER (ORDER BY transaction_id), :first_id - 1) AS prev_id
+            FROM sales_transaction
+            WHERE transaction_id BETWEEN :first_id AND :last_id
+        ) ids
+        WHERE transaction_id > prev_id + 1
+        UNION ALL
+        SELECT COALESCE(MAX(transaction_id), :first_id - 1) + 1, :last_id
+        FROM sales_transaction
+        WHERE transaction_id BETWEEN :first_id AND :last_id
+        HAVING COALESCE(MAX(transaction_id), :first_id - 1) < :last_id;
+    """
+    with timed("db_seconds"):
+        rows = session.execute(text(query), {"first_id": first_id, "last_id": last_id}).fetchall()
+    return [(int(first), int(last)) for first, last in rows]
+
+
+def agent_id_bounds(shard_index, shard_count):
+    """Binary agent id range [lower, upper) of a shard.
+
+    Agent ids are random UUIDs stored as BINARY(16), so splitting the space
+    of their first four bytes into equal ranges spreads the agents evenly.
+    A range predicate on agent_id can seek ix_sales_transaction_agent_date,
+    where a hash of the column would scan the whole table in every shard.
+    The first shard has no lower bound and the last no upper bound.
+    """
+    def bound(index):
+        if index <= 0 or index >= shard_count:
+            return None
+        return (index * 2 ** 32 // shard_count).to_bytes(4, "big") + bytes(12)
+    return bound(shard_index), bound(shard_index + 1)
+
+
+def get_sales_base(session, after_transaction_id=None, up_to_transaction_id=None, chunksize=None,
+                   shard_index=None, shard_count=None, transaction_ranges=None):
+    """One scan of sales_transaction, pre-grouped per agent and product.
+
+    Every aggregate in aggregates.py can be derived from this base. Branch
+    and product are outer-joined so rows without them are kept for the
+    aggregates that do not need them; totals come back as integer cents so
+    they can be re-summed exactly. With a transaction id range only the
+    sales inside it are read; with transaction_ranges, a list of inclusive
+    (first, last) id ranges, only the sales inside them, which is how
+    incremental runs fetch deltas. A base read from the first sale on
+    (no after_transaction_id or transaction_ranges) includes the totals of
+    archived sales, see ARCHIVED_TOTALS_TABLE.
+    With a shard only the agents whose id falls into its range are read (see
+    shards.py and agent_id_bounds). With a chunksize an iterator of DataFrames is returned, see
+    read_query.
+    """
+    logger.info("Fetching agent x product sales base")
+    conditions = []
+    shard_conditions = []
+    params = {}
+    if after_transaction_id is not None:
+        conditions.append("s.transaction_id > :after_transaction_id")
+        params["after_transaction_id"] = after_transaction_id
+    if up_to_transaction_id is not None:
+        conditions.append("s.transaction_id <= :up_to_transaction_id")
+        params["up_to_transaction_id"] = up_to_transaction_id
+    if transaction_ranges:
+        conditions.append("(" + " OR ".join(
+            f"s.transaction_id BETWEEN :range_first_{i} AND :range_last_{i}"
+            for i in range(len(transaction_ranges))
+        ) + ")")
+        for i, (first_id, last_id) in enumerate(transaction_ranges):
+            params.update({f"range_first_{i}": first_id, f"range_last_{i}": last_id})
+    if shard_count:
+        lower, upper = agent_id_bounds(shard_index, shard_count)
+        if lower is not None:
+            shard_conditions.append("s.agent_id >= :shard_lower")
+            params["shard_lower"] = lower
+        if upper is not None:
+            shard_conditions.append("s.agent_id < :shard_upper")
+            params["shard_upper"] = upper
+    where = f"WHERE {' AND '.join(conditions + shard_conditions)}" if conditions or shard_conditions else ""
+    archived = ""
+    if after_transaction_id is None and not transaction_ranges:
+        archived_where = f"WHERE {' AND '.join(shard_conditions)}" if shard_conditions else ""
+        archived = f"""
+            UNION ALL
+            SELECT s.agent_id, s.product_id, s.total_sales, s.transaction_count
+            FROM {ARCHIVED_TOTALS_TABLE} s
+            {archived_where}"""
+    query = f"""
+        SELECT 
+            BIN_TO_UUID(s.agent_id) AS agent_id,
+            BIN_TO_UUID(s.product_id) AS product_id,
+            BIN_TO_UUID(b.branch_id) AS branch_id,
+            b.branch_name,
+            p.name AS product_name,
+            CAST(SUM(s.total_sales) * 100 AS SIGNED) AS total_cents,
+            CAST(SUM(s.transaction_count) AS SIGNED) AS transaction_count
+        FROM (
+            SELECT s.agent_id, s.product_id, SUM(s.sale_amount) AS total_sales, COUNT(*) AS transaction_count
+            FROM sales_transaction s
+            {where}
+            GROUP BY s.agent_id, s.product_id{archived}
+        ) s
+        LEFT JOIN agent a ON s.agent_id = a.agent_id
+        LEFT JOIN branch b ON a.branch_id = b.branch_id
+        LEFT JOIN product p ON s.product_id = p.product_id
+        GROUP BY s.agent_id, s.product_id, b.branch_id, b.branch_name, p.name;
+    """
+    if chunksize:
+        return read_query(session, query, params, chunksize)
+    result = read_query(session, query, params)
+    logger.info(f"Fetched {len(result)} agent x product base rows")
+    return result
+
+def get_daily_sales(session, since=None, chunksize=None):
+    """Daily sales per agent and product from the sales_daily_rollup table.
+
+    The rollup is maintained at ingestion time, so this reads one row per
+    agent, product and day instead of scanning sales_transaction. Agents
+    are attributed to their current branch. Totals come back as integer
+    cents, like get_sales_base.
+
+    Args:
+        since (date): Only read days on or after this one.
+    """
+    logger.info(f"Fetching daily sales since {since}" if since else "Fetching daily sales")
+    where = "WHERE r.sale_day >= :since" if since else ""
+    query = f"""
+        SELECT 
+            r.sale_day,
+            BIN_TO_UUID(r.agent_id) AS agent_id,
+            a.agent_code,
+            BIN_TO_UUID(b.branch_id) AS branch_id,
+            b.branch_name,
+            BIN_TO_UUID(r.product_id) AS product_id,
+            p.name AS product_name,
+            CAST(r.total_sales * 100 AS SIGNED) AS total_cents,
+            r.transaction_count
+        FROM sales_daily_rollup r
+        LEFT JOIN agent a ON r.agent_id = a.agent_id
+        LEFT JOIN branch b ON a.branch_id = b.branch_id
+        LEFT JOIN product p ON r.product_id = p.product_id
+        {where};
+    """
+    params = {"since": since} if since else {}
+    if chunksize:
+        return read_query(session, query, params, chunksize)
+    result = read_query(session, query, params)
+    logger.info(f"Fetched {len(result)} daily sales rows")
+    return result
@@ -1,16 +1,518 @@
+import csv
+import gzip
+import io
+import json
 import logging
+import uuid
+from datetime import datetime
+from aggregation.app.instrumentation import record, timed
+from aggregation.configs import REDSHIFT_LOAD_METHOD, REDSHIFT_STAGING, REDSHIFT_STAGING_BUCKET, \
+    REDSHIFT_STAGING_PREFIX, REDSHIFT_IAM_ROLE, REDSHIFT_INSERT_PAGE_SIZE, REDSHIFT_LOAD_MODE
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_to_redshift(df, table_name, conn):
-    cursor = conn.cursor()
+STAGING_SUFFIX = "_staging"
+RETIRED_SUFFIX = "_retired"
+WATERMARK_TABLE = "aggregation_watermark"
+SALES_BASE_STATE_TABLE = "sales_base_state"
+# HyperLogLog sketch columns the aggregates carry when sketches are enabled
+SKETCH_COLUMNS = {
+    "best_teams": ["agents_sketch", "products_sketch"],
+    "top_products": ["agents_sketch"],
+    "branch_performance": ["agents_sketch", "products_sketch"],
+}
+
+def load_to_redshift(df, table_name, conn, method=REDSHIFT_LOAD_METHOD, mode=REDSHIFT_LOAD_MODE):
+    """Load a dataframe into a Redshift table in bulk and commit.
+
+    With method "copy" the frame is written once as CSV and loaded with a
+    single COPY: from a gzipped file staged in S3 on Redshift, or streamed
+    through COPY FROM STDIN on a PostgreSQL stand-in. Unless both an S3
+    staging bucket and an IAM role are configured it falls back to
+    "values", multi-row INSERTs sent in pages through execute_values.
+
+    The mode decides what happens to the rows already in the table, see
+    write_table.
+    """
     logger.info(f"Loading data into Redshift table: {table_name}")
-    for _, row in df.iterrows():
-        cols = ", ".join(df.columns)
-        placeholders = ", ".join(["%s"] * len(df.columns))
-        sql = f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})"
-        cursor.execute(sql, tuple(row))
-    conn.commit()
-    cursor.close()
-    logger.info(f"Loaded data into Redshift table: {table_name}")
\ No newline at end of file
+    cursor = conn.cursor()
+    try:
+        write_table(table_name, cursor, lambda target: write_frame(df, target, cursor, method), mode)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    logger.info(f"Loaded {len(df)} rows into Redshift table: {table_name}")
+
+def load_chunks_to_redshift(chunks, table_name, conn, method=REDSHIFT_LOAD_METHOD, mode=REDSHIFT_LOAD_MODE):
+    """Load an iterator of dataframes into a Redshift table in one transaction.
+
+    Every chunk is written as soon as it is read, so only one chunk is held
+    in memory at a time. Nothing is committed unless all chunks load.
+    """
+    logger.info(f"Streaming data into Redshift table: {table_name}")
+    cursor = conn.cursor()
+    rows = 0
+
+    def write(target):
+        nonlocal rows
+        for chunk in chunks:
+            write_frame(chunk, target, cursor, method)
+            rows += len(chunk)
+
+    try:
+        write_table(table_name, cursor, write, mode)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    logger.info(f"Loaded {rows} rows into Redshift table: {table_name}")
+    return rows
+
+def write_table(table_name, cursor, write, mode=REDSHIFT_LOAD_MODE):
+    """Write a table's rows inside the caller's transaction.
+
+    Args:
+        write: Called with the name of the table to write the rows into.
+        mode (str): "append" adds the rows to the table. "replace" loads a
+        temporary staging copy, then deletes the old rows and inserts the
+        new ones; the table itself, its grants and views stay as they are,
+        but deleted rows are left for VACUUM. "swap" loads a fresh staging
+        copy, grants it the table's privileges and renames it over the
+        table; tables with bound views are replaced instead. With "swap"
+        and "replace" readers see the old contents until the transaction
+        commits and the new ones after it, never a partial load.
+    """
+    if mode == "swap":
+        swap_in(table_name, cursor, write)
+    elif mode == "replace":
+        replace_from_staging(table_name, cursor, write)
+    else:
+        write(table_name)
+
+def swap_in(table_name, cursor, write):
+    """Build the new contents in a staging table and rename it over the target.
+
+    The staging table gets the grants of the target before the rename, so
+    readers keep their access. Views bound to the target would block the
+    DROP of the retired table, so with dependent views the load falls back
+    to replace_from_staging; late-binding views (WITH NO SCHEMA BINDING) do
+    not count, they resolve the table by name.
+    """
+    views = dependent_views(table_name, cursor)
+    if views:
+        logger.warning(f"Views {', '.join(views)} depend on {table_name}, replacing its rows instead of swapping")
+        replace_from_staging(table_name, cursor, write)
+        return
+    staging_table = f"{table_name}{STAGING_SUFFIX}"
+    retired_table = f"{table_name}{RETIRED_SUFFIX}"
+    cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    cursor.execute(f"DROP TABLE IF EXISTS {retired_table}")
+    # LIKE copies the column definitions and the distribution and sort keys,
+    # but not the grants
+    cursor.execute(f"CREATE TABLE {staging_table} (LIKE {table_name})")
+    for grant in table_grants(table_name, cursor):
+        cursor.execute(grant.format(table=staging_table))
+    write(staging_table)
+    cursor.execute(f"ALTER TABLE {table_name} RENAME TO {retired_table}")
+    cursor.execute(f"ALTER TABLE {staging_table} RENAME TO {table_name}")
+    cursor.execute(f"DROP TABLE {retired_table}")
+
+# privilege letters of a pg_class ACL entry, see the GRANT documentation
+ACL_PRIVILEGES = {"r": "SELECT", "a": "INSERT", "w": "UPDATE", "d": "DELETE", "x": "REFERENCES"}
+
+def table_grants(table_name, cursor):
+    """GRANT statements that give a copy of a table the privileges of the
+    - table, with a {table} placeholder for the copy's name."""
+    cursor.execute(
+        "SELECT array_to_string(relacl, '\n') FROM pg_class WHERE oid = %s::regclass",
+        (table_name,)
+    )
+    row = cursor.fetchone()
+    grants = []
+    for entry in (row[0] or "").splitlines() if row else []:
+        is_group, grantee, letters = parse_acl_entry(entry.strip())
+        privileges = [ACL_PRIVILEGES[letter] for letter in letters if letter in ACL_PRIVILEGES]
+        if not privileges:
+            continue
+        if not grantee:
+            target = "PUBLIC"
+        else:
+            target = '"{}"'.format(grantee.replace('"', '""'))
+            if is_group:
+                target = f"GROUP {target}"
+        # the statements are filled in with str.format, so braces in names are doubled
+        target = target.replace("{", "{{").replace("}", "}}")
+        grants.append(f"GRANT {', '.join(privileges)} ON {{table}} TO {target}")
+    return grants
+
+def parse_acl_entry(entry):
+    """Split an ACL entry such as 'group "a=""b"=r/owner' into whether the
+    - grantee is a group, the grantee name (empty for PUBLIC) and the
+    - privilege letters. Quoted names double their inner quotes and may
+    - contain = or /, so the grantee is read up to its closing quote."""
+    is_group = entry.startswith("group ")
+    if is_group:
+        entry = entry[len("group "):]
+    if entry.startswith('"'):
+        name = []
+        index = 1
+        while True:
+            quote = entry.index('"', index)
+            name.append(entry[index:quote])
+            if entry[quote + 1:quote + 2] != '"':
+                break
+            name.append('"')
+            index = quote + 2
+        grantee = "".join(name)
+        index = quote + 1
+    else:
+        index = entry.index("=")
+        grantee = entry[:index]
+    # entry[index] is the = between the grantee and the privileges
+    return is_group, grantee, entry[index + 1:].split("/")[0]
+
+def dependent_views(table_name, cursor):
+    """Names of the views bound to a table."""
+    cursor.execute("""
+        SELECT DISTINCT v.relname
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.refobjid = %s::regclass AND v.oid <> d.refobjid
+    """, (table_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+def replace_from_staging(table_name, cursor, write):
+    """Build the new contents in a temporary table and copy them over the target."""
+    staging_table = f"{table_name}{STAGING_SUFFIX}"
+    cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    cursor.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {table_name})")
+    write(staging_table)
+    cursor.execute(f"DELETE FROM {table_name}")
+    cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {staging_table}")
+    cursor.execute(f"DROP TABLE {staging_table}")
+
+def write_frame(df, table_name, cursor, method=REDSHIFT_LOAD_METHOD):
+    """Bulk insert a dataframe inside the caller's transaction."""
+    if df.empty:
+        return
+    if method == "copy" and REDSHIFT_STAGING == "stdin":
+        copy_from_stdin(df, table_name, cursor)
+    elif method == "copy" and REDSHIFT_STAGING_BUCKET and REDSHIFT_IAM_ROLE:
+        # COPY from S3 needs both the staging bucket and a role Redshift
+        # reads it with; without either every COPY would fail
+        copy_from_s3(df, table_name, cursor)
+    else:
+        insert_values(df, table_name, cursor)
+    record(rows_loaded=len(df))
+
+def ensure_state_tables(conn):
+    """Create the tables incremental runs keep their state in."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+                aggregate_name VARCHAR(100) NOT NULL,
+                last_transaction_id BIGINT NOT NULL,
+                updated_at TIMESTAMP,
+                pending_ranges VARCHAR(65535)
+            )
+        """)
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s",
+            (WATERMARK_TABLE,)
+        )
+        if "pending_ranges" not in {row[0] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {WATERMARK_TABLE} ADD COLUMN pending_ranges VARCHAR(65535)")
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SALES_BASE_STATE_TABLE} (
+                agent_id VARCHAR(36),
+                product_id VARCHAR(36),
+                branch_id VARCHAR(36),
+                branch_name VARCHAR(255),
+                product_name VARCHAR(255),
+                total_cents BIGINT,
+                transaction_count BIGINT
+            )
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# column types of the windowed aggregate tables, see windows.py
+WINDOW_KEY_TYPES = {
+    "agent_id": "VARCHAR(36)", "agent_code": "VARCHAR(50)",
+    "branch_id": "VARCHAR(36)", "branch_name": "VARCHAR(255)",
+    "product_id": "VARCHAR(36)", "product_name": "VARCHAR(255)",
+}
+
+def ensure_window_tables(conn):
+    """Create the windowed aggregate tables, one per dimension and kind."""
+    from aggregation.app.sps.windows import DIMENSIONS, ROLLING_WINDOWS, period_table, rolling_table
+    cursor = conn.cursor()
+    try:
+        for dimension, keys in DIMENSIONS.items():
+            key_columns = ", ".join(f"{key} {WINDOW_KEY_TYPES[key]}" for key in keys)
+            num_agents = ", num_agents INTEGER" if dimension != "agent" else ""
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {period_table(dimension)} (
+                    period VARCHAR(10), period_start DATE, {key_columns},
+                    total_sales DECIMAL(18, 2), transaction_count BIGINT{num_agents}
+                )
+            """)
+            window_columns = ", ".join(f"sales_{window}d DECIMAL(18, 2)" for window in ROLLING_WINDOWS)
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {rolling_table(dimension)} (
+                    sale_day DATE, {key_columns}, {window_columns}
+                )
+            """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def ensure_sketch_columns(conn):
+    """Add the sketch columns to aggregate tables that do not have them yet."""
+    cursor = conn.cursor()
+    try:
+        for table_name, columns in SKETCH_COLUMNS.items():
+            cursor.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = %s",
+                (table_name,)
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            for column in columns:
+                if column not in existing:
+                    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} VARCHAR(65535)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def read_watermark(conn, aggregate_name):
+    """Last transaction id folded into an aggregate's state, 0 when none."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT MAX(last_transaction_id) FROM {WATERMARK_TABLE} WHERE aggregate_name = %s",
+            (aggregate_name,)
+        )
+        row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+    finally:
+        cursor.close()
+
+def read_pending_ranges(conn, aggregate_name):
+    """Id ranges below an aggregate's watermark that were not visible yet
+    - when it was stored, as [first, last, first_seen] lists."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT pending_ranges FROM {WATERMARK_TABLE} WHERE aggregate_name = %s "
+            "ORDER BY last_transaction_id DESC LIMIT 1",
+            (aggregate_name,)
+        )
+        row = cursor.fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+    finally:
+        cursor.close()
+
+def read_table(conn, table_name):
+    """Read a whole (small) state table into a dataframe."""
+    import pandas as pd
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT * FROM {table_name}")
+        columns = [column[0] for column in cursor.description]
+        return pd.DataFrame(cursor.fetchall(), columns=columns)
+    finally:
+        cursor.close()
+
+def replace_tables(frames, conn, watermarks=None, method=REDSHIFT_LOAD_METHOD, mode=REDSHIFT_LOAD_MODE,
+                   pending_ranges=None):
+    """Replace the contents of several tables and move watermarks forward
+    in one transaction, so a failed run leaves the previous state intact.
+
+    Args:
+        frames (dict): Table name to dataframe.
+        watermarks (dict): Aggregate name to last folded transaction id.
+        pending_ranges (dict): Aggregate name to the id ranges below its
+        watermark that are not folded yet, see read_pending_ranges.
+    """
+    cursor = conn.cursor()
+    try:
+        for table_name, df in frames.items():
+            logger.info(f"Replacing contents of Redshift table: {table_name}")
+            # appending would keep the old rows, so anything but a swap replaces
+            write_table(table_name, cursor, lambda target, df=df: write_frame(df, target, cursor, method),
+                        "swap" if mode == "swap" else "replace")
+        for aggregate_name, last_transaction_id in (watermarks or {}).items():
+            cursor.execute(f"DELETE FROM {WATERMARK_TABLE} WHERE aggregate_name = %s", (aggregate_name,))
+            cursor.execute(
+                f"INSERT INTO {WATERMARK_TABLE} (aggregate_name, last_transaction_id, updated_at, pending_ranges) "
+                "VALUES (%s, %s, %s, %s)",
+                (aggregate_name, last_transaction_id, datetime.now(),
+                 json.dumps((pending_ranges or {}).get(aggregate_name, [])))
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# columns of the partial aggregates written by sharded runs, see shards.py
+PARTIAL_COLUMNS = {
+    "best_teams": "branch_id VARCHAR(36), branch_name VARCHAR(255), total_cents BIGINT, num_agents BIGINT, "
+                  "agents_sketch VARCHAR(65535), products_sketch VARCHAR(65535)",
+    "top_products": "product_name VARCHAR(255), total_cents BIGINT, agents_sketch VARCHAR(65535)",
+    "branch_performance": "branch_name VARCHAR(255), total_cents BIGINT, num_agents BIGINT, "
+                          "agents_sketch VARCHAR(65535), products_sketch VARCHAR(65535)",
+}
+
+def ensure_partial_tables(conn):
+    """Create the partial aggregate tables and the shard completion table."""
+    from aggregation.app.sps.shards import SHARD_RUNS_TABLE, partial_table
+    cursor = conn.cursor()
+    try:
+        for aggregate_name, columns in PARTIAL_COLUMNS.items():
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {partial_table(aggregate_name)} (
+                    run_date DATE, shard_index INTEGER, shard_count INTEGER, {columns}
+                )
+            """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SHARD_RUNS_TABLE} (
+                run_date DATE, shard_index INTEGER, shard_count INTEGER, finished_at TIMESTAMP
+            )
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def replace_partials(frames, conn, run_date, shard_index, shard_count, method=REDSHIFT_LOAD_METHOD):
+    """Replace one shard's partials and mark the shard finished, in one
+    transaction.
+
+    Shards finish around the same time and write the same tables, so the
+    tables are locked first: concurrent shards then queue up instead of
+    failing with serializable isolation violations.
+    """
+    from aggregation.app.sps.shards import SHARD_RUNS_TABLE
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"LOCK {', '.join(list(frames) + [SHARD_RUNS_TABLE])}")
+        for table_name, df in frames.items():
+            cursor.execute(f"DELETE FROM {table_name} WHERE shard_index = %s", (shard_index,))
+            write_frame(
+                df.assign(run_date=run_date, shard_index=shard_index, shard_count=shard_count),
+                table_name, cursor, method
+            )
+        cursor.execute(f"DELETE FROM {SHARD_RUNS_TABLE} WHERE shard_index = %s", (shard_index,))
+        cursor.execute(
+            f"INSERT INTO {SHARD_RUNS_TABLE} (run_date, shard_index, shard_count, finished_at) "
+            "VALUES (%s, %s, %s, %s)",
+            (run_date, shard_index, shard_count, datetime.now())
+        )
+        conn.commit()
+        logger.info(f"Wrote partials of shard {shard_index} of {shard_count}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def read_finished_shards(conn, run_date, shard_count):
+    """Indexes of the shards of a run that have written their partials."""
+    from aggregation.app.sps.shards import SHARD_RUNS_TABLE
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT shard_index FROM {SHARD_RUNS_TABLE} WHERE run_date = %s AND shard_count = %s",
+            (run_date, shard_count)
+        )
+        finished = {int(row[0]) for row in cursor.fetchall()}
+        # end the transaction, so the next poll sees newly finished shards
+        conn.commit()
+        return finished
+    finally:
+        cursor.close()
+
+def read_partials(conn, table_name, run_date, shard_count):
+    """Partial rows of all shards of a run, without the shard columns."""
+    import pandas as pd
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT * FROM {table_name} WHERE run_date = %s AND shard_count = %s",
+            (run_date, shard_count)
+        )
+        columns = [column[0] for column in cursor.description]
+        df = pd.DataFrame(cursor.fetchall(), columns=columns)
+        return df.drop(columns=["run_date", "shard_index", "shard_count"])
+    finally:
+        cursor.close()
+
+def insert_values(df, table_name, cursor, page_size=REDSHIFT_INSERT_PAGE_SIZE):
+    """Multi-row INSERT, one statement per page of rows."""
+    from psycopg2.extras import execute_values
+    cols = ", ".join(df.columns)
+    sql = f"INSERT INTO {table_name} ({cols}) VALUES %s"
+    with timed("pandas_seconds"):
+        rows = dataframe_rows(df)
+    with timed("db_seconds"):
+        execute_values(cursor, sql, rows, page_size=page_size)
+
+def copy_from_stdin(df, table_name, cursor):
+    """Single COPY streamed from memory (PostgreSQL stand-in)."""
+    cols = ", ".join(df.columns)
+    with timed("pandas_seconds"):
+        buffer = io.StringIO(dataframe_csv(df))
+    with timed("db_seconds"):
+        cursor.copy_expert(f"COPY {table_name} ({cols}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def copy_from_s3(df, table_name, cursor):
+    """Single COPY from a gzipped CSV staged in S3 (Redshift). Redshift
+    loads empty CSV fields into text columns as empty strings, EMPTYASNULL
+    makes them NULL as COPY FROM STDIN does on PostgreSQL."""
+    import boto3
+    cols = ", ".join(df.columns)
+    key = f"{REDSHIFT_STAGING_PREFIX}{table_name}/{uuid.uuid4()}.csv.gz"
+    s3_client = boto3.client('s3')
+    with timed("pandas_seconds"):
+        body = gzip.compress(dataframe_csv(df).encode("utf-8"))
+    try:
+        # the upload counts as load time, together with the COPY
+        with timed("db_seconds"):
+            s3_client.put_object(Bucket=REDSHIFT_STAGING_BUCKET, Key=key, Body=body)
+            cursor.execute(
+                f"COPY {table_name} ({cols}) FROM %s IAM_ROLE %s FORMAT AS CSV GZIP EMPTYASNULL",
+                (f"s3://{REDSHIFT_STAGING_BUCKET}/{key}", REDSHIFT_IAM_ROLE)
+            )
+    finally:
+        s3_client.delete_object(Bucket=REDSHIFT_STAGING_BUCKET, Key=key)
+
+def dataframe_rows(df):
+    """Rows of a dataframe as tuples of python values, NaN as None."""
+    return list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+def dataframe_csv(df):
+    """Headerless CSV of a dataframe, NaN and None as empty unquoted fields,
+    which both COPY paths load as NULL."""
+    return df.to_csv(index=False, header=False, quoting=csv.QUOTE_MINIMAL)
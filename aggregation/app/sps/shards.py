@@ -0,0 +1,75 @@
+import logging
+import time
+from aggregation.app.sps.aggregates import merge_partials, partial_best_performing_teams, \
+    finish_best_performing_teams, partial_top_products, finish_top_products, partial_branch_performance, \
+    finish_branch_performance
+from aggregation.configs import AGGREGATION_REDUCE_WAIT_SECONDS, AGGREGATION_REDUCE_POLL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Sharded aggregation. Each of shard_count pods reads the sales of the agents
+# whose id falls into its range of the agent id space (an indexed range scan,
+# see rds_provider.agent_id_bounds), reduces them to partial aggregates and writes
+# those to <aggregate>_partial tables together with a completion marker.
+# Every agent belongs to exactly one shard, so cents totals and distinct
+# agent counts of the partials add up exactly; sketches are merged. The
+# reduce run waits for all markers of the day, merges the partials and
+# replaces the three aggregates.
+
+PARTIAL_SUFFIX = "_partial"
+SHARD_RUNS_TABLE = "aggregation_shard_runs"
+
+# aggregate name -> (partial, finish, group columns)
+PARTIALS = {
+    "best_teams": (partial_best_performing_teams, finish_best_performing_teams, ['branch_id', 'branch_name']),
+    "top_products": (partial_top_products, finish_top_products, ['product_name']),
+    "branch_performance": (partial_branch_performance, finish_branch_performance, ['branch_name']),
+}
+
+
+class ShardException(Exception):
+    pass
+
+
+def partial_table(aggregate_name):
+    return f"{aggregate_name}{PARTIAL_SUFFIX}"
+
+def validate_shard(shard_index, shard_count):
+    if shard_count < 1:
+        raise ShardException(f"Shard count must be at least 1, got {shard_count}")
+    if not 0 <= shard_index < shard_count:
+        raise ShardException(f"Shard index {shard_index} is outside 0-{shard_count - 1}")
+
+def derive_partials(base, with_sketches=False):
+    """Partial aggregates of one shard's sales base, by partial table."""
+    return {
+        partial_table(name): partial(base, with_sketches=with_sketches)
+        for name, (partial, _, _) in PARTIALS.items()
+    }
+
+def reduce_partials(partials, with_sketches=False):
+    """Final aggregates from the partials of all shards.
+
+    Args:
+        partials (dict): Partial table name to the rows of every shard.
+    """
+    return {
+        name: finish(merge_partials(partials[partial_table(name)], group_cols, with_sketches),
+                     with_sketches=with_sketches)
+        for name, (_, finish, group_cols) in PARTIALS.items()
+    }
+
+def wait_for_shards(sink, shard_count, wait_seconds=AGGREGATION_REDUCE_WAIT_SECONDS,
+                    poll_seconds=AGGREGATION_REDUCE_POLL_SECONDS):
+    """Block until every shard of today's run has written its partials."""
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        missing = sorted(set(range(shard_count)) - sink.finished_shards(shard_count))
+        if not missing:
+            return
+        if time.monotonic() >= deadline:
+            raise ShardException(
+                f"Shards {', '.join(map(str, missing))} of {shard_count} did not finish within {wait_seconds}s"
+            )
+        logger.info(f"Waiting for shards {', '.join(map(str, missing))} of {shard_count}...")
+        time.sleep(poll_seconds)
@@ -0,0 +1,403 @@
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime
+from aggregation.app.instrumentation import record, timed
+from aggregation.app.sps.redshift_provider import load_to_redshift, load_chunks_to_redshift, \
+    ensure_state_tables, ensure_sketch_columns, ensure_window_tables, ensure_partial_tables, read_watermark, \
+    read_pending_ranges, read_table, replace_tables, replace_partials, read_finished_shards, read_partials, WATERMARK_TABLE, \
+    SALES_BASE_STATE_TABLE
+from aggregation.app.sps.shards import SHARD_RUNS_TABLE
+from aggregation.configs import AGGREGATION_SINK, DUCKDB_PATH, PARQUET_EXPORT_DIR
+
+logger = logging.getLogger(__name__)
+
+# An aggregation run writes through an AggregateSink. Every job opens its
+# own sink from a SinkFactory, the way it gets its own RDS connection, so
+# sinks do not need to be thread-safe. The Redshift sink wraps the
+# redshift_provider functions; the DuckDB sink keeps everything in a local
+# database file, optionally mirrored to partitioned Parquet, so a whole run
+# can be done and benchmarked without a warehouse.
+
+
+class SinkException(Exception):
+    pass
+
+
+class AggregateSink:
+    """Where aggregates and incremental state are written to."""
+
+    def prepare(self, with_sketches=False, windows=False, shards=False):
+        """Create or extend the tables the run is going to write."""
+        raise NotImplementedError
+
+    def load(self, df, table_name):
+        """Write the rows of one aggregate and commit."""
+        raise NotImplementedError
+
+    def load_chunks(self, chunks, table_name):
+        """Write an iterator of dataframes as one aggregate and commit.
+
+        Returns:
+            int: Number of written rows.
+        """
+        raise NotImplementedError
+
+    def ensure_state_tables(self):
+        raise NotImplementedError
+
+    def read_watermark(self, aggregate_name):
+        """Last transaction id folded into an aggregate's state, 0 when none."""
+        raise NotImplementedError
+
+    def read_pending_ranges(self, aggregate_name):
+        """Id ranges below an aggregate's watermark that are not folded into
+        - its state yet, as [first, last, first_seen] lists."""
+        raise NotImplementedError
+
+    def read_table(self, table_name):
+        """Current contents of a (small) state table as a dataframe."""
+        raise NotImplementedError
+
+    def replace_tables(self, frames, watermarks=None, pending_ranges=None):
+        """Replace several tables and move watermarks forward atomically."""
+        raise NotImplementedError
+
+    def load_partials(self, frames, shard_index, shard_count):
+        """Replace one shard's partial aggregates and mark it finished, atomically."""
+        raise NotImplementedError
+
+    def finished_shards(self, shard_count):
+        """Indexes of the shards of today's run that have written their partials."""
+        raise NotImplementedError
+
+    def read_partials(self, table_name, shard_count):
+        """Partial rows of all shards of today's run."""
+        raise NotImplementedError
+
+    def cancel(self):
+        """Abort the statement currently running, from another thread."""
+
+    def close(self):
+        pass
+
+
+class SinkFactory:
+    def open(self, timeout_seconds=None) -> AggregateSink:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RedshiftSink(AggregateSink):
+    """Sink on one pooled Redshift connection, loaded with the configured
+    load method and mode (see load_to_redshift)."""
+
+    def __init__(self, pool, timeout_seconds=None, run_date=None):
+        self.pool = pool
+        self.run_date = run_date or date.today()
+        self.conn = pool.getconn()
+        if timeout_seconds:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(f"SET statement_timeout TO {int(timeout_seconds * 1000)}")
+                self.conn.commit()
+            finally:
+                cursor.close()
+
+    def prepare(self, with_sketches=False, windows=False, shards=False):
+        if with_sketches:
+            ensure_sketch_columns(self.conn)
+        if windows:
+            ensure_window_tables(self.conn)
+        if shards:
+            ensure_partial_tables(self.conn)
+
+    def load(self, df, table_name):
+        load_to_redshift(df, table_name, self.conn)
+
+    def load_chunks(self, chunks, table_name):
+        return load_chunks_to_redshift(chunks, table_name, self.conn)
+
+    def ensure_state_tables(self):
+        ensure_state_tables(self.conn)
+
+    def read_watermark(self, aggregate_name):
+        return read_watermark(self.conn, aggregate_name)
+
+    def read_pending_ranges(self, aggregate_name):
+        return read_pending_ranges(self.conn, aggregate_name)
+
+    def read_table(self, table_name):
+        return read_table(self.conn, table_name)
+
+    def replace_tables(self, frames, watermarks=None, pending_ranges=None):
+        replace_tables(frames, self.conn, watermarks, pending_ranges=pending_ranges)
+
+    def load_partials(self, frames, shard_index, shard_count):
+        replace_partials(frames, self.conn, self.run_date, shard_index, shard_count)
+
+    def finished_shards(self, shard_count):
+        return read_finished_shards(self.conn, self.run_date, shard_count)
+
+    def read_partials(self, table_name, shard_count):
+        return read_partials(self.conn, table_name, self.run_date, shard_count)
+
+    def cancel(self):
+        try:
+            self.conn.cancel()
+        except Exception as e:
+            logger.warning(f"Could not cancel Redshift statement: {e}")
+
+    def close(self):
+        broken = False
+        try:
+            self.conn.rollback()
+            cursor = self.conn.cursor()
+            cursor.execute("RESET statement_timeout")
+            cursor.close()
+            self.conn.commit()
+        except Exception:
+            broken = True
+        self.pool.putconn(self.conn, close=broken)
+
+
+class RedshiftSinkFactory(SinkFactory):
+    def __init__(self, pool=None, run_date=None):
+        from aggregation.app.sps.db import get_redshift_pool
+        self.pool = pool or get_redshift_pool()
+        self.run_date = run_date
+
+    def open(self, timeout_seconds=None):
+        return RedshiftSink(self.pool, timeout_seconds, self.run_date)
+
+    def close(self):
+        self.pool.closeall()
+
+
+class DuckDBSink(AggregateSink):
+    """Sink on a local DuckDB database that keeps the aggregate history.
+
+    Every table gets a run_date column. A load replaces the rows of the
+    current run date and leaves earlier runs in place, so rerunning a day
+    is idempotent and the history of every aggregate can be queried, e.g.
+
+        SELECT run_date, total_sales FROM best_teams WHERE branch_name = 'Colombo'
+
+    read_table returns the latest run. With a parquet_dir every load is also
+    exported to <parquet_dir>/<table>/run_date=YYYY-MM-DD/, which DuckDB,
+    pandas or Spark can read back with hive partitioning. A DuckDB file has
+    a single writer, so sharded runs against it have to run one at a time.
+    """
+    RUN_DATE_COLUMN = "run_date"
+
+    def __init__(self, connection, parquet_dir=None, run_date=None):
+        self.connection = connection
+        self.parquet_dir = parquet_dir
+        self.run_date = run_date or date.today()
+
+    def prepare(self, with_sketches=False, windows=False, shards=False):
+        # tables and new columns are created from the frames on first write
+        pass
+
+    def load(self, df, table_name):
+        self.load_chunks([df], table_name)
+
+    def load_chunks(self, chunks, table_name):
+        self.connection.begin()
+        try:
+            rows = self.__write_run(table_name, chunks)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        self.__export(table_name)
+        logger.info(f"Loaded {rows} rows into DuckDB table: {table_name}")
+        return rows
+
+    def ensure_state_tables(self):
+        from aggregation.app.sps.aggregates import BASE_COLUMNS
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+                aggregate_name VARCHAR NOT NULL,
+                last_transaction_id BIGINT NOT NULL,
+                updated_at TIMESTAMP,
+                pending_ranges VARCHAR
+            )
+        """)
+        self.connection.execute(f"ALTER TABLE {WATERMARK_TABLE} ADD COLUMN IF NOT EXISTS pending_ranges VARCHAR")
+        columns = ", ".join(
+            f"{column} {'BIGINT' if column in ('total_cents', 'transaction_count') else 'VARCHAR'}"
+            for column in BASE_COLUMNS
+        )
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {SALES_BASE_STATE_TABLE} ({columns}, {self.RUN_DATE_COLUMN} DATE)"
+        )
+
+    def read_watermark(self, aggregate_name):
+        row = self.connection.execute(
+            f"SELECT MAX(last_transaction_id) FROM {WATERMARK_TABLE} WHERE aggregate_name = ?",
+            [aggregate_name]
+        ).fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+    def read_pending_ranges(self, aggregate_name):
+        row = self.connection.execute(
+            f"SELECT pending_ranges FROM {WATERMARK_TABLE} WHERE aggregate_name = ? "
+            "ORDER BY last_transaction_id DESC LIMIT 1",
+            [aggregate_name]
+        ).fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+
+    def read_table(self, table_name):
+        return self.query(f"""
+            SELECT * EXCLUDE ({self.RUN_DATE_COLUMN}) FROM {table_name}
+            WHERE {self.RUN_DATE_COLUMN} = (SELECT MAX({self.RUN_DATE_COLUMN}) FROM {table_name})
+        """)
+
+    def replace_tables(self, frames, watermarks=None, pending_ranges=None):
+        self.connection.begin()
+        try:
+            for table_name, df in frames.items():
+                self.__write_run(table_name, [df])
+            for aggregate_name, last_transaction_id in (watermarks or {}).items():
+                self.connection.execute(
+                    f"DELETE FROM {WATERMARK_TABLE} WHERE aggregate_name = ?", [aggregate_name]
+                )
+                self.connection.execute(
+                    f"INSERT INTO {WATERMARK_TABLE} "
+                    "(aggregate_name, last_transaction_id, updated_at, pending_ranges) VALUES (?, ?, ?, ?)",
+                    [aggregate_name, last_transaction_id, datetime.now(),
+                     json.dumps((pending_ranges or {}).get(aggregate_name, []))]
+                )
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        for table_name in frames:
+            self.__export(table_name)
+
+    def load_partials(self, frames, shard_index, shard_count):
+        import pandas as pd
+        marker = pd.DataFrame({
+            "shard_index": [shard_index], "shard_count": [shard_count], "finished_at": [datetime.now()]
+        })
+        self.connection.begin()
+        try:
+            for table_name, df in {**frames, SHARD_RUNS_TABLE: marker}.items():
+                if self.__columns(table_name):
+                    self.connection.execute(
+                        f"DELETE FROM {table_name} WHERE {self.RUN_DATE_COLUMN} = ? AND shard_index = ?",
+                        [self.run_date, shard_index]
+                    )
+                self.__insert(table_name, df.assign(shard_index=shard_index, shard_count=shard_count))
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+    def finished_shards(self, shard_count):
+        if not self.__columns(SHARD_RUNS_TABLE):
+            return set()
+        rows = self.connection.execute(
+            f"SELECT shard_index FROM {SHARD_RUNS_TABLE} WHERE {self.RUN_DATE_COLUMN} = ? AND shard_count = ?",
+            [self.run_date, shard_count]
+        ).fetchall()
+        return {int(row[0]) for row in rows}
+
+    def read_partials(self, table_name, shard_count):
+        return self.query(f"""
+            SELECT * EXCLUDE ({self.RUN_DATE_COLUMN}, shard_index, shard_count) FROM {table_name}
+            WHERE {self.RUN_DATE_COLUMN} = ? AND shard_count = ?
+        """, [self.run_date, shard_count])
+
+    def query(self, sql, params=None):
+        """Run a query against the local aggregate history."""
+        return self.connection.execute(sql, params or []).fetchdf()
+
+    def cancel(self):
+        self.connection.interrupt()
+
+    def close(self):
+        self.connection.close()
+
+    def __write_run(self, table_name, chunks):
+        if self.__columns(table_name):
+            self.connection.execute(
+                f"DELETE FROM {table_name} WHERE {self.RUN_DATE_COLUMN} = ?", [self.run_date]
+            )
+        rows = 0
+        for chunk in chunks:
+            self.__insert(table_name, chunk)
+            rows += len(chunk)
+        return rows
+
+    def __insert(self, table_name, chunk):
+        with timed("db_seconds"):
+            self.connection.register("chunk", chunk)
+            try:
+                self.__ensure_columns(table_name)
+                self.connection.execute(
+                    f"INSERT INTO {table_name} BY NAME SELECT *, ?::DATE AS {self.RUN_DATE_COLUMN} FROM chunk",
+                    [self.run_date]
+                )
+            finally:
+                self.connection.unregister("chunk")
+        record(rows_loaded=len(chunk))
+
+    def __columns(self, table_name):
+        return {row[0] for row in self.connection.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ?", [table_name]
+        ).fetchall()}
+
+    def __ensure_columns(self, table_name):
+        """Create the table from the registered chunk, or add its new columns."""
+        existing = self.__columns(table_name)
+        if not existing:
+            self.connection.execute(
+                f"CREATE TABLE {table_name} AS "
+                f"SELECT *, NULL::DATE AS {self.RUN_DATE_COLUMN} FROM chunk LIMIT 0"
+            )
+            return
+        for column_name, column_type, *_ in self.connection.execute("DESCRIBE SELECT * FROM chunk").fetchall():
+            if column_name not in existing:
+                self.connection.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+    def __export(self, table_name):
+        if not self.parquet_dir:
+            return
+        target = os.path.join(self.parquet_dir, table_name)
+        with timed("db_seconds"):
+            self.connection.execute(f"""
+                COPY (SELECT * FROM {table_name} WHERE {self.RUN_DATE_COLUMN} = DATE '{self.run_date.isoformat()}')
+                TO '{target}' (FORMAT PARQUET, PARTITION_BY ({self.RUN_DATE_COLUMN}), OVERWRITE_OR_IGNORE)
+            """)
+
+
+class DuckDBSinkFactory(SinkFactory):
+    """Opens one DuckDB database per run and hands every job its own cursor."""
+
+    def __init__(self, database_path=DUCKDB_PATH, parquet_dir=PARQUET_EXPORT_DIR, run_date=None):
+        import duckdb
+        self.database = duckdb.connect(database_path)
+        self.parquet_dir = parquet_dir
+        self.run_date = run_date
+        self.lock = threading.Lock()
+
+    def open(self, timeout_seconds=None):
+        # DuckDB has no statement timeout; the job runner interrupts instead
+        with self.lock:
+            return DuckDBSink(self.database.cursor(), self.parquet_dir, self.run_date)
+
+    def close(self):
+        self.database.close()
+
+
+def get_sink_factory(kind=AGGREGATION_SINK, run_date=None) -> SinkFactory:
+    if kind == "redshift":
+        return RedshiftSinkFactory(run_date=run_date)
+    if kind == "duckdb":
+        return DuckDBSinkFactory(run_date=run_date)
+    raise SinkException(f"Unknown aggregation sink: {kind}")
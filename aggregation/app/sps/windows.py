@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+from aggregation.app.sps.aggregates import cents_to_amount
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Time-windowed aggregates derived from the daily sales returned by
+# rds_provider.get_daily_sales. Calendar periods are computed with one
+# bucketed groupby per period, rolling windows with cumulative sums over a
+# dense day x entity matrix, so no query runs per window. Sums stay in
+# integer cents until the end, as in aggregates.py.
+
+# pandas period aliases; weeks run Monday to Sunday
+PERIODS = {"day": "D", "week": "W-SUN", "month": "M"}
+ROLLING_WINDOWS = (7, 30)
+
+# columns identifying an entity of each dimension
+DIMENSIONS = {
+    "agent": ["agent_id", "agent_code"],
+    "branch": ["branch_id", "branch_name"],
+    "product": ["product_id", "product_name"],
+}
+
+def period_table(dimension):
+    return f"{dimension}_sales_by_period"
+
+def rolling_table(dimension):
+    return f"{dimension}_rolling_sales"
+
+def period_start(sale_days, period):
+    """First day of the period each sale day falls in."""
+    return pd.to_datetime(sale_days).dt.to_period(PERIODS[period]).dt.start_time.dt.date
+
+def derive_period_sales(daily, dimension, since=None):
+    """Sales per entity per day, week and month, in one long frame.
+
+    Args:
+        since (date): First day of the daily sales read; periods starting
+        before it would only be partly covered and are dropped.
+
+    Returns:
+        pd.DataFrame: period, period_start, the dimension's key columns,
+        total_sales, transaction_count and, for branches and products,
+        num_agents.
+    """
+    keys = DIMENSIONS[dimension]
+    rows = daily.dropna(subset=keys)
+    aggregations = {
+        "total_cents": ("total_cents", "sum"),
+        "transaction_count": ("transaction_count", "sum"),
+    }
+    if dimension != "agent":
+        aggregations["num_agents"] = ("agent_id", "nunique")
+
+    frames = []
+    for period in PERIODS:
+        bucketed = rows.assign(period_start=period_start(rows["sale_day"], period))
+        result = bucketed.groupby(keys + ["period_start"], sort=False).agg(**aggregations).reset_index()
+        result.insert(0, "period", period)
+        frames.append(result)
+    result = pd.concat(frames, ignore_index=True)
+    if since is not None:
+        result = result[result["period_start"] >= since]
+    result = result.assign(total_sales=cents_to_amount(result["total_cents"]))
+
+    columns = ["period", "period_start"] + keys + ["total_sales", "transaction_count"]
+    if dimension != "agent":
+        columns.append("num_agents")
+    return result.sort_values(["period", "period_start"], kind="mergesort")[columns].reset_index(drop=True)
+
+def derive_rolling_sales(daily, dimension, as_of=None, output_days=None, windows=ROLLING_WINDOWS):
+    """Trailing-window sales per entity for every day, e.g. sales_7d and sales_30d.
+
+    The daily totals are laid out as a dense day x entity matrix, with days
+    without sales filled with zero, and each window is the difference of two
+    rows of its cumulative sum. Only entity-days with sales inside at least
+    one window are returned.
+
+    Args:
+        as_of (date): Last day to report, defaults to the last sale day.
+        output_days (int): Only report the last this many days; earlier
+        days are still read to fill their windows.
+    """
+    keys = DIMENSIONS[dimension]
+    columns = ["sale_day"] + keys + [f"sales_{window}d" for window in windows]
+    rows = daily.dropna(subset=keys)
+    if rows.empty:
+        return pd.DataFrame(columns=columns)
+
+    per_day = rows.groupby(["sale_day"] + keys)["total_cents"].sum()
+    matrix = per_day.unstack(keys, fill_value=0)
+    matrix.index = pd.to_datetime(matrix.index)
+    last_day = pd.Timestamp(as_of) if as_of is not None else matrix.index.max()
+    days = pd.date_range(matrix.index.min(), last_day, freq="D")
+    matrix = matrix.reindex(days, fill_value=0)
+
+    values = matrix.to_numpy(dtype=np.int64)
+    cumulative = np.vstack([np.zeros((1, values.shape[1]), dtype=np.int64), values.cumsum(axis=0)])
+    first_output = max(len(days) - output_days, 0) if output_days else 0
+    day_index = np.arange(first_output, len(days))
+
+    entities = matrix.columns.to_frame(index=False)
+    result = pd.DataFrame({
+        "sale_day": np.repeat(days[first_output:].date, len(entities)),
+        **{key: np.tile(entities[key].to_numpy(), len(day_index)) for key in keys},
+    })
+    in_any_window = np.zeros(len(result), dtype=bool)
+    for window in windows:
+        window_start = np.maximum(day_index + 1 - window, 0)
+        cents = (cumulative[day_index + 1] - cumulative[window_start]).ravel()
+        result[f"sales_{window}d"] = cents_to_amount(cents)
+        in_any_window |= cents != 0
+    return result[in_any_window][columns].reset_index(drop=True)
@@ -23,3 +23,86 @@ if not REDSHIFT_DB_STRING_CHECK:
     os.environ["REDSHIFT_DB_STRING"] = f'postgresql://{REDSHIFT_DB_USERNAME}:{REDSHIFT_DB_PASSWORD}@{REDSHIFT_DB_ENDPOINT}/{REDSHIFT_DB_NAME}'
 REDSHIFT_DB_STRING = os.getenv('REDSHIFT_DB_STRING') 
 
+
+# Redshift bulk loading: "copy" stages the frame and issues one COPY,
+# "values" sends multi-row INSERTs through execute_values
+REDSHIFT_LOAD_METHOD = os.getenv('REDSHIFT_LOAD_METHOD', 'copy')
+# where COPY reads from: "s3" for Redshift, "stdin" for a local PostgreSQL stand-in;
+# "s3" needs both REDSHIFT_STAGING_BUCKET and REDSHIFT_IAM_ROLE, without them
+# loads fall back to "values"
+REDSHIFT_STAGING = os.getenv('REDSHIFT_STAGING', 's3')
+REDSHIFT_STAGING_BUCKET = os.getenv('REDSHIFT_STAGING_BUCKET')
+REDSHIFT_STAGING_PREFIX = os.getenv('REDSHIFT_STAGING_PREFIX', 'aggregation/staging/')
+REDSHIFT_IAM_ROLE = os.getenv('REDSHIFT_IAM_ROLE')
+REDSHIFT_INSERT_PAGE_SIZE = int(os.getenv('REDSHIFT_INSERT_PAGE_SIZE', '1000'))
+# what a load does with the rows already in the table: "replace" deletes and
+# re-inserts from a staging copy, "swap" builds a staging copy, grants it the
+# table's privileges and renames it over the table (falling back to replace
+# when views are bound to the table), both atomically; "append" only adds rows
+REDSHIFT_LOAD_MODE = os.getenv('REDSHIFT_LOAD_MODE', 'replace')
+
+# "separate" runs one query per aggregate, "shared" derives all of them
+# from a single agent x product scan of sales_transaction
+AGGREGATION_MODE = os.getenv('AGGREGATION_MODE', 'separate')
+
+# incremental runs fold only sales past the stored watermark into the state
+AGGREGATION_INCREMENTAL = os.getenv('AGGREGATION_INCREMENTAL', 'false').lower() == 'true'
+# ids below the watermark that were not committed yet are re-read by later
+# runs for this long, after that they are taken to be rolled back
+AGGREGATION_PENDING_RANGE_TTL_SECONDS = float(os.getenv('AGGREGATION_PENDING_RANGE_TTL_SECONDS', '86400'))
+
+# add mergeable HyperLogLog sketches of distinct agents/products to the
+# aggregates derived from the shared base; precision p uses 2**p registers
+AGGREGATION_SKETCHES = os.getenv('AGGREGATION_SKETCHES', 'false').lower() == 'true'
+AGGREGATION_SKETCH_PRECISION = int(os.getenv('AGGREGATION_SKETCH_PRECISION', '12'))
+
+# concurrent job runner: worker threads (and pooled connections per database),
+# per-attempt timeout and retries of a failed or timed out job
+AGGREGATION_WORKERS = int(os.getenv('AGGREGATION_WORKERS', '4'))
+AGGREGATION_JOB_TIMEOUT_SECONDS = float(os.getenv('AGGREGATION_JOB_TIMEOUT_SECONDS', '1800'))
+AGGREGATION_JOB_RETRIES = int(os.getenv('AGGREGATION_JOB_RETRIES', '2'))
+AGGREGATION_RETRY_BACKOFF_SECONDS = float(os.getenv('AGGREGATION_RETRY_BACKOFF_SECONDS', '10'))
+
+# stream extracts through server-side cursors in chunks of this many rows
+# and load them chunk by chunk; 0 reads every result into memory at once
+AGGREGATION_CHUNK_SIZE = int(os.getenv('AGGREGATION_CHUNK_SIZE', '0'))
+
+# windowed (day/week/month and rolling 7/30-day) aggregates per agent, branch
+# and product, computed from the trailing history days of the daily rollup;
+# rolling values are written for the last AGGREGATION_ROLLING_OUTPUT_DAYS days
+AGGREGATION_WINDOWS = os.getenv('AGGREGATION_WINDOWS', 'false').lower() == 'true'
+AGGREGATION_WINDOW_HISTORY_DAYS = int(os.getenv('AGGREGATION_WINDOW_HISTORY_DAYS', '400'))
+AGGREGATION_ROLLING_OUTPUT_DAYS = int(os.getenv('AGGREGATION_ROLLING_OUTPUT_DAYS', '90'))
+
+# where aggregates are written: "redshift", or "duckdb" for a local database
+# file (optionally mirrored to partitioned Parquet) that needs no warehouse
+AGGREGATION_SINK = os.getenv('AGGREGATION_SINK', 'redshift')
+DUCKDB_PATH = os.getenv('DUCKDB_PATH', 'aggregates.duckdb')
+PARQUET_EXPORT_DIR = os.getenv('PARQUET_EXPORT_DIR')
+
+# aggregate query API: results are cached per query, parameters and data
+# watermark (MAX(transaction_id)); the watermark itself is re-read at most
+# once per refresh interval and entries also expire after the TTL so changes
+# to agents, branches and products show up
+API_HOST = os.getenv('API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('API_PORT', '8002'))
+API_CACHE_SIZE = int(os.getenv('API_CACHE_SIZE', '256'))
+API_CACHE_TTL_SECONDS = float(os.getenv('API_CACHE_TTL_SECONDS', '300'))
+API_WATERMARK_REFRESH_SECONDS = float(os.getenv('API_WATERMARK_REFRESH_SECONDS', '1'))
+
+# JSON run report of every aggregation run (wall time, DB and pandas time,
+# rows and bytes per phase, peak RSS); written to AGGREGATION_REPORT_PATH when
+# set, always logged, and POSTed to METRICS_PUSH_URL when set
+AGGREGATION_REPORT_PATH = os.getenv('AGGREGATION_REPORT_PATH')
+METRICS_PUSH_URL = os.getenv('METRICS_PUSH_URL')
+
+# sharded runs: AGGREGATION_SHARD_COUNT pods each aggregate the agents whose
+# id falls into their shard's range and write partials; the shard index defaults to
+# JOB_COMPLETION_INDEX, which Kubernetes sets in Indexed Jobs. A run with
+# AGGREGATION_REDUCE waits up to AGGREGATION_REDUCE_WAIT_SECONDS for all
+# shards, then merges their partials into the aggregates
+AGGREGATION_SHARD_COUNT = int(os.getenv('AGGREGATION_SHARD_COUNT', '1'))
+AGGREGATION_SHARD_INDEX = int(os.getenv('AGGREGATION_SHARD_INDEX', os.getenv('JOB_COMPLETION_INDEX', '0')))
+AGGREGATION_REDUCE = os.getenv('AGGREGATION_REDUCE', 'false').lower() == 'true'
+AGGREGATION_REDUCE_WAIT_SECONDS = float(os.getenv('AGGREGATION_REDUCE_WAIT_SECONDS', '3600'))
+AGGREGATION_REDUCE_POLL_SECONDS = float(os.getenv('AGGREGATION_REDUCE_POLL_SECONDS', '30'))
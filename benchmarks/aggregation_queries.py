@@ -0,0 +1,91 @@
+"""Timings of the aggregation queries against a live RDS/MySQL database.
+
+Run it once before and once after partitioning sales_transaction and compare
+the two reports:
+
+    python -m benchmarks.aggregation_queries --label before --output before.json
+    python -m agent.app.models.partition_sales migrate
+    python -m benchmarks.aggregation_queries --label after --output after.json
+    python -m benchmarks.aggregation_queries --compare before.json after.json
+"""
+import argparse
+import json
+import statistics
+import time
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from aggregation.app.sps.rds_provider import get_best_performing_teams, get_top_products, \
+    get_branch_performance
+from aggregation.configs import DB_STRING
+
+# date-bounded lookups that can use partition pruning and the covering indexes
+RECENT_SALES_BY_AGENT = """
+    SELECT s.agent_id, SUM(s.sale_amount) AS total_sales
+    FROM sales_transaction s
+    WHERE s.sale_date >= NOW() - INTERVAL 30 DAY
+    GROUP BY s.agent_id
+"""
+AGENT_SALES_IN_MONTH = """
+    SELECT SUM(s.sale_amount) AS total_sales
+    FROM sales_transaction s
+    WHERE s.agent_id = (SELECT agent_id FROM agent LIMIT 1)
+        AND s.sale_date >= DATE_FORMAT(NOW(), '%Y-%m-01')
+"""
+
+
+def time_call(function, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return {"median_seconds": statistics.median(samples), "min_seconds": min(samples)}
+
+
+def run(db_url: str, repeat: int) -> dict:
+    engine = create_engine(db_url)
+    session = sessionmaker(bind=engine)()
+    try:
+        queries = {
+            "best_performing_teams": lambda: get_best_performing_teams(session),
+            "top_products": lambda: get_top_products(session),
+            "branch_performance": lambda: get_branch_performance(session),
+            "recent_sales_by_agent": lambda: session.execute(text(RECENT_SALES_BY_AGENT)).fetchall(),
+            "agent_sales_in_month": lambda: session.execute(text(AGENT_SALES_IN_MONTH)).fetchall(),
+        }
+        return {name: time_call(query, repeat) for name, query in queries.items()}
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def compare(before: dict, after: dict) -> dict:
+    return {
+        name: {
+            "before_seconds": before["queries"][name]["median_seconds"],
+            "after_seconds": after["queries"][name]["median_seconds"],
+            "speedup": before["queries"][name]["median_seconds"]
+            / max(after["queries"][name]["median_seconds"], 1e-9),
+        }
+        for name in before["queries"] if name in after["queries"]
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the aggregation queries.")
+    parser.add_argument("--db-url", default=DB_STRING)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--output")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before_file, open(args.compare[1]) as after_file:
+            report = compare(json.load(before_file), json.load(after_file))
+    else:
+        report = {"label": args.label, "queries": run(args.db_url, args.repeat)}
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(report, output_file, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,82 @@
+"""Accuracy and size of the HyperLogLog sketches in aggregation.app.sps.sketches.
+
+For every precision and cardinality a set of random ids is sketched, the
+estimate is compared to the true count, and the serialised size is reported.
+The ids are also split into daily partials whose merged sketch must equal
+the sketch of the whole set:
+
+    python -m benchmarks.hll_accuracy
+    python -m benchmarks.hll_accuracy --precisions 10 12 14 --cardinalities 100 10000 1000000
+"""
+import argparse
+import json
+import time
+import uuid
+import numpy as np
+from aggregation.app.sps.sketches import group_registers, estimate_registers, serialize_registers, \
+    merge_sketches, estimate_sketch
+
+
+def random_ids(count: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return np.array([str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(count)], dtype=object)
+
+
+def sketch(values, precision: int) -> str:
+    registers = group_registers(np.zeros(len(values), dtype=np.int64), 1, values, precision)
+    return serialize_registers(registers[0])
+
+
+def measure(precision: int, cardinality: int, trials: int, partials: int) -> dict:
+    errors = []
+    sizes = []
+    build_seconds = 0.0
+    merge_exact = True
+    for trial in range(trials):
+        ids = random_ids(cardinality, seed=trial)
+        start = time.perf_counter()
+        whole = sketch(ids, precision)
+        build_seconds += time.perf_counter() - start
+        errors.append((estimate_sketch(whole) - cardinality) / cardinality)
+        sizes.append(len(whole))
+
+        # overlapping daily partials: every id shows up on one or two days
+        days = np.random.default_rng(trial).integers(0, partials, size=(2, cardinality))
+        daily = [sketch(np.concatenate([ids[days[0] == day], ids[days[1] == day]]), precision)
+                 for day in range(partials)]
+        merged = merge_sketches(daily)
+        merge_exact = merge_exact and merged == whole
+
+    errors = np.array(errors)
+    return {
+        "precision": precision,
+        "registers": 1 << precision,
+        "cardinality": cardinality,
+        "expected_std_error": 1.04 / np.sqrt(1 << precision),
+        "mean_relative_error": float(np.mean(errors)),
+        "rms_relative_error": float(np.sqrt(np.mean(errors ** 2))),
+        "max_abs_relative_error": float(np.max(np.abs(errors))),
+        "serialized_bytes": int(np.mean(sizes)),
+        "raw_register_bytes": 1 << precision,
+        "build_seconds": build_seconds / trials,
+        "merged_partials_equal_whole": merge_exact,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HyperLogLog accuracy/size trade-off.")
+    parser.add_argument("--precisions", type=int, nargs="+", default=[8, 10, 12, 14])
+    parser.add_argument("--cardinalities", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--partials", type=int, default=7)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    report = [
+        measure(precision, cardinality, args.trials, args.partials)
+        for precision in args.precisions for cardinality in args.cardinalities
+    ]
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,97 @@
+"""Throughput of the multi-worker serving mode as the worker count grows.
+
+For every worker count the API is started through its ``serve`` entry point,
+hammered by a pool of keep-alive HTTP clients for a fixed duration and then
+stopped with SIGTERM, so the graceful drain path runs as well:
+
+    python -m benchmarks.serving_throughput --app agent --workers 1 2 4 --path /branch/<id>/detail
+"""
+import argparse
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_until_ready(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/healthz")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not become ready")
+
+
+def hammer(port: int, path: str, duration: float, clients: int) -> dict:
+    """Send requests from several keep-alive clients and count responses."""
+    counts = [0] * clients
+    errors = [0] * clients
+    deadline = time.monotonic() + duration
+
+    def client(index):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        while time.monotonic() < deadline:
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+                if response.status < 500:
+                    counts[index] += 1
+                else:
+                    errors[index] += 1
+            except OSError:
+                errors[index] += 1
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {"requests": sum(counts), "errors": sum(errors), "rps": sum(counts) / duration}
+
+
+def run(app: str, worker_counts: list, path: str, duration: float, clients: int, port: int) -> list:
+    results = []
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    for workers in worker_counts:
+        server = subprocess.Popen(
+            [sys.executable, "-m", f"{app}.app.serve", "--workers", str(workers),
+             "--host", "127.0.0.1", "--port", str(port)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            wait_until_ready(port)
+            result = hammer(port, path, duration, clients)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+        result["workers"] = workers
+        results.append(result)
+    baseline = results[0]["rps"] or 1
+    for result in results:
+        result["speedup"] = result["rps"] / baseline
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure API throughput per worker count.")
+    parser.add_argument("--app", default="agent", choices=["agent", "intergration"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--path", default="/openapi.json")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.app, args.workers, args.path, args.duration, args.clients, args.port), indent=2))
@@ -0,0 +1,71 @@
+"""Cold-start benchmark for the agent and integration APIs.
+
+Every sample imports the app module in a fresh interpreter, which is what an
+autoscaled pod or a new worker process pays before it can serve. The script
+exits non-zero when the median import time of any app goes over the budget,
+so it can be used as a CI gate:
+
+    python -m benchmarks.startup_time --repeat 10 --budget 1.5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_MODULES = ["agent.app.main", "intergration.app.main"]
+STARTUP_IMPORT_BUDGET_SECONDS = float(os.getenv('STARTUP_IMPORT_BUDGET_SECONDS', '2.0'))
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+import sys
+heavy = [name for name in ("pandas", "boto3") if name in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def measure_import(module: str) -> tuple:
+    """Import a module in a fresh interpreter and return the elapsed
+    - seconds and the heavy modules it pulled in."""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+        capture_output=True, text=True, env=env, check=True
+    )
+    elapsed, _, heavy = result.stdout.strip().splitlines()[-1].partition(" ")
+    return float(elapsed), [name for name in heavy.split(",") if name]
+
+
+def run(repeat: int, budget: float) -> dict:
+    report = {"budget_seconds": budget, "apps": {}}
+    for module in APP_MODULES:
+        samples = []
+        heavy = []
+        for _ in range(repeat):
+            elapsed, heavy = measure_import(module)
+            samples.append(elapsed)
+        report["apps"][module] = {
+            "median_seconds": statistics.median(samples),
+            "max_seconds": max(samples),
+            "heavy_imports": heavy,
+            "within_budget": statistics.median(samples) <= budget,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure API import time.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=STARTUP_IMPORT_BUDGET_SECONDS,
+                        help="maximum median import time in seconds")
+    args = parser.parse_args()
+
+    report = run(args.repeat, args.budget)
+    print(json.dumps(report, indent=2))
+    if not all(app["within_budget"] for app in report["apps"].values()):
+        sys.exit(1)
@@ -0,0 +1,106 @@
+"""Table size and key lookup latency report for the BINARY(16) uuid migration.
+
+Take a snapshot before and after running agent.app.models.migrate_uuid_binary
+and compare them:
+
+    python -m benchmarks.uuid_storage_report --label char36 --output before.json
+    python -m benchmarks.uuid_storage_report --label binary16 --output after.json
+    python -m benchmarks.uuid_storage_report --compare before.json after.json
+"""
+import argparse
+import json
+import statistics
+import time
+from sqlalchemy import create_engine, text
+from agent.app.models.migrate_uuid_binary import UUID_COLUMNS
+from agent.configs import DB_STRING
+
+LOOKUPS = {
+    "agent_by_pk": ("SELECT agent_id FROM agent ORDER BY RAND() LIMIT :n",
+                    "SELECT * FROM agent WHERE agent_id = :id"),
+    "sales_by_agent": ("SELECT agent_id FROM agent ORDER BY RAND() LIMIT :n",
+                       "SELECT COUNT(*), SUM(sale_amount) FROM sales_transaction WHERE agent_id = :id"),
+    "permissions_by_agent": ("SELECT agent_id FROM agent ORDER BY RAND() LIMIT :n",
+                             "SELECT product_id FROM product_permission WHERE agent_id = :id"),
+}
+
+
+def table_sizes(connection) -> dict:
+    # refresh the statistics so data/index lengths reflect the current layout
+    for table in UUID_COLUMNS:
+        connection.execute(text(f"ANALYZE TABLE {table}"))
+    rows = connection.execute(text("""
+        SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE()
+    """)).fetchall()
+    return {
+        name: {"rows": table_rows, "data_bytes": data_length, "index_bytes": index_length}
+        for name, table_rows, data_length, index_length in rows if name in UUID_COLUMNS
+    }
+
+
+def lookup_latency(connection, samples: int) -> dict:
+    report = {}
+    for name, (sample_query, lookup_query) in LOOKUPS.items():
+        ids = [row[0] for row in connection.execute(text(sample_query), {"n": samples}).fetchall()]
+        timings = []
+        for key in ids:
+            start = time.perf_counter()
+            connection.execute(text(lookup_query), {"id": key}).fetchall()
+            timings.append(time.perf_counter() - start)
+        if timings:
+            timings.sort()
+            report[name] = {
+                "median_ms": statistics.median(timings) * 1000,
+                "p95_ms": timings[int(len(timings) * 0.95) - 1] * 1000,
+            }
+    return report
+
+
+def compare(before: dict, after: dict) -> dict:
+    sizes = {}
+    for table, size in before["tables"].items():
+        if table not in after["tables"]:
+            continue
+        old_bytes = size["data_bytes"] + size["index_bytes"]
+        new_bytes = after["tables"][table]["data_bytes"] + after["tables"][table]["index_bytes"]
+        sizes[table] = {
+            "before_bytes": old_bytes,
+            "after_bytes": new_bytes,
+            "saved_percent": 100 * (old_bytes - new_bytes) / old_bytes if old_bytes else 0,
+        }
+    latency = {
+        name: {
+            "before_median_ms": before["lookups"][name]["median_ms"],
+            "after_median_ms": after["lookups"][name]["median_ms"],
+        }
+        for name in before["lookups"] if name in after["lookups"]
+    }
+    return {"tables": sizes, "lookups": latency}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report uuid key storage and lookup cost.")
+    parser.add_argument("--db-url", default=DB_STRING)
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--output")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before_file, open(args.compare[1]) as after_file:
+            report = compare(json.load(before_file), json.load(after_file))
+    else:
+        engine = create_engine(args.db_url)
+        with engine.connect() as connection:
+            report = {
+                "label": args.label,
+                "tables": table_sizes(connection),
+                "lookups": lookup_latency(connection, args.samples),
+            }
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(report, output_file, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,163 @@
+"""Request and SQL timing shared by the agent and intergration APIs.
+
+Each service installs the middleware on its app and the engine hooks on its
+engine, passing its own slow query threshold.
+"""
+import contextvars
+import json
+import logging
+import time
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger(f"{__name__}.slow_query")
+
+
+class RequestTimings:
+    """Database time accumulated for one request: statements, commits and
+    - the opening of new connections."""
+    __slots__ = ("db_time", "query_count", "commit_time", "connect_time")
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.query_count = 0
+        self.commit_time = 0.0
+        self.connect_time = 0.0
+
+
+# set by the middleware, read by the engine hooks of the same request
+_current_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def redact_parameters(parameters):
+    """Keep the shape of statement parameters but drop their values."""
+    if isinstance(parameters, dict):
+        return {key: "?" for key in parameters}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany: report the row count and the shape of one row
+            return {"rows": len(parameters), "row": redact_parameters(parameters[0])}
+        return ["?"] * len(parameters)
+    return "?" if parameters is not None else None
+
+
+def install_sql_timing(engine, slow_query_threshold_ms: float):
+    """Time every statement, commit and new connection of the engine.
+
+    The time is added to the current request's timings, and statements slower
+    than the threshold are written to the slow query log with their
+    parameters redacted. The commit event fires before the commit is sent,
+    so it marks the start and the dialect's commit call the end.
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.db_time += elapsed
+            timings.query_count += 1
+        if elapsed * 1000 >= slow_query_threshold_ms:
+            slow_query_logger.warning(json.dumps({
+                "event": "slow_query",
+                "duration_ms": round(elapsed * 1000, 2),
+                "statement": statement,
+                "parameters": redact_parameters(parameters),
+                "executemany": executemany,
+            }))
+
+    @event.listens_for(engine, "commit")
+    def commit(conn):
+        conn.info["commit_start_time"] = time.perf_counter()
+
+    do_commit = engine.dialect.do_commit
+
+    def timed_do_commit(dbapi_connection):
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            started = dbapi_connection.info.pop("commit_start_time", None)
+            timings = _current_timings.get()
+            if started is not None and timings is not None:
+                timings.commit_time += time.perf_counter() - started
+
+    engine.dialect.do_commit = timed_do_commit
+
+    @event.listens_for(engine, "do_connect")
+    def do_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info["connect_start_time"] = time.perf_counter()
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        started = connection_record.info.pop("connect_start_time", None)
+        timings = _current_timings.get()
+        if started is not None and timings is not None:
+            timings.connect_time += time.perf_counter() - started
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_start_time"):
+            connection.info["query_start_time"].pop()
+
+
+class RequestTimingMiddleware:
+    """ASGI middleware recording the wall time of each request.
+
+    The response carries the request's statement time and count in
+    ``X-DB-Time-Ms`` / ``X-DB-Query-Count`` and a ``Server-Timing`` header
+    splitting the total into opening database connections, statements,
+    commits and application (validation, serialisation, business logic)
+    time.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        start = time.perf_counter()
+        response_status = None
+
+        async def send_with_timings(message):
+            nonlocal response_status
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+                total_ms = (time.perf_counter() - start) * 1000
+                db_ms = timings.db_time * 1000
+                commit_ms = timings.commit_time * 1000
+                connect_ms = timings.connect_time * 1000
+                app_ms = total_ms - db_ms - commit_ms - connect_ms
+                headers = MutableHeaders(scope=message)
+                headers.append("X-DB-Time-Ms", f"{db_ms:.2f}")
+                headers.append("X-DB-Query-Count", str(timings.query_count))
+                headers.append(
+                    "Server-Timing",
+                    f"connect;dur={connect_ms:.2f}, db;dur={db_ms:.2f}, commit;dur={commit_ms:.2f}, "
+                    f"app;dur={app_ms:.2f}, total;dur={total_ms:.2f}"
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _current_timings.reset(token)
+            logger.info(json.dumps({
+                "event": "request",
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": response_status,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                "db_time_ms": round(timings.db_time * 1000, 2),
+                "query_count": timings.query_count,
+                "commit_ms": round(timings.commit_time * 1000, 2),
+                "connect_ms": round(timings.connect_time * 1000, 2),
+            }))
@@ -1,29 +1,54 @@
 import sys
 sys.path.append('/home/kosala/git-repos/moon_agent_tracker_test/')
 from fastapi import APIRouter
-from intergration.app.models.dtos import IngesionRequest
+from intergration.app.models.dtos import IngesionRequest, ArchiveRequest, SalesRecord
 from fastapi import Body
 from pydantic import BaseModel
 from typing import Annotated
 from intergration.app.db_repository.sql_repository import SQLRepository, DatabaseOperationException \
     , DataNotFoundException
 from intergration.app.services.service import IntergrationService
+from intergration.app.services.archive_service import SalesArchiveService
+from intergration.app.services.event_ingestion import LocalQueueSource
 from intergration.app.s3_repository.s3_service import S3Service, S3ServiceException
-from intergration.configs import DB_STRING
-from fastapi import HTTPException, status
+from fastapi import HTTPException, status, Depends, Request, Query
+from typing import Dict, List, Optional
+from datetime import date
+from intergration.configs import SALES_PAGE_SIZE, SALES_MAX_PAGE_SIZE
 
 router = APIRouter()
-db_repository = SQLRepository(database_url=DB_STRING)
-s3_repository = S3Service()
-# injecting the db and s3 repository into the service
-intergration_service = IntergrationService(
-    db_adapter=db_repository,
-    s3_adapter=s3_repository
-)
-    
+
+def get_intergration_service(request: Request) -> IntergrationService:
+    """Dependency returning the service created by the app lifespan."""
+    return request.app.state.intergration_service
+
+def get_archive_service(request: Request) -> SalesArchiveService:
+    """Dependency returning the archive service created by the app lifespan."""
+    return request.app.state.archive_service
+
 class IngetionResponse(BaseModel):
     message: str
     ingestion: str
+    loaded_files: List[str] = []
+    skipped_files: List[str] = []
+    # file key -> error of the files that failed, the others were still ingested
+    failed_files: Dict[str, str] = {}
+
+class EventsResponse(BaseModel):
+    message: str
+    queued_files: int
+
+class ArchiveResponse(BaseModel):
+    message: str
+    archived_rows: int
+    files: List[str]
+
+class SalesResponse(BaseModel):
+    start_date: date
+    end_date: date
+    sales: List[SalesRecord]
+    # pass as after_transaction_id to get the next page, None on the last page
+    next_after_transaction_id: Optional[int] = None
 
 class ErrorResponse(BaseModel):
     detail: str
@@ -40,7 +65,8 @@ class ErrorResponse(BaseModel):
         providing the required details.",
     tags=["Ingesion"]
 )
-async def ingest_data(ingest_request: IngesionRequest):
+async def ingest_data(ingest_request: IngesionRequest,
+                      intergration_service: IntergrationService = Depends(get_intergration_service)):
     """Controller function to create an agent.
     
     Args:
@@ -52,17 +78,15 @@ async def ingest_data(ingest_request: IngesionRequest):
     """
     try:
         # Call the repository function to save the agent
-        success = intergration_service.fetch_data(ingest_request.model_dump())
-        if success:
-            return {
-                "message": "Sales data ingested successfully.",
-                "ingestion": "success"
-            }
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to trigger sales ingestion process."
-            )
+        result = intergration_service.fetch_data(ingest_request.model_dump())
+        return {
+            "message": "Some sales files failed to ingest." if result["failed"]
+            else "Sales data ingested successfully.",
+            "ingestion": "partial" if result["failed"] else "success",
+            "loaded_files": result["loaded"],
+            "skipped_files": result["skipped"],
+            "failed_files": result["failed"]
+        }
     except DatabaseOperationException as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -79,3 +103,134 @@ async def ingest_data(ingest_request: IngesionRequest):
             detail=f"An unexpected error occurred: {str(e)}"
         )
 
+@router.post(
+    "/intergration/events",
+    response_model=EventsResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={
+        202: {"description": "Files of the notification queued for ingestion", "model": EventsResponse},
+        400: {"description": "Invalid notification", "model": ErrorResponse},
+        409: {"description": "The local event queue is not enabled", "model": ErrorResponse},
+    },
+    summary="New file notification",
+    description="This endpoint accepts an S3 event notification and queues its new \
+        files for ingestion, when INGESTION_EVENT_SOURCE is \"queue\".",
+    tags=["Ingesion"]
+)
+async def notify_files(request: Request, notification: Annotated[dict, Body()]):
+    worker = request.app.state.event_worker
+    if worker is None or not isinstance(worker.source, LocalQueueSource):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The local event queue is not enabled."
+        )
+    try:
+        queued_files = worker.source.publish(notification)
+    except (KeyError, TypeError, AttributeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid S3 event notification: {str(e)}"
+        )
+    return {
+        "message": "Files queued for ingestion.",
+        "queued_files": queued_files
+    }
+
+@router.post(
+    "/intergration/archive_sales",
+    response_model=ArchiveResponse,
+    responses={
+        200: {"description": "Old sales archived successfully", "model": ArchiveResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Archive old sales transactions",
+    description="This endpoint moves sales transactions older than the retention \
+        window into compressed, month-partitioned Parquet files.",
+    tags=["Archive"]
+)
+def archive_sales(archive_request: ArchiveRequest,
+                  archive_service: SalesArchiveService = Depends(get_archive_service)):
+    # a plain def: FastAPI runs it in its threadpool, so the long, blocking
+    # archive job does not stall the event loop and every other request
+    try:
+        if archive_request.retention_days is not None:
+            result = archive_service.archive(retention_days=archive_request.retention_days)
+        else:
+            result = archive_service.archive()
+        return {
+            "message": "Sales transactions archived successfully.",
+            "archived_rows": result["archived_rows"],
+            "files": result["files"]
+        }
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except S3ServiceException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"S3 error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.get(
+    "/intergration/sales",
+    response_model=SalesResponse,
+    responses={
+        200: {"description": "Sales transactions in the date range", "model": SalesResponse},
+        400: {"description": "Invalid date range", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse},
+    },
+    summary="Get sales transactions",
+    description="This endpoint returns the sales transactions of a date range, \
+        reading archived dates from cold storage transparently. Sales are returned \
+        in pages ordered by transaction id; pass next_after_transaction_id of a \
+        page as after_transaction_id to get the next one.",
+    tags=["Archive"]
+)
+def get_sales(start_date: date, end_date: date, after_transaction_id: Optional[int] = None,
+              limit: int = Query(SALES_PAGE_SIZE, ge=1, le=SALES_MAX_PAGE_SIZE),
+              archive_service: SalesArchiveService = Depends(get_archive_service)):
+    if start_date > end_date:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="start_date must not be after end_date."
+        )
+    try:
+        sales = archive_service.get_sales(start_date, end_date, after_transaction_id, limit)
+        return {
+            "start_date": start_date,
+            "end_date": end_date,
+            "next_after_transaction_id": int(sales['transaction_id'].iloc[-1]) if len(sales) == limit else None,
+            "sales": [
+                SalesRecord(
+                    transaction_id=int(row.transaction_id),
+                    agent_id=row.agent_id,
+                    product_id=row.product_id,
+                    sale_amount=row.sale_amount,
+                    sale_date=row.sale_date,
+                    core_reference_id=row.core_reference_id
+                )
+                for row in sales.itertuples(index=False)
+            ]
+        }
+    except DatabaseOperationException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    except S3ServiceException as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"S3 error: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
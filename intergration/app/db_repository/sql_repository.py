@@ -1,8 +1,14 @@
-from sqlalchemy import create_engine
+from datetime import timedelta
+from sqlalchemy import create_engine, select, func, update, or_, and_, case, literal_column
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.orm import sessionmaker, declarative_base
 from intergration.app.models.dtos import Agent, AgentUpdate, Product, ProductUpdate
-from intergration.app.models.db_models import Agent as DBAgent, FileHash as DBFileHash
+from intergration.app.models.db_models import Agent as DBAgent, FileHash as DBFileHash, \
+    FileLease as DBFileLease
 from intergration.app.models.db_models import Product as DBProduct
+from intergration.app.models.db_models import SalesDailyRollup as DBSalesDailyRollup, \
+    SalesTransaction as DBSalesTransaction
+from intergration.configs import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_ECHO
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 
@@ -18,13 +24,21 @@ class DataNotFoundException(Exception):
     def __init__(self, message):
         super().__init__(message)
 
+class LeaseLostException(Exception):
+    """Raised when a worker no longer owns the lease of the file it processed."""
+    def __init__(self, message):
+        super().__init__(message)
+
 class SQLRepository:
     def __init__(self, database_url):
         """
         Initialize the SQLRepository with a database URL.
         This will create the database engine and session factory.
         """
-        self.engine = create_engine(database_url, echo=True)
+        self.engine = create_engine(
+            database_url, echo=DB_ECHO,
+            pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True
+        )
         self.Session = sessionmaker(bind=self.engine)
 
     def create_tables(self):
@@ -35,6 +49,10 @@ class SQLRepository:
 
     def get_session(self):
         return self.Session()
+
+    def dispose(self):
+        """Close every pooled connection, used when a worker shuts down."""
+        self.engine.dispose()
     
     def get_db_engine(self):
         """Get the database engine.
@@ -134,7 +152,230 @@ class SQLRepository:
         finally:
             session.close()
         return output
+
+    def upsert_sales_daily_rollup(self, connection, rollup_rows: list):
+        """Add freshly ingested sales to the daily rollup table.
+        
+        Args:
+            connection: Connection of the transaction that inserts the raw 
+            sales rows, so both commit or roll back together.
+            rollup_rows (list): Dicts with agent_id, sale_day, product_id, 
+            total_sales and transaction_count.
+        
+        Raises:
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        if not rollup_rows:
+            return
+        try:
+            statement = mysql_insert(DBSalesDailyRollup.__table__).values(rollup_rows)
+            statement = statement.on_duplicate_key_update(
+                total_sales=DBSalesDailyRollup.total_sales + statement.inserted.total_sales,
+                transaction_count=DBSalesDailyRollup.transaction_count + statement.inserted.transaction_count
+            )
+            connection.execute(statement)
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while updating sales rollup: {e}")
+
+    def rebuild_sales_daily_rollup(self, start_date=None, end_date=None):
+        """Recompute the daily rollup from the raw sales, for backfills 
+        - and corrections. The rollup rows of the rebuilt range are deleted 
+        - and recomputed in one transaction, so days without sales left lose 
+        - their rows. Days before the oldest live sale have been archived 
+        - (see archive_service.py) and are left as they are.
+        
+        Args:
+            start_date (date): First day to rebuild, all history when None.
+            end_date (date): Last day to rebuild, up to today when None.
+        
+        Raises:
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        rollup = DBSalesDailyRollup.__table__
+        try:
+            with self.engine.begin() as connection:
+                oldest_sale = connection.execute(select(func.min(DBSalesTransaction.sale_date))).scalar()
+                if oldest_sale is None:
+                    return
+                if start_date is None or start_date < oldest_sale.date():
+                    start_date = oldest_sale.date()
+                if end_date is not None and end_date < start_date:
+                    return
+
+                sale_day = func.date(DBSalesTransaction.sale_date)
+                source = select(
+                    DBSalesTransaction.agent_id,
+                    sale_day.label("sale_day"),
+                    DBSalesTransaction.product_id,
+                    func.sum(DBSalesTransaction.sale_amount).label("total_sales"),
+                    func.count(DBSalesTransaction.transaction_id).label("transaction_count")
+                ) \
+                    .where(DBSalesTransaction.sale_date >= start_date) \
+                    .group_by(DBSalesTransaction.agent_id, sale_day, DBSalesTransaction.product_id)
+                stale = rollup.delete().where(rollup.c.sale_day >= start_date)
+                if end_date is not None:
+                    source = source.where(DBSalesTransaction.sale_date < end_date + timedelta(days=1))
+                    stale = stale.where(rollup.c.sale_day <= end_date)
+
+                connection.execute(stale)
+                connection.execute(rollup.insert().from_select(
+                    ["agent_id", "sale_day", "product_id", "total_sales", "transaction_count"], source
+                ))
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while rebuilding sales rollup: {e}")
+
+    def claim_file_lease(self, file_hash: str, file_key: str, owner: str,
+                         lease_seconds: int, max_attempts: int, file_version: str = None) -> bool:
+        """Claim a file for processing by one worker.
+        
+        A file is claimed when nobody has claimed it yet, when the lease of
+        - its previous worker has expired, or when it failed fewer than
+        - max_attempts times. A failed file of another version than the one
+        - attempted was replaced and starts over at its first attempt. Lease
+        - times use the database clock, so the clocks of the worker hosts do
+        - not matter.
+        
+        Args:
+            file_hash (str): Hash identifying the file, as in file_hash.
+            file_key (str): Key of the file in the bucket, for operators.
+            owner (str): Id of the claiming worker.
+            lease_seconds (int): How long the claim lasts without a heartbeat.
+            max_attempts (int): Attempts after which a failed file is left alone.
+            file_version (str): Modification time and size, or ETag, of the
+            file; None when unknown, which never counts as a replacement.
+        
+        Returns:
+            bool: True if this worker now owns the file.
+        
+        Raises:
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        table = DBFileLease.__table__
+        expires_at = func.timestampadd(literal_column("SECOND"), lease_seconds, func.now())
+        try:
+            with self.engine.begin() as connection:
+                # the primary key makes the first claim atomic
+                inserted = connection.execute(
+                    mysql_insert(table).prefix_with("IGNORE").values(
+                        file_hash=file_hash, file_key=file_key, owner=owner, status="PROCESSING",
+                        attempts=1, file_version=file_version, lease_expires_at=expires_at
+                    )
+                )
+                if inserted.rowcount == 1:
+                    return True
+                retriable = table.c.attempts < max_attempts
+                attempts = table.c.attempts + 1
+                if file_version is not None:
+                    replaced = table.c.file_version.is_distinct_from(file_version)
+                    retriable = or_(retriable, replaced)
+                    attempts = case((replaced, 1), else_=attempts)
+                # the row lock lets only one worker take over an expired or failed file
+                taken_over = connection.execute(
+                    update(table)
+                    .where(table.c.file_hash == file_hash)
+                    .where(or_(
+                        and_(table.c.status == "PROCESSING", table.c.lease_expires_at < func.now()),
+                        and_(table.c.status == "FAILED", retriable)
+                    ))
+                    .values(owner=owner, status="PROCESSING", attempts=attempts,
+                            file_version=func.coalesce(file_version, table.c.file_version),
+                            lease_expires_at=expires_at)
+                )
+                return taken_over.rowcount == 1
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while claiming file lease: {e}")
+
+    def get_file_lease(self, file_hash: str):
+        """Status and attempts of the lease of a file, None if it has none.
         
+        Raises:
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        table = DBFileLease.__table__
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(
+                    select(table.c.status, table.c.attempts).where(table.c.file_hash == file_hash)
+                ).first()
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while reading file lease: {e}")
+
+    def renew_file_lease(self, file_hash: str, owner: str, lease_seconds: int) -> bool:
+        """Extend a lease this worker holds (heartbeat).
         
+        Returns:
+            bool: False if the lease was lost to another worker.
         
+        Raises:
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        table = DBFileLease.__table__
+        try:
+            with self.engine.begin() as connection:
+                result = connection.execute(
+                    update(table)
+                    .where(table.c.file_hash == file_hash)
+                    .where(table.c.owner == owner)
+                    .where(table.c.status == "PROCESSING")
+                    .values(lease_expires_at=func.timestampadd(
+                        literal_column("SECOND"), lease_seconds, func.now()
+                    ))
+                )
+                return result.rowcount == 1
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while renewing file lease: {e}")
 
+    def complete_file_lease(self, connection, file_hash: str, owner: str):
+        """Mark a leased file processed inside the transaction that loads it.
+        
+        The lease row stays locked until that transaction ends, so no other
+        - worker can take the file over while its rows are written, and the
+        - rows are rolled back if the lease had already been taken over.
+        
+        Args:
+            connection: Connection of the transaction that loads the file.
+        
+        Raises:
+            LeaseLostException: If another worker owns the file by now.
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        table = DBFileLease.__table__
+        try:
+            result = connection.execute(
+                update(table)
+                .where(table.c.file_hash == file_hash)
+                .where(table.c.owner == owner)
+                .where(table.c.status == "PROCESSING")
+                .values(status="DONE", lease_expires_at=None, last_error=None)
+            )
+            if result.rowcount != 1:
+                raise LeaseLostException(f"Lease of file {file_hash} was taken over by another worker")
+            connection.execute(DBFileHash.__table__.insert().values(file_hash=file_hash))
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while completing file lease: {e}")
+
+    def release_file_lease(self, file_hash: str, owner: str, error: str = None):
+        """Give up a lease after a failed attempt, so the file can be retried.
+        
+        Raises:
+            DatabaseOperationException: If there is an error during 
+            the database operation.
+        """
+        table = DBFileLease.__table__
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    update(table)
+                    .where(table.c.file_hash == file_hash)
+                    .where(table.c.owner == owner)
+                    .where(table.c.status == "PROCESSING")
+                    .values(status="FAILED", lease_expires_at=None, last_error=error)
+                )
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while releasing file lease: {e}")
@@ -1,7 +1,52 @@
 import sys
 sys.path.append("/home/kosala/git-repos/moon_agent_tracker_test/")
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from intergration.app.controllers.controller import router
+from intergration.app.db_repository.sql_repository import SQLRepository
+from common.timing import RequestTimingMiddleware, install_sql_timing
+from intergration.app.s3_repository.s3_service import S3Service
+from intergration.app.services.service import IntergrationService
+from intergration.app.services.archive_service import SalesArchiveService
+from intergration.app.services.event_ingestion import EventIngestionWorker, get_event_source
+from intergration.configs import DB_STRING, INGESTION_EVENT_SOURCE, GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS, \
+    SLOW_QUERY_THRESHOLD_MS
 
-app = FastAPI()
-app.include_router(router)
\ No newline at end of file
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the database engine and S3 client when the app starts serving,
+    not at import time, so workers never inherit them across fork."""
+    db_repository = SQLRepository(database_url=DB_STRING)
+    install_sql_timing(db_repository.engine, SLOW_QUERY_THRESHOLD_MS)
+    s3_repository = S3Service()
+    # injecting the db and s3 repository into the service
+    app.state.intergration_service = IntergrationService(
+        db_adapter=db_repository,
+        s3_adapter=s3_repository
+    )
+    app.state.archive_service = SalesArchiveService(
+        db_adapter=db_repository,
+        s3_adapter=s3_repository
+    )
+    # with an event source configured, files are also ingested as they arrive
+    app.state.event_worker = None
+    if INGESTION_EVENT_SOURCE:
+        app.state.event_worker = EventIngestionWorker(
+            app.state.intergration_service, get_event_source(INGESTION_EVENT_SOURCE)
+        )
+        app.state.event_worker.start()
+    yield
+    if app.state.event_worker is not None:
+        app.state.event_worker.stop(GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS)
+    # uvicorn has already drained in-flight requests at this point
+    db_repository.dispose()
+    s3_repository.close()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestTimingMiddleware)
+app.include_router(router)
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"status": "ok"}
@@ -1,6 +1,7 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import Optional, List
 from datetime import datetime
+from decimal import Decimal
 from uuid import UUID
 
 class IngesionRequest(BaseModel):
@@ -8,6 +9,19 @@ class IngesionRequest(BaseModel):
     file_path: str
     archive_path: Optional[str] = None
     
+
+class ArchiveRequest(BaseModel):
+    retention_days: Optional[int] = None
+
+
+class SalesRecord(BaseModel):
+    transaction_id: int
+    agent_id: str
+    product_id: str
+    sale_amount: Decimal
+    sale_date: datetime
+    core_reference_id: str
+    
     
 ## models of the agent
 class Agent(BaseModel):
@@ -1,5 +1,3 @@
-import boto3
-from botocore.exceptions import ClientError
 from typing import Optional, Dict, Any
 
 class S3ServiceException(Exception):
@@ -8,7 +6,15 @@ class S3ServiceException(Exception):
 
 class S3Service:
     def __init__(self):
+        # boto3 is slow to import, load it only when a client is created
+        import boto3
         self.s3_client = boto3.client('s3')
+
+    def close(self):
+        """Release the client's HTTP connection pool."""
+        close = getattr(self.s3_client, "close", None)
+        if close is not None:
+            close()
         
     def list_files(self, bucket_name: str, file_path: str, strip_prefix: bool = False) -> list:
         """
@@ -22,6 +28,8 @@ class S3Service:
         Returns:
             List of file keys in the directory, excluding the directory itself
         """
+        # loaded with boto3 by __init__, so importing it here is free
+        from botocore.exceptions import ClientError
         output = []
         try:
             # Ensure file_path ends with a slash if it's meant to be a directory
@@ -51,6 +59,7 @@ class S3Service:
             
     def read_file(self, bucket_name: str, file_key:str) -> Optional[Dict[str, Any]]:
         """Download a file from S3."""
+        from botocore.exceptions import ClientError
         output = {}
         try:
             response = self.s3_client.get_object(Bucket=bucket_name, Key=file_key)
@@ -65,6 +74,7 @@ class S3Service:
     
     def download_file(self, bucket_name: str, file_key:str, local_path:str) -> bool:
         """Download a file from S3 to a local path."""
+        from botocore.exceptions import ClientError
         output = False
         try:
             self.s3_client.download_file(bucket_name, file_key, local_path)
@@ -74,4 +84,18 @@ class S3Service:
         except Exception as e:
             raise S3ServiceException(f"Unexpected error: {e}")
         
-        return output
\ No newline at end of file
+        return output
+    
+    def upload_file(self, bucket_name: str, file_key: str, local_path: str) -> bool:
+        """Upload a local file to S3."""
+        from botocore.exceptions import ClientError
+        output = False
+        try:
+            self.s3_client.upload_file(local_path, bucket_name, file_key)
+            output = True
+        except ClientError as e:
+            raise S3ServiceException(f"Error uploading file {file_key}: {e}")
+        except Exception as e:
+            raise S3ServiceException(f"Unexpected error: {e}")
+        
+        return output
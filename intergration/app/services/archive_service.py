@@ -0,0 +1,237 @@
+import sys
+sys.path.append('/home/kosala/git-repos/moon_agent_tracker_test/')
+from intergration.app.s3_repository.s3_service import S3Service, S3ServiceException
+from intergration.app.db_repository.sql_repository import SQLRepository, DatabaseOperationException
+from intergration.app.models.db_models import SalesTransaction as DBSalesTransaction, \
+    SalesArchivedTotal as DBSalesArchivedTotal
+from intergration.configs import DB_STRING, ARCHIVE_RETENTION_DAYS, ARCHIVE_BATCH_SIZE, \
+    ARCHIVE_COMPRESSION, ARCHIVE_TARGET, ARCHIVE_LOCAL_DIR, ARCHIVE_BUCKET, ARCHIVE_PREFIX, SALES_PAGE_SIZE
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import SQLAlchemyError
+from datetime import date, datetime, timedelta
+import io
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class SalesArchiveService:
+    """Moves old sales transactions to partitioned Parquet files.
+
+    Rows older than the retention window are written in batches to
+    ``year=YYYY/month=MM/part-<first id>-<last id>.parquet`` under a local
+    directory or an S3 prefix, and deleted from sales_transaction once their
+    file is written. File names are derived from the batch, so a batch that
+    is retried after a failed delete simply overwrites its own file.
+
+    The totals of every archived batch are added to sales_archived_total in
+    the transaction that deletes its rows, so the all-time aggregates of
+    aggregation/app/sps/rds_provider.py see each sale exactly once, live or
+    archived, and do not change when sales are archived.
+
+    The daily sales rollup is not archived, so the agent sales history keeps
+    covering archived dates.
+    """
+    def __init__(self, db_adapter: SQLRepository = None, s3_adapter: S3Service = None,
+                 target: str = ARCHIVE_TARGET, local_dir: str = ARCHIVE_LOCAL_DIR,
+                 bucket_name: str = ARCHIVE_BUCKET, prefix: str = ARCHIVE_PREFIX,
+                 compression: str = ARCHIVE_COMPRESSION):
+        self.db_adapter = db_adapter
+        self.s3_adapter = s3_adapter
+        self.target = target
+        self.local_dir = local_dir
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.compression = compression
+
+    def archive(self, retention_days: int = ARCHIVE_RETENTION_DAYS,
+                batch_size: int = ARCHIVE_BATCH_SIZE) -> dict:
+        """Archive every sales transaction older than the retention window.
+
+        Returns:
+            dict: Number of archived rows and written files.
+        """
+        import pandas as pd
+        cutoff = datetime.combine(date.today() - timedelta(days=retention_days), datetime.min.time())
+        table = DBSalesTransaction.__table__
+        engine = self.db_adapter.get_db_engine()
+        archived_rows = 0
+        written_files = []
+        try:
+            while True:
+                batch_query = select(table) \
+                    .where(table.c.sale_date < cutoff) \
+                    .order_by(table.c.transaction_id) \
+                    .limit(batch_size)
+                with engine.connect() as connection:
+                    # keep sale_amount as Decimal so the archive is exact
+                    batch = pd.read_sql(batch_query, connection, coerce_float=False)
+                if batch.empty:
+                    break
+
+                written_files += self.__write_batch(batch)
+
+                first_id = int(batch['transaction_id'].min())
+                last_id = int(batch['transaction_id'].max())
+                # ids are handed out on insert, not on commit: a backdated
+                # sale committing after the read can hold an id inside
+                # first_id-last_id, so only the rows that were written go
+                with engine.begin() as connection:
+                    deleted = connection.execute(
+                        delete(table)
+                        .where(table.c.sale_date < cutoff)
+                        .where(table.c.transaction_id.in_(batch['transaction_id'].tolist()))
+                    ).rowcount
+                    if deleted != len(batch):
+                        # another run archived part of the batch, its totals
+                        # are counted already; roll back and read it again
+                        raise DatabaseOperationException(
+                            f"Expected to archive {len(batch)} sales {first_id}-{last_id}, deleted {deleted}"
+                        )
+                    self.__add_archived_totals(connection, batch)
+                archived_rows += len(batch)
+                logger.info(f"Archived sales transactions {first_id}-{last_id}")
+                if len(batch) < batch_size:
+                    break
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while archiving sales: {e}")
+        return {"archived_rows": archived_rows, "files": written_files}
+
+    def read_archived_sales(self, start_date: date, end_date: date, after_transaction_id: int = None):
+        """Read archived sales with a sale date between two dates (inclusive)
+        - and, if given, a transaction id above after_transaction_id.
+
+        Files only holding lower ids are skipped by their name.
+        """
+        import pandas as pd
+        frames = []
+        month = start_date.replace(day=1)
+        while month <= end_date:
+            for data in self.__read_partition(month.year, month.month, after_transaction_id):
+                frames.append(pd.read_parquet(io.BytesIO(data)))
+            month = (month + timedelta(days=32)).replace(day=1)
+        if not frames:
+            return pd.DataFrame(columns=[column.name for column in DBSalesTransaction.__table__.columns])
+
+        sales = pd.concat(frames, ignore_index=True)
+        sale_day = pd.to_datetime(sales['sale_date']).dt.date
+        selected = (sale_day >= start_date) & (sale_day <= end_date)
+        if after_transaction_id is not None:
+            selected &= sales['transaction_id'] > after_transaction_id
+        return sales[selected]
+
+    def get_sales(self, start_date: date, end_date: date, after_transaction_id: int = None,
+                  limit: int = SALES_PAGE_SIZE):
+        """One page of the sales between two dates (inclusive), read from
+        - the database and, for dates older than the oldest live row, from
+        - the archive.
+
+        Pages are ordered by transaction id; pass the last id of a page as
+        after_transaction_id to get the next one.
+
+        Returns:
+            DataFrame: Up to limit sales.
+        """
+        import pandas as pd
+        table = DBSalesTransaction.__table__
+        engine = self.db_adapter.get_db_engine()
+        query = select(table) \
+            .where(table.c.sale_date >= start_date) \
+            .where(table.c.sale_date < end_date + timedelta(days=1))
+        if after_transaction_id is not None:
+            query = query.where(table.c.transaction_id > after_transaction_id)
+        try:
+            with engine.connect() as connection:
+                oldest_live = connection.execute(select(func.min(table.c.sale_date))).scalar()
+                live = pd.read_sql(
+                    query.order_by(table.c.transaction_id).limit(limit),
+                    connection, coerce_float=False
+                )
+        except SQLAlchemyError as e:
+            raise DatabaseOperationException(f"Database error while reading sales: {e}")
+
+        if oldest_live is not None and start_date >= oldest_live.date():
+            return live
+        archived_end = min(end_date, oldest_live.date()) if oldest_live is not None else end_date
+        archived = self.read_archived_sales(start_date, archived_end, after_transaction_id)
+        sales = pd.concat([archived, live], ignore_index=True)
+        return sales.drop_duplicates(subset='transaction_id').sort_values('transaction_id').head(limit)
+
+    def __add_archived_totals(self, connection, batch):
+        """Add the per-agent/per-product totals of a batch to sales_archived_total."""
+        totals = batch.groupby(['agent_id', 'product_id']) \
+            .agg(total_sales=('sale_amount', 'sum'), transaction_count=('transaction_id', 'count')) \
+            .reset_index()
+        rows = [
+            {"agent_id": agent_id, "product_id": product_id,
+             "total_sales": total_sales, "transaction_count": int(transaction_count)}
+            for agent_id, product_id, total_sales, transaction_count in totals.itertuples(index=False)
+        ]
+        statement = mysql_insert(DBSalesArchivedTotal.__table__).values(rows)
+        statement = statement.on_duplicate_key_update(
+            total_sales=DBSalesArchivedTotal.total_sales + statement.inserted.total_sales,
+            transaction_count=DBSalesArchivedTotal.transaction_count + statement.inserted.transaction_count
+        )
+        connection.execute(statement)
+
+    def __write_batch(self, batch) -> list:
+        import pandas as pd
+        sale_date = pd.to_datetime(batch['sale_date'])
+        written = []
+        for (year, month), rows in batch.groupby([sale_date.dt.year, sale_date.dt.month]):
+            file_name = f"part-{rows['transaction_id'].min()}-{rows['transaction_id'].max()}.parquet"
+            relative_path = f"year={year:04d}/month={month:02d}/{file_name}"
+            if self.target == "s3":
+                with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_file:
+                    rows.to_parquet(temp_file.name, compression=self.compression, index=False)
+                    self.s3_adapter.upload_file(self.bucket_name, self.prefix + relative_path, temp_file.name)
+            else:
+                local_path = os.path.join(self.local_dir, relative_path)
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                rows.to_parquet(local_path, compression=self.compression, index=False)
+            written.append(relative_path)
+        return written
+
+    def __read_partition(self, year: int, month: int, after_transaction_id: int = None):
+        """Yield the raw bytes of every archived file of one month, leaving
+        - out the files without ids above after_transaction_id."""
+        partition = f"year={year:04d}/month={month:02d}"
+        if self.target == "s3":
+            for file_key in self.s3_adapter.list_files(self.bucket_name, self.prefix + partition):
+                if self.__holds_ids_after(file_key, after_transaction_id):
+                    yield self.s3_adapter.read_file(self.bucket_name, file_key)
+        else:
+            partition_dir = os.path.join(self.local_dir, partition)
+            if not os.path.isdir(partition_dir):
+                return
+            for file_name in sorted(os.listdir(partition_dir)):
+                if self.__holds_ids_after(file_name, after_transaction_id):
+                    with open(os.path.join(partition_dir, file_name), "rb") as archived_file:
+                        yield archived_file.read()
+
+    @staticmethod
+    def __holds_ids_after(file_name: str, after_transaction_id: int = None) -> bool:
+        """Whether an archived file (part-<first id>-<last id>.parquet) may
+        - hold ids above after_transaction_id."""
+        if not file_name.endswith(".parquet"):
+            return False
+        if after_transaction_id is None:
+            return True
+        try:
+            last_id = int(file_name.rsplit("/", 1)[-1][:-len(".parquet")].rsplit("-", 1)[-1])
+        except ValueError:
+            return True
+        return last_id > after_transaction_id
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    archive_service = SalesArchiveService(
+        db_adapter=SQLRepository(DB_STRING),
+        s3_adapter=S3Service() if ARCHIVE_TARGET == "s3" else None
+    )
+    result = archive_service.archive()
+    logger.info(f"Archived {result['archived_rows']} sales into {len(result['files'])} file(s)")
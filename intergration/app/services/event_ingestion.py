@@ -0,0 +1,380 @@
+"""Event-driven ingestion: every file is ingested as soon as it arrives.
+
+    python -m intergration.app.services.event_ingestion --source directory
+    python -m intergration.app.services.event_ingestion --source sqs
+
+Instead of listing a whole prefix on every trigger, a worker consumes
+new-file events from one source:
+
+- directory: files landing in the staging directory. Once a file has not
+  changed for the settle time it is ingested, then moved to the processed
+  directory. Files already staged when the worker starts are picked up too.
+- queue: an in-process stand-in for a notification queue, fed with S3 event
+  notifications through POST /intergration/events.
+- sqs: S3 event notifications delivered to an SQS queue, directly or via SNS.
+
+Files are claimed through the file leases of IntergrationService, so any
+number of workers can consume the same source side by side, and a file
+arriving through several paths is still loaded once. The listing trigger
+stays available as a reconciliation sweep.
+"""
+import sys
+sys.path.append('/home/kosala/git-repos/moon_agent_tracker_test/')
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import signal
+import threading
+import time
+from urllib.parse import unquote_plus
+from intergration.app.db_repository.sql_repository import SQLRepository
+from intergration.app.s3_repository.s3_service import S3Service
+from intergration.app.services.service import IntergrationService
+from intergration.configs import DB_STRING, INGESTION_EVENT_SOURCE, INGESTION_STAGING_DIR, \
+    INGESTION_PROCESSED_DIR, INGESTION_WATCH_INTERVAL_SECONDS, INGESTION_SETTLE_SECONDS, \
+    INGESTION_SQS_QUEUE_URL, INGESTION_SQS_WAIT_SECONDS, INGESTION_MAX_ATTEMPTS, \
+    INGESTION_RETRY_BACKOFF_BASE_SECONDS, INGESTION_RETRY_BACKOFF_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class EventSourceException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class FileEvent:
+    """A file that arrived, either in a bucket or at a local path."""
+    def __init__(self, file_key: str, bucket_name: str = None, local_path: str = None, receipt: str = None,
+                 file_version: str = None):
+        self.file_key = file_key
+        self.bucket_name = bucket_name
+        self.local_path = local_path
+        # ETag of an object, so a replaced object is retried after it failed
+        self.file_version = file_version
+        # handle of the queue message the event came in, if any
+        self.receipt = receipt
+
+
+def parse_s3_notification(message: dict) -> list:
+    """File events of the object-created records of an S3 event notification.
+
+    Test events and other event types yield no file events.
+    """
+    events = []
+    for record in message.get("Records", []):
+        if not record.get("eventName", "").startswith("ObjectCreated"):
+            continue
+        file_key = unquote_plus(record["s3"]["object"]["key"])
+        if file_key.endswith("/"):
+            continue
+        events.append(FileEvent(file_key, bucket_name=record["s3"]["bucket"]["name"],
+                                file_version=record["s3"]["object"].get("eTag")))
+    return events
+
+
+class EventSource:
+    def poll(self, stop_event: threading.Event, timeout: float) -> list:
+        """Wait up to timeout for new file events."""
+        raise NotImplementedError
+
+    def ack(self, event: FileEvent, loaded: bool):
+        """The file of an event was ingested, by this worker when loaded is
+        - set, or was already processed or claimed by another worker."""
+
+    def nack(self, event: FileEvent):
+        """Ingesting the file of an event failed."""
+
+    def close(self):
+        pass
+
+
+class DirectoryWatcherSource(EventSource):
+    """Watches a staging directory for new files.
+
+    The directory is scanned every poll, which for a local directory is a
+    single cheap system call; hidden and partial (.part, .tmp) files are
+    ignored. A file is moved out once this worker has loaded it. A failed
+    file is retried with exponential backoff until it has failed
+    max_attempts times. Files that kept failing, and files another worker
+    claimed (which that worker moves), are not looked at again until they
+    are replaced.
+    """
+    IGNORED_SUFFIXES = (".part", ".tmp")
+
+    def __init__(self, staging_dir: str = INGESTION_STAGING_DIR, processed_dir: str = INGESTION_PROCESSED_DIR,
+                 settle_seconds: float = INGESTION_SETTLE_SECONDS, max_attempts: int = INGESTION_MAX_ATTEMPTS,
+                 backoff_base_seconds: float = INGESTION_RETRY_BACKOFF_BASE_SECONDS,
+                 backoff_max_seconds: float = INGESTION_RETRY_BACKOFF_MAX_SECONDS):
+        if not os.path.isdir(staging_dir):
+            raise EventSourceException(f"Staging directory {staging_dir} does not exist")
+        self.staging_dir = staging_dir
+        self.processed_dir = processed_dir
+        self.settle_seconds = settle_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self._queued = set()
+        # path -> modification time of files not to pick up again
+        self._passed = {}
+        # path -> (modification time, failed attempts, time of the next retry)
+        self._failed = {}
+
+    def poll(self, stop_event, timeout):
+        events = self.__ready_files()
+        if not events:
+            stop_event.wait(timeout)
+        return events
+
+    def ack(self, event, loaded):
+        if not loaded:
+            self.__pass(event)
+            return
+        self._queued.discard(event.local_path)
+        self._failed.pop(event.local_path, None)
+        os.makedirs(self.processed_dir, exist_ok=True)
+        shutil.move(event.local_path, os.path.join(self.processed_dir, os.path.basename(event.local_path)))
+
+    def nack(self, event):
+        self._queued.discard(event.local_path)
+        try:
+            modified = os.stat(event.local_path).st_mtime
+        except FileNotFoundError:
+            self._failed.pop(event.local_path, None)
+            return
+        previous_modified, attempts, _ = self._failed.get(event.local_path, (modified, 0, 0))
+        attempts = attempts + 1 if previous_modified == modified else 1
+        if attempts >= self.max_attempts:
+            logger.error(f"Giving up on {event.local_path} after {attempts} failed attempt(s)")
+            self._failed.pop(event.local_path, None)
+            self.__pass(event)
+            return
+        delay = self.backoff_delay(attempts)
+        logger.warning(f"Retrying {event.local_path} in {delay:.0f}s, attempt {attempts} of {self.max_attempts} failed")
+        self._failed[event.local_path] = (modified, attempts, time.time() + delay)
+
+    def backoff_delay(self, attempts: int) -> float:
+        """Seconds to wait before retrying a file that failed attempts times."""
+        return min(self.backoff_base_seconds * (2 ** (attempts - 1)), self.backoff_max_seconds)
+
+    def __pass(self, event):
+        self._queued.discard(event.local_path)
+        try:
+            self._passed[event.local_path] = os.stat(event.local_path).st_mtime
+        except FileNotFoundError:
+            pass
+
+    def __ready_files(self):
+        now = time.time()
+        events = []
+        with os.scandir(self.staging_dir) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.name.startswith(".") or entry.name.endswith(self.IGNORED_SUFFIXES):
+                    continue
+                if entry.path in self._queued or not entry.is_file():
+                    continue
+                modified = entry.stat().st_mtime
+                if self._passed.get(entry.path) == modified or now - modified < self.settle_seconds:
+                    continue
+                failed = self._failed.get(entry.path)
+                if failed is not None and failed[0] == modified and now < failed[2]:
+                    continue
+                self._passed.pop(entry.path, None)
+                self._queued.add(entry.path)
+                events.append(FileEvent(entry.path, local_path=entry.path))
+        return events
+
+
+class LocalQueueSource(EventSource):
+    """In-process stand-in for a notification queue."""
+    def __init__(self, maxsize: int = 0):
+        self.queue = queue.Queue(maxsize)
+
+    def publish(self, message: dict) -> int:
+        """Queue the files of an S3 event notification.
+
+        Returns:
+            int: Number of queued file events.
+        """
+        events = parse_s3_notification(message)
+        for event in events:
+            self.queue.put(event)
+        return len(events)
+
+    def poll(self, stop_event, timeout):
+        try:
+            events = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class SQSSource(EventSource):
+    """S3 event notifications from an SQS queue, received with long polling.
+
+    A message is deleted once all of its files are ingested or skipped. A
+    failed file leaves its message in the queue, so it is delivered again
+    after the visibility timeout (and dead-lettered by the queue's redrive
+    policy when it keeps failing). A message that is not a valid
+    notification is logged and deleted.
+    """
+    def __init__(self, queue_url: str = INGESTION_SQS_QUEUE_URL, wait_seconds: int = INGESTION_SQS_WAIT_SECONDS):
+        if not queue_url:
+            raise EventSourceException("INGESTION_SQS_QUEUE_URL is not set")
+        import boto3
+        self.sqs_client = boto3.client('sqs')
+        self.queue_url = queue_url
+        self.wait_seconds = wait_seconds
+        self._outstanding = {}
+
+    def poll(self, stop_event, timeout):
+        try:
+            response = self.sqs_client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=self.wait_seconds
+            )
+        except Exception as e:
+            raise EventSourceException(f"Error receiving from queue {self.queue_url}: {e}")
+        events = []
+        for message in response.get("Messages", []):
+            try:
+                body = json.loads(message["Body"])
+                if "Records" not in body and "Message" in body:
+                    # delivered through an SNS topic
+                    body = json.loads(body["Message"])
+                message_events = parse_s3_notification(body)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                # redelivering it would fail the same way, so drop it
+                logger.error(f"Deleting malformed message {message.get('MessageId')} "
+                             f"from queue {self.queue_url}: {e}")
+                self.__delete(message["ReceiptHandle"])
+                continue
+            if not message_events:
+                self.__delete(message["ReceiptHandle"])
+                continue
+            self._outstanding[message["ReceiptHandle"]] = len(message_events)
+            for event in message_events:
+                event.receipt = message["ReceiptHandle"]
+                events.append(event)
+        return events
+
+    def ack(self, event, loaded):
+        if event.receipt not in self._outstanding:
+            return
+        self._outstanding[event.receipt] -= 1
+        if self._outstanding[event.receipt] == 0:
+            del self._outstanding[event.receipt]
+            self.__delete(event.receipt)
+
+    def nack(self, event):
+        self._outstanding.pop(event.receipt, None)
+
+    def close(self):
+        close = getattr(self.sqs_client, "close", None)
+        if close is not None:
+            close()
+
+    def __delete(self, receipt):
+        try:
+            self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+        except Exception as e:
+            logger.warning(f"Could not delete message from queue {self.queue_url}: {e}")
+
+
+def get_event_source(kind: str = INGESTION_EVENT_SOURCE) -> EventSource:
+    if kind == "directory":
+        return DirectoryWatcherSource()
+    if kind == "queue":
+        return LocalQueueSource()
+    if kind == "sqs":
+        return SQSSource()
+    raise EventSourceException(f"Unknown ingestion event source: {kind}")
+
+
+class EventIngestionWorker:
+    """Ingests the file of every event of a source as it arrives."""
+    def __init__(self, service: IntergrationService, source: EventSource,
+                 poll_seconds: float = INGESTION_WATCH_INTERVAL_SECONDS):
+        self.service = service
+        self.source = source
+        self.poll_seconds = poll_seconds
+        self.stop_event = threading.Event()
+        self._thread = None
+
+    def handle(self, event: FileEvent) -> bool:
+        """Ingest the file of one event.
+
+        Returns:
+            bool: True if this worker loaded the file.
+        """
+        if event.local_path:
+            return self.service.ingest_file(event.file_key, event.local_path)
+        return self.service.ingest_object(event.bucket_name, event.file_key, event.file_version)
+
+    def run(self):
+        """Consume events until stopped."""
+        while not self.stop_event.is_set():
+            try:
+                events = self.source.poll(self.stop_event, self.poll_seconds)
+            except EventSourceException as e:
+                logger.error(e)
+                self.stop_event.wait(self.poll_seconds)
+                continue
+            except Exception as e:
+                # keep the worker thread alive, the next poll may succeed
+                logger.exception(f"Unexpected error polling for events: {e}")
+                self.stop_event.wait(self.poll_seconds)
+                continue
+            for event in events:
+                started = time.monotonic()
+                try:
+                    loaded = self.handle(event)
+                except Exception as e:
+                    logger.error(f"Ingestion of {event.file_key} failed: {e}")
+                    self.source.nack(event)
+                    continue
+                self.source.ack(event, loaded)
+                if loaded:
+                    logger.info(f"Ingested {event.file_key} in {time.monotonic() - started:.2f}s")
+
+    def start(self):
+        """Run in a background thread, used by the API lifespan."""
+        self._thread = threading.Thread(target=self.run, name="event-ingestion", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self.stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.source.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Ingest sales files as they arrive.")
+    parser.add_argument("--source", choices=["directory", "sqs"], default=INGESTION_EVENT_SOURCE or "directory")
+    args = parser.parse_args()
+
+    db_repository = SQLRepository(database_url=DB_STRING)
+    s3_repository = S3Service() if args.source == "sqs" else None
+    worker = EventIngestionWorker(
+        IntergrationService(db_adapter=db_repository, s3_adapter=s3_repository),
+        get_event_source(args.source)
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop_event.set())
+    try:
+        worker.run()
+    finally:
+        worker.source.close()
+        db_repository.dispose()
+        if s3_repository is not None:
+            s3_repository.close()
@@ -2,34 +2,107 @@ import sys
 sys.path.append('/home/kosala/git-repos/moon_agent_tracker_test/')
 from intergration.app.s3_repository.s3_service import S3Service, S3ServiceException
 from intergration.app.db_repository.sql_repository import SQLRepository, DatabaseOperationException
-from intergration.app.db_repository.sql_repository import DataNotFoundException
+from intergration.app.db_repository.sql_repository import DataNotFoundException, LeaseLostException
 import logging
 import hashlib
-from intergration.configs import DOWNLOAD_DIR, DB_STRING
+import socket
+import threading
+import uuid
+from intergration.app.models.types import to_uuid_bytes
+from intergration.configs import DOWNLOAD_DIR, DB_STRING, INGESTION_WORKER_ID, INGESTION_LEASE_SECONDS, \
+    INGESTION_LEASE_HEARTBEAT_SECONDS, INGESTION_MAX_ATTEMPTS
 import os
-import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+class LeaseHeartbeat:
+    """Renews a file lease in the background while the file is processed.
+    
+    Used as a context manager around the work on one file. If a renewal
+    - finds the lease taken over, ``lost`` is set and the heartbeat stops;
+    - the worker checks it between steps to give up early, and a load that
+    - starts anyway is rejected by complete_file_lease.
+    """
+    def __init__(self, db_adapter: SQLRepository, file_hash: str, owner: str,
+                 lease_seconds: int = INGESTION_LEASE_SECONDS,
+                 interval_seconds: float = INGESTION_LEASE_HEARTBEAT_SECONDS):
+        self.db_adapter = db_adapter
+        self.file_hash = file_hash
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.interval_seconds = interval_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.__run, name=f"lease-{file_hash[:12]}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def check(self):
+        """Raise LeaseLostException if the lease was taken over."""
+        if self.lost:
+            raise LeaseLostException(f"Lease of file {self.file_hash} was taken over by another worker")
+
+    def __run(self):
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                renewed = self.db_adapter.renew_file_lease(self.file_hash, self.owner, self.lease_seconds)
+            except DatabaseOperationException as e:
+                # keep trying, the lease outlives a few missed heartbeats
+                logger.warning(f"Could not renew lease of file {self.file_hash}: {e}")
+                continue
+            if not renewed and not self._stop.is_set():
+                self.lost = True
+                logger.warning(f"Lease of file {self.file_hash} was taken over by another worker")
+                return
+
+def local_file_version(path: str):
+    """Modification time and size of a local file, None if it is gone."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
 class IntergrationService:
-    def __init__(self, db_adapter: SQLRepository=None, s3_adapter: S3Service=None):
+    def __init__(self, db_adapter: SQLRepository=None, s3_adapter: S3Service=None,
+                 worker_id: str = INGESTION_WORKER_ID):
         self.db_adapter = db_adapter
         self.s3_adapter = s3_adapter
+        # prefix of the lease owners of this instance; every claim gets its own
+        # owner, so overlapping calls in one process fence each other out too
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
         
     def fetch_data(self, request_params: dict):
         """fetch data from a s3 bucket as files ** process a file at a time **
         1. fetch files from s3 bucket
         2. compare file hash with db to check if file has already been processed
-        3. if file has not been processed, process the file
+        3. if file has not been processed, claim a lease on it; skip the file \
+            if another worker holds it, so many workers can split one prefix
         4. if file has been processed, skip the file and move to the next file
-        5. if file has been processed, save the processsed file hash to db \
-            and archive and save the file to s3 bucket. delete the processed \
+        5. process the file while a heartbeat renews the lease; its rows, the \
+            processed file hash and the completed lease commit together. on \
+            failure the lease is released so the file is retried
+        6. archive and save the file to s3 bucket. delete the processed \
             file from the bucket(source)
 
+        A file that fails does not stop the others; the failures are
+        - logged and reported once every file was tried.
+
         Args:
             request_params (dict): can be any for now
+
+        Returns:
+            dict: Keys of the loaded and skipped files, and the error of
+            every failed file by key.
         """ 
-        output = False
+        output = {"loaded": [], "skipped": [], "failed": {}}
         try:
             file_path_list = self.s3_adapter.list_files(
                 request_params['bucket_name'], 
@@ -39,28 +112,21 @@ class IntergrationService:
                 raise S3ServiceException("No files found in bucket")
             
             for file_path in file_path_list:
-                file_name = file_path.split("/")[-1]
-                file_hash = self.__generate_file_hash(file_name)
-                file_hash_exists = self.db_adapter.check_file_hash_exists(file_hash)
-                
-                if file_hash_exists:
-                    logger.info(f"File {file_name} has already been processed. Skipping...")
+                try:
+                    loaded = self.ingest_object(request_params['bucket_name'], file_path)
+                except Exception as e:
+                    logger.error(f"Ingestion of {file_path} failed: {e}")
+                    output["failed"][file_path] = str(e)
                     continue
-                else:
-                    output_file_path = os.path.join(DOWNLOAD_DIR, file_name) 
-                    self.s3_adapter.download_file(
-                        request_params['bucket_name'], 
-                        file_path, 
-                        output_file_path
-                    )
-                    self.__process_file(output_file_path)
-                    self.db_adapter.save_file_hash(file_hash)
-                    
-                    #TODO: archive the file and delete the file from the bucket
+                output["loaded" if loaded else "skipped"].append(file_path)
                     
-                    # self.s3_adapter.archive_file(file)  
-                    # self.s3_adapter.delete_file(file)
-            output = True
+                #TODO: archive the file and delete the file from the bucket
+                
+                # self.s3_adapter.archive_file(file)  
+                # self.s3_adapter.delete_file(file)
+            if output["failed"]:
+                logger.error(f"{len(output['failed'])} of {len(file_path_list)} file(s) failed to ingest: "
+                             f"{', '.join(output['failed'])}")
         except DatabaseOperationException as e:
             raise e
         except FileNotFoundError as e:
@@ -71,6 +137,80 @@ class IntergrationService:
             raise e
         return output
     
+    def ingest_object(self, bucket_name: str, file_key: str, file_version: str = None) -> bool:
+        """Ingest one object of a bucket, unless it has been processed or
+        - another worker holds it.
+
+        Args:
+            file_version (str): ETag of the object, if known.
+
+        Returns:
+            bool: True if this call loaded the file.
+        """
+        output_file_path = os.path.join(DOWNLOAD_DIR, file_key.split("/")[-1])
+        return self.ingest_file(
+            file_key,
+            output_file_path,
+            lambda: self.s3_adapter.download_file(bucket_name, file_key, output_file_path),
+            file_version
+        )
+
+    def ingest_file(self, file_key: str, local_path: str, fetch=None, file_version: str = None) -> bool:
+        """Claim, fetch and process one file.
+
+        Files are identified by their name, so a file is loaded once whether
+        - it arrives through a bucket listing, a notification or the staging
+        - directory.
+
+        Args:
+            file_key (str): Key of the file, the bucket key or a local path.
+            local_path (str): Where the file is read from.
+            fetch: Called once the file is claimed to put it at local_path,
+            None when it is already there.
+            file_version (str): Identifies the contents of the file, so a
+            replaced file is retried after it failed too often; defaults to
+            the modification time and size of a file already at local_path.
+
+        Returns:
+            bool: True if this call loaded the file.
+        """
+        file_name = file_key.split("/")[-1]
+        file_hash = self.__generate_file_hash(file_name)
+        if self.db_adapter.check_file_hash_exists(file_hash):
+            logger.info(f"File {file_name} has already been processed. Skipping...")
+            return False
+        if file_version is None and fetch is None:
+            file_version = local_file_version(local_path)
+        lease_owner = f"{self.worker_id}/{uuid.uuid4().hex[:12]}"
+        if not self.db_adapter.claim_file_lease(file_hash, file_key, lease_owner, INGESTION_LEASE_SECONDS,
+                                                INGESTION_MAX_ATTEMPTS, file_version):
+            lease = self.db_adapter.get_file_lease(file_hash)
+            if lease is not None and lease.status == "FAILED":
+                logger.warning(f"File {file_name} gave up after {lease.attempts} failed attempt(s); "
+                               f"replace the file to retry it. Skipping...")
+            else:
+                logger.info(f"File {file_name} is claimed by another worker. Skipping...")
+            return False
+        self.__ingest_leased_file(file_hash, lease_owner, fetch or (lambda: None), local_path)
+        return True
+
+    def __ingest_leased_file(self, file_hash, lease_owner, fetch, file):
+        """Fetch and process a file this worker holds the lease of, releasing
+        - the lease if anything fails."""
+        try:
+            with LeaseHeartbeat(self.db_adapter, file_hash, lease_owner) as heartbeat:
+                fetch()
+                heartbeat.check()
+                self.__process_file(file, file_hash, lease_owner, heartbeat)
+        except Exception as e:
+            if not isinstance(e, LeaseLostException):
+                try:
+                    self.db_adapter.release_file_lease(file_hash, lease_owner, str(e))
+                except DatabaseOperationException as release_error:
+                    # the lease expires by itself, report the original error
+                    logger.error(release_error)
+            raise e
+
     def __generate_file_hash(self, file):
         """generate a hash for a file"""
         hasher = hashlib.sha256()
@@ -78,17 +218,52 @@ class IntergrationService:
        
         return hasher.hexdigest()
     
-    def __process_file(self, file):
+    def __process_file(self, file, file_hash, lease_owner, heartbeat):
         """process a file"""
         # process the file
         # get the db engine
+        # pandas is only needed once a file is processed, keep it off the import path
+        import pandas as pd
         db_engine = self.db_adapter.get_db_engine()
         dataframe = pd.read_csv(file)
+        rollup_rows = self.__build_daily_rollup(dataframe)
+        
+        # ids are stored as BINARY(16), see BinaryUUID
+        for id_column in ('agent_id', 'product_id'):
+            dataframe[id_column] = dataframe[id_column].map(to_uuid_bytes)
         
-        dataframe.to_sql(
-            'sales_transaction', con=db_engine,
-            if_exists='append', index=False
+        # raw rows, the daily rollup and the completed lease commit together;
+        # completing first locks the lease for the rest of the transaction
+        heartbeat.check()
+        with db_engine.begin() as connection:
+            self.db_adapter.complete_file_lease(connection, file_hash, lease_owner)
+            dataframe.to_sql(
+                'sales_transaction', con=connection,
+                if_exists='append', index=False
+            )
+            self.db_adapter.upsert_sales_daily_rollup(connection, rollup_rows)
+
+    def __build_daily_rollup(self, dataframe):
+        """sum the sales of a file per agent, day and product"""
+        import pandas as pd
+        sales = dataframe.assign(
+            sale_day=pd.to_datetime(dataframe['sale_date']).dt.date
+        )
+        rollup = sales.groupby(['agent_id', 'sale_day', 'product_id'], as_index=False).agg(
+            total_sales=('sale_amount', 'sum'),
+            transaction_count=('sale_amount', 'size')
         )
+        rollup['total_sales'] = rollup['total_sales'].round(2)
+        return [
+            {
+                'agent_id': row.agent_id,
+                'sale_day': row.sale_day,
+                'product_id': row.product_id,
+                'total_sales': float(row.total_sales),
+                'transaction_count': int(row.transaction_count),
+            }
+            for row in rollup.itertuples(index=False)
+        ]
     
     
 if __name__ == "__main__":
@@ -12,3 +12,63 @@ if not DB_STRING_CHECK:
 DB_STRING = os.getenv('DB_STRING')   
 
 DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', '/home/kosala/git-repos/moon_agent_tracker_test/intergration/data/output/') 
+
+# Serving: one engine pool per worker process, so every worker holds up to
+# DB_POOL_SIZE + DB_MAX_OVERFLOW connections. The worker count is a small
+# fixed default rather than the CPU count, which inside a container is the
+# node's and not the pod's
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '8000'))
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '2'))
+GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS = int(os.getenv('GRACEFUL_SHUTDOWN_TIMEOUT_SECONDS', '30'))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '5'))
+
+# Request / SQL timing
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
+# log every statement with its parameters; off by default because it
+# bypasses the parameter redaction of the slow-query log
+DB_ECHO = os.getenv('DB_ECHO', 'false').lower() == 'true'
+
+# Cold-storage archival of old sales transactions
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', '365'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '50000'))
+ARCHIVE_COMPRESSION = os.getenv('ARCHIVE_COMPRESSION', 'zstd')
+ARCHIVE_TARGET = os.getenv('ARCHIVE_TARGET', 'local')  # local | s3
+ARCHIVE_LOCAL_DIR = os.getenv('ARCHIVE_LOCAL_DIR', '/home/kosala/git-repos/moon_agent_tracker_test/intergration/data/archive/')
+ARCHIVE_BUCKET = os.getenv('ARCHIVE_BUCKET', 'iit-cc-shal-2024')
+ARCHIVE_PREFIX = os.getenv('ARCHIVE_PREFIX', 'archive/sales_transaction/')
+# GET /intergration/sales returns pages of at most this many sales
+SALES_PAGE_SIZE = int(os.getenv('SALES_PAGE_SIZE', '1000'))
+SALES_MAX_PAGE_SIZE = int(os.getenv('SALES_MAX_PAGE_SIZE', '10000'))
+
+# File leases: an ingestion worker claims a file for INGESTION_LEASE_SECONDS
+# and renews the claim every INGESTION_LEASE_HEARTBEAT_SECONDS while it works
+# on it; a file whose worker died is taken over once the lease expires, and a
+# failed file is retried until it has been attempted INGESTION_MAX_ATTEMPTS
+# times, or the file is replaced (other modification time and size, or ETag)
+INGESTION_WORKER_ID = os.getenv('INGESTION_WORKER_ID')  # defaults to host name and pid
+INGESTION_LEASE_SECONDS = int(os.getenv('INGESTION_LEASE_SECONDS', '300'))
+INGESTION_LEASE_HEARTBEAT_SECONDS = float(os.getenv('INGESTION_LEASE_HEARTBEAT_SECONDS', '60'))
+INGESTION_MAX_ATTEMPTS = int(os.getenv('INGESTION_MAX_ATTEMPTS', '3'))
+
+# Event-driven ingestion: files are ingested as they arrive instead of by
+# listing a prefix. INGESTION_EVENT_SOURCE picks where arrivals come from:
+# "directory" watches INGESTION_STAGING_DIR (processed files are moved to
+# INGESTION_PROCESSED_DIR), "queue" is an in-process stand-in fed through
+# POST /intergration/events, "sqs" consumes S3 event notifications from
+# INGESTION_SQS_QUEUE_URL. Unset, the API only ingests on trigger calls
+INGESTION_EVENT_SOURCE = os.getenv('INGESTION_EVENT_SOURCE')
+INGESTION_STAGING_DIR = os.getenv('INGESTION_STAGING_DIR', '/home/kosala/git-repos/moon_agent_tracker_test/intergration/data/staged_data/')
+INGESTION_PROCESSED_DIR = os.getenv('INGESTION_PROCESSED_DIR', DOWNLOAD_DIR)
+INGESTION_WATCH_INTERVAL_SECONDS = float(os.getenv('INGESTION_WATCH_INTERVAL_SECONDS', '1'))
+# a staged file is read once it has not changed for this long, so files
+# that are still being copied in are not picked up half written
+INGESTION_SETTLE_SECONDS = float(os.getenv('INGESTION_SETTLE_SECONDS', '2'))
+# a staged file that failed is retried after an exponential backoff, until it
+# has failed INGESTION_MAX_ATTEMPTS times; after that only a replaced file is,
+# with fresh attempts
+INGESTION_RETRY_BACKOFF_BASE_SECONDS = float(os.getenv('INGESTION_RETRY_BACKOFF_BASE_SECONDS', '30'))
+INGESTION_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv('INGESTION_RETRY_BACKOFF_MAX_SECONDS', '600'))
+INGESTION_SQS_QUEUE_URL = os.getenv('INGESTION_SQS_QUEUE_URL')
+INGESTION_SQS_WAIT_SECONDS = int(os.getenv('INGESTION_SQS_WAIT_SECONDS', '20'))